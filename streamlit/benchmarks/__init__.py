@@ -0,0 +1,4 @@
+"""
+Benchmarks of the scoring pipeline.
+Run them from the streamlit/ directory, e.g. `python -m benchmarks.normalizer`.
+"""
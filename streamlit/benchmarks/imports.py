@@ -0,0 +1,98 @@
+"""
+Import time of the app at startup, and check against a budget.
+
+The startup modules are the top-level imports of main.py: they are imported before the first render. Each run
+imports them in a fresh interpreter with `python -X importtime`. The heavy dependencies only needed after a search
+(DEFERRED_MODULES: map, radar chart) must not be among them.
+
+    python -m benchmarks.imports               # Profile of the startup imports, fails over the default budget
+    python -m benchmarks.imports --budget 3    # Budget in seconds
+"""
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+from typing import Dict, List, Set, Tuple
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Best wall time of the startup imports, in seconds
+DEFAULT_BUDGET_S = 2.0
+# Modules imported by the functions using them, once there are results to show. Streamlit imports the base plotly
+# package itself, plotly.express is the heavy part.
+DEFERRED_MODULES = ['folium', 'branca', 'streamlit_folium', 'plotly.express', 'sklearn', 'gcsfs', 'google.cloud.storage']
+
+
+def startup_modules(main_path: str = os.path.join(APP_DIR, 'main.py')) -> List[str]:
+    """Returns the modules imported at the top level of main.py, in order."""
+    with open(main_path) as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            modules.append(node.module)
+    return modules
+
+
+def profile_imports(modules: List[str]) -> Tuple[float, Dict[str, float], Set[str]]:
+    """
+    Imports `modules` in a fresh interpreter.
+
+    Returns:
+        The wall time of the imports in seconds, the import time of each top-level package in seconds (its own
+        modules only, not the packages it imports), and the names of all the modules loaded.
+    """
+    code = (
+        "import time, sys, json\n"
+        "start = time.perf_counter()\n"
+        + "".join(f"import {module}\n" for module in modules)
+        + "print(json.dumps([time.perf_counter() - start, sorted(sys.modules)]))\n"
+    )
+    run = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=APP_DIR, capture_output=True, text=True, check=True)
+    wall_time, loaded = json.loads(run.stdout.strip().splitlines()[-1])
+
+    # Lines are 'import time: self [us] | cumulative | name'
+    packages = defaultdict(float)
+    for line in run.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        packages[name.strip().split('.')[0]] += int(own) / 1e6
+    return wall_time, dict(packages), set(loaded)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET_S, help='Budget of the startup imports, in seconds')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help='Number of packages shown in the profile')
+    args = parser.parse_args()
+
+    modules = startup_modules()
+    print(f"Startup modules: {', '.join(modules)}")
+    runs = [profile_imports(modules) for _ in range(args.repeat)]
+    wall_time, packages, loaded = min(runs, key=lambda run: run[0])
+
+    print(f"\n{'package':<24}{'import (s)':>12}")
+    for name, seconds in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{name:<24}{seconds:>12.3f}")
+    print(f"\nStartup imports: {wall_time:.2f} s (best of {args.repeat}), budget {args.budget:.2f} s")
+
+    errors = []
+    if wall_time > args.budget:
+        errors.append(f"startup imports take {wall_time:.2f} s, over the budget of {args.budget:.2f} s")
+    eager = [module for module in DEFERRED_MODULES if module in loaded]
+    if eager:
+        errors.append(f"deferred modules imported at startup: {', '.join(eager)}")
+    if errors:
+        print('FAILED: ' + '; '.join(errors))
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
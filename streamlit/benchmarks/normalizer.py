@@ -0,0 +1,96 @@
+"""
+Benchmark of `scoring.quantile_normalize` against the per-column sklearn QuantileTransformer fits it replaces.
+Also checks that both give the same scores within tolerance. The check needs scikit-learn, which is not in
+requirements.txt (the app does not use it): install it separately (`pip install scikit-learn`), otherwise it is skipped.
+The same check runs as a test, skipped without scikit-learn:
+
+    python -m benchmarks.normalizer --rows 35000 --criteria 10
+    python -m pytest benchmarks
+"""
+import argparse
+import importlib.util
+import sys
+import time
+
+import numpy as np
+
+from scoring import quantile_normalize
+
+
+def make_criteria_block(n_rows: int, n_criteria: int, seed: int = 0) -> np.ndarray:
+    """Builds a block shaped like real criteria: skewed ratios with many zeros, and small match counts with many ties."""
+    rng = np.random.default_rng(seed)
+    block = np.empty((n_rows, n_criteria))
+    for j in range(n_criteria):
+        if j % 2 == 0:
+            block[:, j] = np.where(rng.random(n_rows) < 0.3, 0, rng.lognormal(0, 1, n_rows))
+        else:
+            block[:, j] = rng.poisson(0.5, n_rows)
+    return block
+
+
+def sklearn_normalize(block: np.ndarray) -> np.ndarray:
+    """Former implementation: one QuantileTransformer fit per criterion."""
+    from sklearn import preprocessing
+    transformer = preprocessing.QuantileTransformer(output_distribution="uniform")
+    return np.column_stack([transformer.fit_transform(block[:, [j]])[:, 0] for j in range(block.shape[1])])
+
+
+def timeit(func, *args, repeat: int = 5) -> float:
+    """Returns the best wall time of `repeat` runs, in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+    return 1000 * min(timings)
+
+
+def equivalence_tolerance(n_rows: int) -> float:
+    """
+    Tolerance of the comparison of both implementations. Below 1000 rows QuantileTransformer is exact, except on ties:
+    their ranks differ by up to half a rank, and the tolerance is one rank, 1 / (n_rows - 1). Above, it interpolates
+    between 1000 quantiles estimated on a random subsample of 10 000 rows.
+    """
+    return 1 / max(n_rows - 1, 1) if n_rows <= 1000 else 0.02
+
+
+def max_difference(n_rows: int, n_criteria: int) -> float:
+    """Largest difference between the scores of both implementations, on a criteria block of `n_rows`."""
+    block = make_criteria_block(n_rows, n_criteria, seed=n_rows)
+    return np.abs(quantile_normalize(block) - sklearn_normalize(block)).max()
+
+
+def check_equivalence(n_rows: int, n_criteria: int) -> bool:
+    """Compares both implementations, see equivalence_tolerance."""
+    tolerance = equivalence_tolerance(n_rows)
+    max_diff = max_difference(n_rows, n_criteria)
+    print(f"  {n_rows:>6} rows: max abs diff {max_diff:.5f} (tolerance {tolerance:.5f})")
+    return max_diff <= tolerance
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=35000, help='Number of communes in the search area')
+    parser.add_argument('--criteria', type=int, default=10, help='Number of criteria normalized per search')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    block = make_criteria_block(args.rows, args.criteria)
+    print(f"Normalizing {args.rows} x {args.criteria} criteria (best of {args.repeat}):")
+    print(f"  quantile_normalize:        {timeit(quantile_normalize, block, repeat=args.repeat):8.1f} ms")
+
+    if importlib.util.find_spec('sklearn') is None:
+        print("scikit-learn is not installed, skipping the comparison with QuantileTransformer.")
+        return
+
+    print(f"  QuantileTransformer x {args.criteria:<3}: {timeit(sklearn_normalize, block, repeat=args.repeat):8.1f} ms")
+    print("Equivalence with QuantileTransformer:")
+    equivalent = all([check_equivalence(n_rows, args.criteria) for n_rows in (2, 50, 1000, args.rows)])
+    if not equivalent:
+        print("quantile_normalize differs from QuantileTransformer beyond tolerance.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Benchmark of `scoring.compute_odis_score` on a synthetic France-scale dataset (see benchmarks.synthetic).
+Reports the time spent in each stage of the pipeline and the peak memory of a search, for every DEMO_SCENARIOS
+profile and search radius. Stage caches are not used, except for the 'reweight' column: the time to rescore
+after a weight change, with a warm StageCache. Also checks that `scoring.compute_odis_score_batch` gives the same
+top results as `compute_odis_score` for the same profiles.
+
+    python -m benchmarks.pipeline --radii 25 50 1000 --repeat 3
+"""
+import argparse
+import copy
+import dataclasses
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+import config as cfg
+import scoring
+from indexes import build_commune_index, build_services_index, split_list_columns
+from benchmarks.synthetic import make_communes, make_inclusion_directory, load_scores_cat
+
+# Functions of the scoring module timed as pipeline stages, with the column they are reported in.
+STAGES = {
+    'select_search_area': 'search_area',
+    'compute_criteria_scores': 'criteria',
+    'compute_category_scores': 'categories',
+    'compute_weighted_score': 'weighted',
+    'select_best_score_per_commune': 'best_pairs',
+    'expand_result': 'expand',
+}
+# Methods of the CommuneIndex timed as part of a stage
+INDEX_STAGES = {
+    'neighbor_graph': 'search_area',
+}
+
+
+def demo_config(odis, scenario: str, loc_distance_km: int) -> cfg.ScoringConfig:
+    """Builds the ScoringConfig of a demo scenario, as the UI does when the demo is loaded."""
+    data = copy.deepcopy(cfg.DEMO_DATA_DEFAULT)
+    data.update(copy.deepcopy(cfg.DEMO_SCENARIOS[scenario]))
+    nb_adultes = data['nb_adultes']
+    return cfg.ScoringConfig(
+        poids_emploi=data['poids_emploi'],
+        poids_logement=data['poids_logement'],
+        poids_education=data['poids_education'],
+        poids_inclusion=data['poids_inclusion'],
+        poids_mobilité=data['poids_mobilité'],
+        commune_actuelle=odis.index[odis.libgeo == data['commune_actuelle']][0],
+        loc_distance_km=loc_distance_km,
+        nb_adultes=nb_adultes,
+        nb_enfants=data['nb_enfants'],
+        hebergement=data['hebergement'],
+        logement=data['logement'],
+        codes_metiers=(data['codes_metiers'] + [[]] * nb_adultes)[:nb_adultes],
+        codes_formations=(data['codes_formations'] + [[]] * nb_adultes)[:nb_adultes],
+        classe_enfants=data['classe_enfants'],
+        besoin_sante=data['sante'],
+        besoins_autres=data['besoins_autres'],
+        binome_penalty=data['binome_penalty'],
+        pop_min=data['pop_min'],
+    )
+
+
+@contextmanager
+def timed_stages(commune_index):
+    """Wraps the stage functions so that their run times (in ms) are summed in the yielded dict, by stage."""
+    timings = defaultdict(float)
+    targets = [(scoring, name, column) for name, column in STAGES.items()]
+    targets += [(commune_index, name, column) for name, column in INDEX_STAGES.items()]
+
+    def timed(func, column):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings[column] += 1000 * (time.perf_counter() - start)
+        return wrapper
+
+    originals = [(owner, name, getattr(owner, name)) for owner, name, _ in targets]
+    for owner, name, column in targets:
+        setattr(owner, name, timed(getattr(owner, name), column))
+    try:
+        yield timings
+    finally:
+        for owner, name, func in originals:
+            if owner is commune_index:
+                delattr(owner, name)  # Back to the class method
+            else:
+                setattr(owner, name, func)
+
+
+def benchmark_search(data: dict, config: cfg.ScoringConfig, repeat: int) -> dict:
+    """Runs one search `repeat` times and returns the timings of the fastest run, its size and its peak memory."""
+    args = (data['odis'], data['scores_cat'], config, data['incl_index'], data['commune_index'])
+    best = None
+    for _ in range(repeat):
+        with timed_stages(data['commune_index']) as timings:
+            start = time.perf_counter()
+            result = scoring.compute_odis_score(*args)
+            timings['total'] = 1000 * (time.perf_counter() - start)
+        if best is None or timings['total'] < best['total']:
+            best = dict(timings)
+
+    # Weight change with warm stages
+    stage_cache = scoring.StageCache(max_bytes=cfg.STAGE_CACHE_MAX_BYTES)
+    scoring.compute_odis_score(*args, stage_cache=stage_cache)
+    reweighted = dataclasses.replace(config, poids_emploi=config.poids_emploi // 2)
+    start = time.perf_counter()
+    scoring.compute_odis_score(*args[:2], reweighted, *args[3:], stage_cache=stage_cache)
+    best['reweight'] = 1000 * (time.perf_counter() - start)
+
+    # Peak memory is measured on a separate run, tracemalloc slows down allocations.
+    tracemalloc.start()
+    scoring.compute_odis_score(*args)
+    best['peak_mib'] = tracemalloc.get_traced_memory()[1] / 1024**2
+    tracemalloc.stop()
+
+    best['communes'] = len(result)
+    return best
+
+
+def check_batch_equivalence(data: dict, configs: list) -> bool:
+    """
+    Compares the top results of compute_odis_score_batch with the ones of compute_odis_score without the current
+    commune, for each config: same communes in the same order, same binome partners and same weighted scores.
+    """
+    args = (data['odis'], data['scores_cat'])
+    indexes = (data['incl_index'], data['commune_index'])
+    batch = scoring.compute_odis_score_batch(*args, configs, *indexes)
+    equivalent = True
+    for h, config in enumerate(configs):
+        single = scoring.compute_odis_score(*args, config, *indexes).drop(config.commune_actuelle, errors='ignore')
+        expected = scoring.rank_results(single, top_k=cfg.TOP_N_RESULTS).iloc[:cfg.TOP_N_RESULTS]
+        actual = batch[batch.household == h]
+        same_communes = (len(expected) == len(actual) and (expected.index.to_numpy() == actual['codgeo'].to_numpy()).all()
+                         and (expected['codgeo_binome'].to_numpy() == actual['codgeo_binome'].to_numpy()).all())
+        max_diff = np.abs(expected['weighted_score'].to_numpy() - actual['weighted_score'].to_numpy()).max() if same_communes else np.inf
+        print(f"  household {h}: {'same' if same_communes else 'different'} communes and partners, max abs diff {max_diff:.2e}")
+        equivalent &= max_diff <= 1e-9
+    return equivalent
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--side', type=int, default=190, help='The synthetic dataset has side x side communes')
+    parser.add_argument('--radii', type=int, nargs='+', default=[25, 50, 1000], help='Search radii, in km')
+    parser.add_argument('--scenarios', nargs='+', default=list(cfg.DEMO_SCENARIOS), help='Ids of the DEMO_SCENARIOS to run')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    # --- Dataset ---
+    start = time.perf_counter()
+    odis, odis_lists = split_list_columns(make_communes(n_side=args.side), scoring.ODIS_LIST_COLUMNS)
+    annuaire_inclusion = make_inclusion_directory(odis)
+    print(f"Synthetic dataset: {len(odis)} communes, {len(annuaire_inclusion)} inclusion services ({time.perf_counter() - start:.1f} s)")
+
+    start = time.perf_counter()
+    data = {
+        'odis': odis,
+        'scores_cat': load_scores_cat(),
+        'incl_index': build_services_index(annuaire_inclusion, odis.index),
+        'commune_index': build_commune_index(odis, odis_lists, scoring.PROJECTED_CRS),
+    }
+    print(f"Load-time indexes: {1000 * (time.perf_counter() - start):.0f} ms\n")
+
+    # --- Batch scoring ---
+    configs = [demo_config(odis, scenario, radius) for scenario in args.scenarios for radius in args.radii]
+    configs.append(dataclasses.replace(configs[0], poids_emploi=-50))  # Negative weights count as 0
+    print("Equivalence of compute_odis_score_batch with compute_odis_score:")
+    if not check_batch_equivalence(data, configs):
+        print("compute_odis_score_batch differs from compute_odis_score.")
+        sys.exit(1)
+    print()
+
+    # --- Searches ---
+    columns = ['communes'] + list(dict.fromkeys(STAGES.values())) + ['total', 'reweight', 'peak_mib']
+    print(f"Best of {args.repeat} runs, times in ms, peak memory in MiB")
+    print(f"{'scenario':<10}{'radius':>7}" + ''.join(f"{col:>13}" for col in columns))
+    for scenario in args.scenarios:
+        for radius in args.radii:
+            stats = benchmark_search(data, demo_config(odis, scenario, radius), args.repeat)
+            print(f"{scenario:<10}{radius:>7}{stats['communes']:>13}" + ''.join(f"{stats.get(col, 0):>13.1f}" for col in columns[1:]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Synthetic France-scale dataset matching the schema expected by scoring.py, for benchmarks on machines without
+the production parquet files: ~36k adjacent commune polygons with their neighbor lists, FAP and training codes,
+housing, schools and inclusion metrics, and an inclusion services directory.
+
+    odis = make_communes()
+    annuaire_inclusion = make_inclusion_directory(odis)
+    scores_cat = load_scores_cat()
+"""
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely as shp
+
+import config as cfg
+from scoring import PROJECTED_CRS
+
+# Lambert-93 extent roughly covering metropolitan France
+X_MIN, X_MAX = 100_000, 1_200_000
+Y_MIN, Y_MAX = 6_100_000, 7_100_000
+
+# Demo communes placed at their real Lambert-93 position, in their real département
+DEMO_COMMUNES = {
+    'Paris': ('75', 651_000, 6_862_000),
+    'Bordeaux': ('33', 417_000, 6_421_000),
+    'Marseille': ('13', 892_000, 6_247_000),
+}
+
+FAP_CODES = ['B2X37', 'B2X38', 'T2A60'] + [f'{a}{b}X{c:02d}' for a in 'ABDEGJLRSTUV' for b in range(4) for c in range(30, 40)]
+FORMATION_CODES = [str(c) for c in range(100, 470)]
+INCLUSION_SERVICES = [('apprendre-francais', '-'), ('apprendre-francais', 'communiquer-vie-tous-les-jours'),
+                      ('numerique', 'utiliser-le-numerique-au-quotidien'), ('numerique', 'prendre-en-main-un-ordinateur'),
+                      ('mobilite', 'aides-financieres-permis'), ('logement-hebergement', 'etre-accompagne-pour-se-loger'),
+                      ('famille', 'garde-denfants'), ('sante', 'acces-aux-soins')]
+
+
+def _wiggly_borders(start: np.ndarray, end: np.ndarray, n_points: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Builds irregular borders between `start` and `end` points (arrays of shape (..., 2)).
+
+    Returns:
+        The `n_points` inner points of each border, of shape (..., n_points, 2).
+    """
+    t = np.linspace(0, 1, n_points + 2)[1:-1]
+    direction = end - start
+    normal = np.stack([-direction[..., 1], direction[..., 0]], axis=-1)
+    # Sum of a few sine waves of random amplitude and phase, vanishing at both ends
+    waves = np.zeros(start.shape[:-1] + (n_points,))
+    for k in range(1, 6):
+        amplitude = rng.uniform(-0.06, 0.06, start.shape[:-1] + (1,)) / k
+        waves += amplitude * np.sin(np.pi * k * t + rng.uniform(0, np.pi, start.shape[:-1] + (1,))) * np.sin(np.pi * t)
+    return start[..., None, :] + t[:, None] * direction[..., None, :] + waves[..., None] * normal[..., None, :]
+
+
+def make_communes(n_side: int = 190, seed: int = 0, border_points: int = 0) -> gpd.GeoDataFrame:
+    """
+    Builds a GeoDataFrame of n_side x n_side adjacent communes covering metropolitan France.
+
+    Polygons are jittered grid cells sharing their vertices, so that neighbouring communes
+    touch exactly like a real administrative coverage. With `border_points`, each border between
+    two vertices is an irregular line of that many more points, also shared by both communes:
+    real commune polygons have hundreds of vertices.
+    """
+    rng = np.random.default_rng(seed)
+    n = n_side * n_side
+    step_x = (X_MAX - X_MIN) / n_side
+    step_y = (Y_MAX - Y_MIN) / n_side
+
+    # Shared, jittered vertices
+    vx, vy = np.meshgrid(np.arange(n_side + 1) * step_x + X_MIN, np.arange(n_side + 1) * step_y + Y_MIN)
+    vx = vx + rng.uniform(-0.2, 0.2, vx.shape) * step_x
+    vy = vy + rng.uniform(-0.2, 0.2, vy.shape) * step_y
+    rows, cols = np.divmod(np.arange(n), n_side)
+    corners = [(rows, cols), (rows, cols + 1), (rows + 1, cols + 1), (rows + 1, cols)]
+    coords = np.stack([np.stack([vx[r, c], vy[r, c]], axis=-1) for r, c in corners], axis=1)
+    if border_points:
+        # Borders along the rows (between (r, c) and (r, c + 1)) and along the columns (between (r, c) and (r + 1, c))
+        vertices = np.stack([vx, vy], axis=-1)
+        row_borders = _wiggly_borders(vertices[:, :-1], vertices[:, 1:], border_points, rng)
+        col_borders = _wiggly_borders(vertices[:-1], vertices[1:], border_points, rng)
+        coords = np.concatenate([
+            coords[:, :1], row_borders[rows, cols],
+            coords[:, 1:2], col_borders[rows, cols + 1],
+            coords[:, 2:3], row_borders[rows + 1, cols][:, ::-1],
+            coords[:, 3:4], col_borders[rows, cols][:, ::-1],
+        ], axis=1)
+    polygons = shp.polygons(np.concatenate([coords, coords[:, :1]], axis=1))
+
+    # Administrative codes: départements are blocks of about (n_side / 10)² cells, EPCI blocks of 4x4 cells
+    dep_block = n_side // 10 + 1
+    dep_num = (rows // dep_block) * 10 + cols // dep_block
+    dep_code = np.char.zfill(dep_num.astype(str), 2)
+    rank_in_dep = pd.Series(dep_num).groupby(dep_num).cumcount().to_numpy()
+    codgeo = np.char.add(dep_code, np.char.zfill(rank_in_dep.astype(str), 3))
+    epci_num = (rows // 4) * (n_side // 4 + 1) + cols // 4
+    libgeo = np.char.add('Commune ', codgeo).astype(object)
+
+    centroids = shp.centroid(polygons)
+    demo_positions = []
+    for name, (dep, x, y) in DEMO_COMMUNES.items():
+        pos = int(np.argmin(shp.distance(centroids, shp.points(x, y))))
+        libgeo[pos] = name
+        dep_code[pos] = dep
+        demo_positions.append(pos)
+
+    # Rook neighbours plus a couple of diagonals (~6 neighbours per commune on average)
+    neighbours = [[] for _ in range(n)]
+    offsets = [(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (1, 1)]
+    for dr, dc in offsets:
+        r2, c2 = rows + dr, cols + dc
+        ok = (r2 >= 0) & (r2 < n_side) & (c2 >= 0) & (c2 < n_side)
+        for i, j in zip(np.flatnonzero(ok), (r2 * n_side + c2)[ok]):
+            neighbours[i].append(codgeo[j])
+    codgeo_voisins = [np.array(v, dtype=object) if v else None for v in neighbours]
+
+    population = np.round(rng.lognormal(6.5, 1.4, n)).astype(int)
+    population[demo_positions] = rng.integers(200_000, 2_000_000, len(demo_positions))
+    pop_be = np.round(population * rng.uniform(5, 50, n)).astype(int)
+    pop_be[rng.random(n) < 0.01] = 0
+    log_total = np.round(population * rng.uniform(0.4, 0.6, n))
+    log_rp = np.round(log_total * rng.uniform(0.7, 0.95, n))
+    log_soc_total = np.where(rng.random(n) < 0.4, 0, np.round(log_total * rng.uniform(0, 0.3, n)))
+    ecoles_ct = rng.poisson(population / 1500)
+
+    def random_lists(vocabulary, size, p_missing):
+        sizes = rng.integers(0, size + 1, n)
+        return [None if rng.random() < p_missing else list(rng.choice(vocabulary, s, replace=False)) for s in sizes]
+
+    be_codfap_top = random_lists(FAP_CODES, 10, 0.02)
+    codes_formations = random_lists(FORMATION_CODES, 8, 0.6)
+
+    odis = gpd.GeoDataFrame({
+        'codgeo': codgeo,
+        'libgeo': libgeo,
+        'dep_code': dep_code,
+        'epci_code': np.char.add('2', np.char.zfill(epci_num.astype(str), 8)),
+        'epci_nom': np.char.add('CC ', epci_num.astype(str)),
+        'population': population,
+        'pop_be': pop_be,
+        'met': rng.poisson(pop_be / 100).astype(float),
+        'be_codfap_top': be_codfap_top,
+        'be_libfap_top': [None if x is None else [f'Métier {c}' for c in x] for x in be_codfap_top],
+        'codes_formations': codes_formations,
+        'noms_formations': [None if x is None else [f'Formation {c}' for c in x] for x in codes_formations],
+        'rp_5+pieces': np.round(log_rp * rng.uniform(0, 0.4, n)),
+        'log_rp': log_rp,
+        'log_vac': np.round(log_total * rng.uniform(0, 0.15, n)),
+        'log_total': log_total,
+        'log_soc_inoccupes': np.round(log_soc_total * rng.uniform(0, 0.1, n)),
+        'log_soc_total': log_soc_total,
+        'risque_fermeture': rng.binomial(ecoles_ct, 0.2).astype(float),
+        'ecoles_ct': ecoles_ct.astype(float),
+        'svc_incl_count': np.where(pop_be > 0, rng.poisson(population / 800), 0).astype(float),
+        'pol_num': rng.choice([0, 0.25, 0.5, 1], n),
+        'codgeo_voisins': codgeo_voisins,
+        'url_odis': np.char.add('https://odis.example/', codgeo),
+        'url_wikipedia': np.char.add('https://fr.wikipedia.org/wiki/', codgeo),
+        'polygon': polygons,
+    }, geometry='polygon', crs=PROJECTED_CRS).to_crs('EPSG:4326')
+    return odis.set_index('codgeo')
+
+
+def load_scores_cat() -> pd.DataFrame:
+    """Returns the scores definition checked in the repository, read as in load_all_datasets."""
+    return pd.read_csv(cfg.LOCAL_CSV_PATH + cfg.SCORES_CAT_FILE, dtype={'score': str, 'metric': str})
+
+
+def make_inclusion_directory(odis: gpd.GeoDataFrame, seed: int = 0) -> gpd.GeoDataFrame:
+    """Builds an inclusion services directory ('annuaire_inclusion') for the synthetic communes."""
+    rng = np.random.default_rng(seed)
+    counts = rng.poisson(odis.svc_incl_count.to_numpy() / 2)
+    pos = np.repeat(np.arange(len(odis)), counts)
+    svc = rng.integers(0, len(INCLUSION_SERVICES), len(pos))
+    points = shp.point_on_surface(odis.polygon.values[pos])
+    return gpd.GeoDataFrame({
+        'codgeo': odis.index.to_numpy()[pos],
+        'nom': [f'Structure {i}' for i in range(len(pos))],
+        'categorie': [INCLUSION_SERVICES[s][0] for s in svc],
+        'service': [INCLUSION_SERVICES[s][1] for s in svc],
+        'geometry': points,
+    }, geometry='geometry', crs='EPSG:4326')
@@ -0,0 +1,15 @@
+"""
+Checks `scoring.quantile_normalize` against the sklearn QuantileTransformer it replaces (see benchmarks/normalizer.py).
+
+    python -m pytest benchmarks
+"""
+import pytest
+
+from benchmarks.normalizer import equivalence_tolerance, max_difference
+
+pytest.importorskip('sklearn')
+
+
+@pytest.mark.parametrize('n_rows', [2, 50, 1000, 35000])
+def test_quantile_normalize_matches_quantile_transformer(n_rows):
+    assert max_difference(n_rows, n_criteria=10) <= equivalence_tolerance(n_rows)
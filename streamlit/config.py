@@ -9,8 +9,10 @@ LOCAL_CSV_PATH = '../csv/'
 def get_data_path():
     """
     Returns the appropriate data path based on the environment.
-    Checks for the K_SERVICE environment variable to detect Cloud Run.
+    Checks for the K_SERVICE environment variable to detect Cloud Run. ODIS_DATA_PATH overrides the data path.
     """
+    if 'ODIS_DATA_PATH' in os.environ: # Any fsspec location, e.g. a local copy of the bucket
+        return os.environ['ODIS_DATA_PATH']
     if 'K_SERVICE' in os.environ:
         return GCS_BUCKET_PATH
     else:
@@ -26,9 +28,38 @@ MATERNITE_FILE = 'annuaire_maternites_DREES.csv'
 SANTE_FILE = 'annuaire_sante_finess.parquet'
 INCLUSION_FILE = 'odis_services_incl_exploded.parquet'
 SNCF_FILE = 'formes-des-lignes-du-rfn.geojson'
+SNAPSHOT_DIR = 'snapshot/' # Compiled snapshot of all the datasets, see snapshot.py
+
+# --- Data Cache ---
+DATA_CACHE_DIR = os.environ.get('ODIS_DATA_CACHE_DIR', '/tmp/odis_data_cache/') # Local copy of the remote data files, see datastore.py
+DATA_FETCH_TIMEOUT = 60 # Seconds to wait for the remote data files before using their last good local copy
+DATA_CACHE_GRACE_PERIOD = 3600 # Seconds before an unreferenced file of the data cache is deleted, as another process may still load it
+DATA_REFRESH_INTERVAL = float(os.environ.get('ODIS_DATA_REFRESH_INTERVAL', 300)) # Seconds between two checks for changed data files, 0 to never reload them (see datasets.py)
+
+# --- Results ---
+TOP_N_RESULTS = 5 # Number of best results listed and highlighted on the map
+RESULT_CACHE_MAX_BYTES = 128 * 1024**2 # Memory budget of the scoring results cache shared by all sessions
+STAGE_CACHE_MAX_BYTES = 256 * 1024**2 # Memory budget of the intermediate results of the scoring pipeline shared by all sessions
 
 # --- Map Defaults ---
 DEFAULT_MAP_CENTER = [46.603354, 1.888334] # Center of France
+# Levels of simplified commune polygons drawn on the map, by tolerance in degrees (0.001° ~ 100 m). The map uses the
+# coarsest level with details smaller than a pixel at its zoom.
+MAP_SIMPLIFY_TOLERANCES = [0.0005, 0.002, 0.008]
+# Most polygons drawn by the scores layer. With more result communes in view, their scores are shown by area instead:
+# the first level of MAP_AGGREGATION_LEVELS (column of the commune table: label) with few enough areas in view.
+MAP_MAX_FEATURES = 2000
+MAP_AGGREGATION_LEVELS = {'epci_code': 'EPCI', 'dep_code': 'Département'}
+# The scores layer draws the view with this margin (in view widths and heights), so that small moves keep the same layer
+MAP_VIEW_MARGIN = 0.5
+# Approximate size of the map in pixels (width, height), to estimate its bounds before it reports them
+MAP_SIZE_PX = (900, 700)
+# Variants of a map layer (zoom, view) kept by each session for its results, see maps.memoized_layer
+MAP_LAYER_VARIANTS = 4
+# Budget of the map layers shipped to the browser on each rerun, in bytes of serialized JavaScript (see maps.log_map_payload).
+# The scores layer is degraded to coarser polygons and fewer features, up to MAP_DEGRADE_STEPS times, to fit in it.
+MAP_PAYLOAD_BUDGET = int(os.environ.get('ODIS_MAP_PAYLOAD_BUDGET', 3 * 1024**2))
+MAP_DEGRADE_STEPS = 3
 
 # --- Scoring Configuration ---
 @dataclass
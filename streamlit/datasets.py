@@ -0,0 +1,320 @@
+"""
+Registry of the datasets of the app, and its reloading when the data files change.
+
+The commune table ('odis') is stored without its polygons: 'odis_polygons' holds them, aligned on its rows, either
+decoded or memory-mapped in a GeometryBuffer (see snapshot.py), and scoring.with_polygons adds them to selected rows.
+'odis_map_polygons' holds their simplified levels drawn on the map, by tolerance, 'odis_bounds' their bounding boxes,
+and 'map_areas' the polygons of the EPCI and départements the map shows the scores by at low zoom.
+
+The core datasets, needed to fill in a profile, run a search and show the details of a result, are loaded
+synchronously at startup. The secondary directories (schools, health facilities, inclusion services) are only needed by
+the map overlays, as the points of each commune ('*_points' PointIndexes): they are loaded on background threads, and
+reading them only blocks if they are not loaded yet.
+The details of a result read the per-commune indexes (ListColumns, 'inclusion_by_commune'), never the directories.
+
+Datasets are loaded by steps, each declaring the source files it is built from. A DatasetManager checks the source
+files in the background (their remote version, or their checksums in the manifest of the snapshot) and, when some
+changed, loads a new version of the registry: only the steps built from changed files run again, the other datasets
+are shared with the previous version. The new version replaces the current one once it is fully loaded, while the
+sessions using the previous one keep it as long as they need it (see main.py).
+"""
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import config as cfg
+import scoring
+import snapshot
+from datastore import DataStore, open_store
+from indexes import build_commune_index, build_services_index, build_services_rows
+from memory import memory_report, nbytes
+
+# Datasets loaded on background threads
+LAZY_DATASETS = ['ecoles_points', 'sante_points', 'inclusion_points']
+
+
+class DatasetRegistry:
+    """
+    Datasets of the app, by name. `registry[name]` returns a dataset, waiting for it if it is still loading in the
+    background. App-wide objects (caches, lookup tables) can be added with `registry[name] = value`.
+
+    A registry is one version of the datasets: `fingerprints` identify the source files it was loaded from, and
+    `snapshot` is the checksum of the snapshot it was read from (None when loaded from the source files).
+    """
+
+    def __init__(self, max_workers: int = len(LAZY_DATASETS), version: int = 1):
+        self.version = version
+        self.fingerprints: Dict[str, str] = {}
+        self.snapshot: Optional[str] = None
+        self._datasets: Dict[str, Future] = {}
+        self._timings: Dict[str, float] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='datasets')
+
+    def timed(self, name: str, loader: Callable[[], Any]) -> Any:
+        """Runs `loader` and records its run time under `name`."""
+        start = time.perf_counter()
+        value = loader()
+        self._timings[name] = time.perf_counter() - start
+        size = nbytes(value)
+        print(f"--- Loaded {name} in {self._timings[name]:.2f} s" + ("" if size is None else f" ({size / 1024**2:.1f} MiB)") + " ---")
+        return value
+
+    def load(self, name: str, loader: Callable[[], Any]) -> Any:
+        """Loads a dataset now and returns it."""
+        self[name] = self.timed(name, loader)
+        return self[name]
+
+    def prefetch(self, name: str, loader: Callable[[], Any]):
+        """Starts loading a dataset on a background thread."""
+        self._datasets[name] = self._executor.submit(self.timed, name, loader)
+
+    def close(self):
+        """Ends the background loads: the datasets prefetched so far still load, then the worker threads exit."""
+        self._executor.shutdown(wait=False)
+
+    def share(self, other: 'DatasetRegistry', names: List[str]):
+        """Adds datasets of another registry as they are, loaded or still loading."""
+        for name in names:
+            self._datasets[name] = other._datasets[name]
+
+    def is_ready(self, name: str) -> bool:
+        """Whether a dataset is loaded, i.e. reading it does not block."""
+        return self._datasets[name].done()
+
+    def wait(self):
+        """Waits for all the datasets to be loaded. Raises the exception of a failed background load."""
+        for future in self._datasets.values():
+            future.result()
+
+    def timings(self) -> Dict[str, float]:
+        """Returns the load time of each dataset loaded so far, in seconds."""
+        return dict(self._timings)
+
+    def memory_report(self, wait: bool = False) -> pd.DataFrame:
+        """Returns the memory of the datasets loaded so far (of all of them with `wait`), see memory.memory_report."""
+        return memory_report({name: self[name] for name in self._datasets if wait or self.is_ready(name)})
+
+    def __setitem__(self, name: str, value: Any):
+        future = Future()
+        future.set_result(value)
+        self._datasets[name] = future
+
+    def __getitem__(self, name: str) -> Any:
+        # Raises the exception of a failed background load
+        return self._datasets[name].result()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._datasets
+
+
+# --- Load steps ---
+
+@dataclass
+class Step:
+    """
+    Datasets built together. `build(registry)` returns the dataset (a tuple of one value per dataset when there are
+    several), and may read the datasets of the previous steps in the registry: their source files must then be listed
+    in `sources` too, so that the step runs again when they change.
+    """
+    datasets: List[str]
+    sources: List[str]
+    build: Callable[[DatasetRegistry], Any]
+    lazy: bool = False  # Built on a background thread. Lazy steps build a single dataset.
+
+
+def _snapshot_steps(paths: Dict[str, str], manifest: dict) -> List[Step]:
+    """Steps memory-mapping the datasets of a compiled snapshot (see snapshot.py), from the local `paths` of its files."""
+    tables = {name: paths[cfg.SNAPSHOT_DIR + snapshot.table_file(name, manifest)] for name in snapshot.TABLES}
+    arrays = snapshot.read_arrays({name: paths[cfg.SNAPSHOT_DIR + snapshot.array_file(name, manifest)] for name in manifest['arrays']})
+
+    def table_step(name: str, lazy: bool = False) -> Step:
+        return Step([name], snapshot.TABLE_SOURCES[name], lambda registry: snapshot.read_table(tables[name], manifest, name), lazy=lazy)
+
+    def points_step(name: str) -> Step:
+        return Step([name], snapshot.TABLE_SOURCES[name], lambda registry: snapshot.read_point_index(
+            arrays, snapshot.read_table(tables[name], manifest, name), manifest, name), lazy=True)
+
+    return [points_step(name) for name in LAZY_DATASETS] + [
+        table_step(name) for name in ['odis', 'scores_cat', 'codfap_index', 'codformations_index', 'inclusion_services']
+    ] + [
+        Step(['incl_index', 'commune_index', 'odis_lists', 'odis_polygons'], [cfg.ODIS_FILE, cfg.INCLUSION_FILE],
+             lambda registry: snapshot.read_indexes(arrays, registry['odis'])),
+        Step(['odis_map_polygons'], [cfg.ODIS_FILE], lambda registry: snapshot.read_map_polygons(arrays, manifest)),
+        Step(['odis_bounds'], [cfg.ODIS_FILE], lambda registry: arrays['odis_bounds']),
+        Step(['map_areas'], [cfg.ODIS_FILE], lambda registry: snapshot.read_map_areas(arrays, manifest)),
+        Step(['inclusion_by_commune'], snapshot.TABLE_SOURCES['inclusion_by_commune'], lambda registry: snapshot.read_row_ranges(
+            arrays, snapshot.read_table(tables['inclusion_by_commune'], manifest, 'inclusion_by_commune'), 'inclusion_by_commune')),
+    ]
+
+
+def _source_steps(paths: Dict[str, str]) -> List[Step]:
+    """Steps loading and preprocessing the datasets from the local `paths` of the source files."""
+    def load_odis(registry: DatasetRegistry) -> tuple:
+        odis, odis_lists = scoring.load_odis(paths[cfg.ODIS_FILE])
+        commune_index = build_commune_index(odis, odis_lists, scoring.PROJECTED_CRS)
+        # The table is stored without its polygons, as in a snapshot
+        return pd.DataFrame(odis.drop(columns='polygon')), odis_lists, np.asarray(odis.polygon.values), commune_index, odis.polygon.bounds.to_numpy()
+
+    def load_services(registry: DatasetRegistry) -> tuple:
+        # The scoring only needs the services of each commune, not the full directory with names and geometries
+        services = scoring.load_inclusion_services(paths[cfg.INCLUSION_FILE])
+        codgeo = registry['odis'].index
+        return build_services_index(services, codgeo), scoring.inclusion_catalog(services), build_services_rows(services, codgeo)
+
+    return [
+        Step(['ecoles_points'], [cfg.ECOLES_FILE], lambda registry: scoring.ecoles_points(scoring.load_annuaire_ecoles(paths[cfg.ECOLES_FILE])), lazy=True),
+        Step(['sante_points'], [cfg.SANTE_FILE, cfg.MATERNITE_FILE], lambda registry: scoring.sante_points(
+            scoring.load_annuaire_sante(paths[cfg.SANTE_FILE], paths[cfg.MATERNITE_FILE])), lazy=True),
+        Step(['inclusion_points'], [cfg.INCLUSION_FILE],
+             lambda registry: scoring.inclusion_points(scoring.load_annuaire_inclusion(paths[cfg.INCLUSION_FILE])), lazy=True),
+        Step(['odis', 'odis_lists', 'odis_polygons', 'commune_index', 'odis_bounds'], [cfg.ODIS_FILE], load_odis),
+        # Only needed by the map, and slow to build without a snapshot
+        Step(['odis_map_polygons'], [cfg.ODIS_FILE],
+             lambda registry: scoring.simplify_polygons(registry['odis_polygons'], cfg.MAP_SIMPLIFY_TOLERANCES), lazy=True),
+        Step(['map_areas'], [cfg.ODIS_FILE], lambda registry: scoring.build_map_areas(registry['odis'], registry['odis_map_polygons']), lazy=True),
+        Step(['scores_cat'], [cfg.SCORES_CAT_FILE], lambda registry: scoring.load_scores_cat(paths[cfg.SCORES_CAT_FILE])),
+        Step(['codfap_index'], [cfg.METIERS_FILE], lambda registry: scoring.load_codfap_index(paths[cfg.METIERS_FILE])),
+        Step(['codformations_index'], [cfg.FORMATIONS_FILE], lambda registry: scoring.load_codformations_index(paths[cfg.FORMATIONS_FILE])),
+        Step(['incl_index', 'inclusion_services', 'inclusion_by_commune'], [cfg.INCLUSION_FILE, cfg.ODIS_FILE], load_services),
+    ]
+
+
+def _app_steps() -> List[Step]:
+    """Steps building the app-wide objects derived from the datasets."""
+    return [
+        # Intermediate and final scoring results, shared by all sessions, valid as long as the scoring inputs are unchanged
+        Step(['stage_cache', 'result_cache'], [cfg.ODIS_FILE, cfg.SCORES_CAT_FILE, cfg.INCLUSION_FILE],
+             lambda registry: (scoring.StageCache(max_bytes=cfg.STAGE_CACHE_MAX_BYTES), scoring.ResultCache(max_bytes=cfg.RESULT_CACHE_MAX_BYTES))),
+        Step(['coddep_set', 'depcom_df'], [cfg.ODIS_FILE],
+             lambda registry: (sorted(set(registry['odis']['dep_code'])), registry['odis'][['dep_code', 'libgeo']].sort_values('libgeo'))),
+    ]
+
+
+def _run_steps(registry: DatasetRegistry, steps: List[Step], previous: Optional[DatasetRegistry] = None, changed: frozenset = frozenset()):
+    """Runs the steps into `registry`. With a `previous` registry, the steps not built from `changed` files share its datasets."""
+    for step in steps:
+        if previous is not None and not changed.intersection(step.sources):
+            registry.share(previous, step.datasets)
+        elif step.lazy:
+            registry.prefetch(step.datasets[0], partial(step.build, registry))
+        else:
+            values = registry.timed(', '.join(step.datasets), partial(step.build, registry))
+            for name, value in zip(step.datasets, values if len(step.datasets) > 1 else [values]):
+                registry[name] = value
+
+
+# --- Versions ---
+
+def read_fingerprints(store: DataStore) -> Tuple[Optional[dict], Dict[str, str], Optional[Exception]]:
+    """
+    Identifies the current version of the source files.
+
+    Returns:
+        The manifest of the usable snapshot (None without one), the fingerprint of each source file (its checksum in
+        the manifest of the snapshot, its remote version without a snapshot), and why there is no usable snapshot.
+    """
+    try:
+        manifest = snapshot.read_manifest(store.fetch(cfg.SNAPSHOT_DIR + snapshot.MANIFEST_FILE))
+    except (FileNotFoundError, ValueError) as e:
+        return None, store.versions(snapshot.SOURCE_FILES), e
+    return manifest, manifest['sources'], None
+
+
+def load_version(store: DataStore, previous: Optional[DatasetRegistry] = None) -> Optional[DatasetRegistry]:
+    """
+    Loads a version of the datasets, from the compiled snapshot when there is a usable one, from the source files
+    otherwise. Remote files are read through the local disk cache of the DataStore.
+
+    Args:
+        previous: The version in use. Only the datasets built from source files changed since are loaded again.
+
+    Returns:
+        The registry, with the core datasets loaded and the lazy ones loading in the background. None when no source
+        file changed since the `previous` version.
+    """
+    manifest, fingerprints, error = read_fingerprints(store)
+    checksum = None if manifest is None else manifest['checksum']
+    changed = frozenset(snapshot.SOURCE_FILES)
+    if previous is not None:
+        if (previous.snapshot is None) == (checksum is None):  # Otherwise a snapshot appeared or disappeared: all files changed
+            changed = frozenset(file for file in snapshot.SOURCE_FILES if fingerprints[file] != previous.fingerprints.get(file))
+        if not changed:
+            return None
+        print(f"--- Loading dataset version {previous.version + 1}, changed: {', '.join(sorted(changed))} ---")
+
+    registry = DatasetRegistry(version=1 if previous is None else previous.version + 1)
+    registry.fingerprints = fingerprints
+    registry.snapshot = checksum
+    if manifest is None:
+        print(f"--- No usable snapshot in {store.remote_path + cfg.SNAPSHOT_DIR} ({error}), loading the source files ---")
+        steps = _source_steps(store.fetch_all(snapshot.SOURCE_FILES))
+    else:
+        print(f"--- Loading snapshot {checksum[:12]} compiled at {manifest['compiled_at']} ---")
+        files = [cfg.SNAPSHOT_DIR + snapshot.table_file(name, manifest) for name in snapshot.TABLES] \
+                + [cfg.SNAPSHOT_DIR + snapshot.array_file(name, manifest) for name in manifest['arrays']]
+        steps = _snapshot_steps(store.fetch_all(files), manifest)
+    try:
+        _run_steps(registry, steps + _app_steps(), previous, changed)
+    finally:
+        registry.close()  # All the lazy datasets are prefetched
+    return registry
+
+
+def open_datasets() -> DatasetRegistry:
+    """
+    Opens the datasets of the app once, without reloading them (see DatasetManager).
+
+    Returns:
+        The registry, with the core datasets loaded and the LAZY_DATASETS loading in the background.
+    """
+    return load_version(open_store())
+
+
+class DatasetManager:
+    """
+    Current version of the datasets, reloaded in the background when the source files change.
+
+    Args:
+        store: DataStore of the data files (default: open_store()).
+        refresh_interval: Seconds between two checks of the source files. 0 never reloads the datasets.
+    """
+
+    def __init__(self, store: Optional[DataStore] = None, refresh_interval: float = cfg.DATA_REFRESH_INTERVAL):
+        self.store = store or open_store()
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._current = load_version(self.store)
+        if refresh_interval > 0:
+            threading.Thread(target=self._watch, name='datasets-refresh', daemon=True).start()
+
+    def current(self) -> DatasetRegistry:
+        """Returns the latest version of the datasets."""
+        return self._current
+
+    def refresh(self) -> bool:
+        """
+        Loads a new version of the datasets if source files changed, and makes it the current one once all its
+        datasets are loaded. Returns whether there is a new version.
+        """
+        with self._lock:
+            registry = load_version(self.store, previous=self._current)
+            if registry is None:
+                return False
+            registry.wait()
+            self._current = registry  # Atomic: readers get the previous version or the new one, never a mix
+        print(f"--- Dataset version {registry.version} in use ---")
+        return True
+
+    def _watch(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:  # The current version stays in use, the next check tries again
+                print(f"--- Could not reload the datasets ({e!r}) ---")
@@ -0,0 +1,208 @@
+"""
+Read-through local disk cache of the data files.
+
+On Cloud Run the data files are read from the GCS bucket, and every new instance would download all of them again.
+A DataStore downloads each file once into a content-addressed local cache (`objects/<sha256>`). The version of each
+remote file (GCS generation, etag or md5, size and mtime for local files) is recorded next to it, in `refs.json`:
+a file is downloaded again only if its remote version changed. Files are fetched in parallel, and when the remote
+is missing, failing or too slow, the last good local copy is used. Several server processes can share the same cache:
+the updates of `refs.json` and the pruning of the objects are serialized by a lock file. The previous copy of each
+file is kept, as another process may still be loading it, and the other objects are only deleted once they have
+not been written for cfg.DATA_CACHE_GRACE_PERIOD seconds.
+
+Any fsspec location can stand in for the bucket, e.g. a local directory:
+
+    ODIS_DATA_PATH=/tmp/bucket/ streamlit run main.py
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import fsspec
+
+try:
+    import fcntl
+except ImportError:  # Windows: the lock only serializes the threads of the process
+    fcntl = None
+
+import config as cfg
+
+REFS_FILE = 'refs.json'
+LOCK_FILE = 'cache.lock'
+OBJECTS_DIR = 'objects'
+# Fields of the remote file info identifying its version, by order of preference
+VERSION_FIELDS = [['generation'], ['etag'], ['md5Hash'], ['size', 'mtime'], ['size', 'created']]
+
+
+def remote_version(info: dict) -> str:
+    """Returns a string identifying the version of a remote file, from its fsspec info."""
+    for fields in VERSION_FIELDS:
+        if all(info.get(field) is not None for field in fields):
+            return ':'.join(f'{field}={info[field]}' for field in fields)
+    raise ValueError(f"No version information for {info.get('name')}")
+
+
+class DataStore:
+    """
+    Data files of a remote location, read through a local disk cache.
+
+    Args:
+        remote_path: fsspec location of the files (e.g. 'gs://bucket/' or a local directory), ending with '/'.
+        cache_dir: Local cache directory. Without it, the remote files are read directly.
+        timeout: Seconds to wait for a remote file before falling back to its last good local copy.
+    """
+
+    def __init__(self, remote_path: str, cache_dir: Optional[str] = None, timeout: float = cfg.DATA_FETCH_TIMEOUT):
+        self.remote_path = remote_path
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(os.path.join(cache_dir, OBJECTS_DIR), exist_ok=True)
+
+    # --- Cache references ---
+
+    def _read_refs(self) -> Dict[str, dict]:
+        try:
+            with open(os.path.join(self.cache_dir, REFS_FILE)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    @contextmanager
+    def _locked(self):
+        """Locks the cache against the other threads and the other processes using it, to update the refs or the objects."""
+        with self._lock, open(os.path.join(self.cache_dir, LOCK_FILE), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)  # Released when the file is closed
+            yield
+
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, OBJECTS_DIR, digest)
+
+    def _tmp_path(self, name: str) -> str:
+        """Path of a temporary file, unique to the current thread."""
+        return os.path.join(self.cache_dir, f'{name}.{os.getpid()}.{threading.get_ident()}.tmp')
+
+    def _commit(self, file: str, version: str, digest: str, tmp: str):
+        """Moves a downloaded file to the cache and records it as the local copy of `file`."""
+        with self._locked():
+            os.replace(tmp, self._object_path(digest))
+            refs = self._read_refs()
+            previous = refs.get(file, {})
+            # The replaced copy stays referenced until the next change of the file: it may still be in use
+            kept = previous.get('sha256') if previous.get('sha256') != digest else previous.get('previous')
+            refs[file] = {'version': version, 'sha256': digest, 'previous': kept}
+            refs_tmp = self._tmp_path(REFS_FILE)
+            with open(refs_tmp, 'w') as f:
+                json.dump(refs, f, indent=2)
+            os.replace(refs_tmp, os.path.join(self.cache_dir, REFS_FILE))  # Atomic: readers see the old or the new refs
+
+    def prune(self, grace_period: float = cfg.DATA_CACHE_GRACE_PERIOD):
+        """
+        Deletes the objects that are neither the current nor the previous local copy of any file, and the temporary files
+        left by interrupted downloads, once they have not been written for `grace_period` seconds.
+        """
+        with self._locked():
+            referenced = {ref.get(key) for ref in self._read_refs().values() for key in ('sha256', 'previous')}
+            expired = time.time() - grace_period
+            stale = [self._object_path(name) for name in os.listdir(os.path.join(self.cache_dir, OBJECTS_DIR)) if name not in referenced]
+            stale += [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.tmp')]
+            for path in stale:
+                try:
+                    if os.path.getmtime(path) < expired:
+                        os.remove(path)
+                except FileNotFoundError:  # Committed or removed by another process meanwhile
+                    pass
+
+    def last_good(self, file: str) -> Optional[str]:
+        """Returns the path of the last good local copy of a file, if any."""
+        ref = self._read_refs().get(file)
+        if ref is not None and os.path.exists(self._object_path(ref['sha256'])):
+            return self._object_path(ref['sha256'])
+        return None
+
+    # --- Fetch ---
+
+    def version(self, file: str) -> str:
+        """Returns the current version of a remote file (see remote_version), without downloading it."""
+        fs, path = fsspec.core.url_to_fs(self.remote_path + file)
+        return remote_version(fs.info(path))
+
+    def versions(self, files: List[str]) -> Dict[str, str]:
+        """Returns the current version of each of the remote `files`."""
+        return {file: self.version(file) for file in files}
+
+    def _download(self, file: str) -> str:
+        """Returns the path of the local copy of a file, downloading it if its remote version changed."""
+        fs, path = fsspec.core.url_to_fs(self.remote_path + file)
+        version = remote_version(fs.info(path))
+        ref = self._read_refs().get(file)
+        if ref is not None and ref['version'] == version and os.path.exists(self._object_path(ref['sha256'])):
+            return self._object_path(ref['sha256'])
+
+        digest = hashlib.sha256()
+        tmp = self._tmp_path(hashlib.sha256(file.encode()).hexdigest())
+        with fs.open(path, 'rb') as src, open(tmp, 'wb') as dst:
+            for chunk in iter(lambda: src.read(2**20), b''):
+                digest.update(chunk)
+                dst.write(chunk)
+        self._commit(file, version, digest.hexdigest(), tmp)
+        print(f"--- Downloaded {file} ({version}) ---")
+        return self._object_path(digest.hexdigest())
+
+    def fetch_all(self, files: List[str]) -> Dict[str, str]:
+        """
+        Fetches files in parallel.
+
+        Args:
+            files: Paths of the files, relative to the remote path.
+
+        Returns:
+            The local path of each file (its remote path when there is no cache).
+
+        Raises:
+            The error of the remote when a file cannot be fetched and has no local copy.
+        """
+        if self.cache_dir is None:
+            return {file: self.remote_path + file for file in files}
+
+        # Objects replaced by previous fetches are deleted now, as they may have been in use as fallbacks until then
+        self.prune()
+        executor = ThreadPoolExecutor(max_workers=len(files) or 1, thread_name_prefix='datastore')
+        try:
+            futures = {file: executor.submit(self._download, file) for file in files}
+            wait(futures.values(), timeout=self.timeout)
+            paths = {}
+            for file, future in futures.items():
+                fallback = self.last_good(file)
+                if future.done() and future.exception() is None:
+                    paths[file] = future.result()
+                elif fallback is not None:
+                    error = future.exception() if future.done() else f'no answer after {self.timeout} s'
+                    print(f"--- Could not fetch {file} ({error}), using the last good local copy ---")
+                    paths[file] = fallback
+                else:
+                    paths[file] = future.result()  # Nothing to fall back to: wait for the download, or raise its error
+        finally:
+            # Downloads still running keep updating the cache, for the next start
+            executor.shutdown(wait=False)
+        return paths
+
+    def fetch(self, file: str) -> str:
+        """Fetches a single file, see fetch_all."""
+        return self.fetch_all([file])[file]
+
+
+def open_store(data_path: Optional[str] = None) -> DataStore:
+    """
+    Returns the DataStore of the app data, at `data_path` (default: cfg.get_data_path()).
+    Files outside of the local data directory are cached in cfg.DATA_CACHE_DIR.
+    """
+    data_path = data_path or cfg.get_data_path()
+    return DataStore(data_path, cache_dir=None if data_path == cfg.LOCAL_CSV_PATH else cfg.DATA_CACHE_DIR)
@@ -0,0 +1,527 @@
+from dataclasses import dataclass
+from typing import List, Dict, Tuple
+
+import pandas as pd
+import numpy as np
+import geopandas as gpd
+import shapely as shp
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+# --- Static Metrics ---
+# Metrics that only depend on the commune itself, never on the user's ScoringConfig.
+# name: (numerator column, denominator column, factor)
+STATIC_RATIOS: Dict[str, Tuple[str, str, float]] = {
+    'met_ratio': ('met', 'pop_be', 1000),
+    'log_5p_ratio': ('rp_5+pieces', 'log_rp', 1),
+    'log_soc_inoc_ratio': ('log_soc_inoccupes', 'log_soc_total', 1),
+    'log_vac_ratio': ('log_vac', 'log_total', 1),
+    'risque_fermeture_ratio': ('risque_fermeture', 'ecoles_ct', 1),
+    'svc_incl_ratio': ('svc_incl_count', 'pop_be', 1000),
+}
+STATIC_VALUES: List[str] = ['pol_num']
+
+
+def _as_float(series: pd.Series) -> np.ndarray:
+    return series.astype('float64').to_numpy()
+
+
+def _flatten_lists(series: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """Flattens a column of lists (or None) into its values and the row of each value."""
+    lists = [x if isinstance(x, (list, np.ndarray)) else [] for x in series]
+    lengths = np.fromiter((len(x) for x in lists), dtype='int64', count=len(lists))
+    values = np.concatenate([np.asarray(x, dtype=object) for x in lists]) if lengths.sum() else np.array([], dtype=object)
+    return values, np.repeat(np.arange(len(lists)), lengths)
+
+
+@dataclass
+class InvertedIndex:
+    """
+    Inverted index from keys (e.g. FAP codes) to the communes where they appear.
+    Postings are stored as a sparse (n_keys, n_communes) CSR matrix: row i lists the positions of the communes having key i.
+    """
+    keys: pd.Index
+    postings: sparse.csr_matrix
+
+    def count_matches(self, keys) -> np.ndarray:
+        """Returns, for every commune, the number of distinct `keys` it has. Only the postings of these keys are read."""
+        rows = self.keys.get_indexer(pd.unique(pd.Series(list(keys), dtype=object)))
+        rows = rows[rows >= 0]
+        matches = self.postings[rows].indices
+        return np.bincount(matches, minlength=self.postings.shape[1])
+
+    def to_arrays(self, prefix: str) -> Dict[str, np.ndarray]:
+        """Returns the arrays of the index, with names starting with `prefix`, e.g. to save them with np.savez."""
+        return {
+            f'{prefix}_keys': np.asarray(self.keys, dtype=str),
+            f'{prefix}_indptr': self.postings.indptr,
+            f'{prefix}_indices': self.postings.indices,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix: str, n_communes: int) -> 'InvertedIndex':
+        """Rebuilds an index saved with `to_arrays`."""
+        indices = arrays[f'{prefix}_indices']
+        postings = sparse.csr_matrix((np.ones(len(indices), dtype=bool), indices, arrays[f'{prefix}_indptr']),
+                                     shape=(len(arrays[f'{prefix}_keys']), n_communes))
+        return cls(keys=pd.Index(arrays[f'{prefix}_keys'].astype(object)), postings=postings)
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.memory_usage(deep=True) + self.postings.indptr.nbytes + self.postings.indices.nbytes + self.postings.data.nbytes
+
+
+@dataclass
+class ListColumn:
+    """
+    Column of lists (e.g. the neighbors of each commune) flattened into offsets and values, instead of one Python
+    list per row: the list of row i is values[offsets[i]:offsets[i + 1]]. Values are stored as integer codes into
+    their sorted distinct values (`categories`). Missing lists are empty.
+    """
+    offsets: np.ndarray  # int32, length n_rows + 1
+    codes: np.ndarray  # Smallest integer dtype for the number of categories
+    categories: pd.Index
+
+    @classmethod
+    def from_series(cls, series: pd.Series) -> 'ListColumn':
+        """Builds a ListColumn from a column of lists (or None)."""
+        values, rows = _flatten_lists(series)
+        offsets = np.zeros(len(series) + 1, dtype='int64')
+        np.cumsum(np.bincount(rows, minlength=len(series)), out=offsets[1:])
+        codes, categories = pd.factorize(values, sort=True)
+        return cls(offsets=offsets.astype('int32'), codes=codes.astype(_code_dtype(len(categories))), categories=pd.Index(categories))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position: int) -> list:
+        """Returns the list of a row, by position."""
+        return self.categories[self.codes[self.offsets[position]:self.offsets[position + 1]]].tolist()
+
+    def flatten(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns all the values and the row of each value, as `_flatten_lists`."""
+        return self.categories.to_numpy(dtype=object)[self.codes], np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    @property
+    def nbytes(self) -> int:
+        return self.offsets.nbytes + self.codes.nbytes + self.categories.memory_usage(deep=True)
+
+    def to_arrays(self, prefix: str) -> Dict[str, np.ndarray]:
+        """Returns the arrays of the column, with names starting with `prefix`, e.g. to save them with np.savez."""
+        return {
+            f'{prefix}_offsets': self.offsets,
+            f'{prefix}_codes': self.codes,
+            f'{prefix}_categories': np.asarray(self.categories, dtype=str),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix: str) -> 'ListColumn':
+        """Rebuilds a column saved with `to_arrays`."""
+        return cls(offsets=arrays[f'{prefix}_offsets'], codes=arrays[f'{prefix}_codes'],
+                   categories=pd.Index(arrays[f'{prefix}_categories'].astype(object)))
+
+
+@dataclass
+class RowRanges:
+    """
+    Rows of a table grouped by commune, like a ListColumn: the rows of the commune at position i are
+    rows[offsets[i]:offsets[i + 1]], read without scanning the table.
+    """
+    rows: pd.DataFrame
+    offsets: np.ndarray  # int32, length n_communes + 1
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, positions: np.ndarray, n_communes: int) -> 'RowRanges':
+        """Groups the rows of `df` by the commune `positions` of its rows, keeping their order. Rows of unknown communes (-1) are dropped."""
+        known = positions >= 0
+        order = np.argsort(positions[known], kind='stable')
+        offsets = np.zeros(n_communes + 1, dtype='int64')
+        np.cumsum(np.bincount(positions[known], minlength=n_communes), out=offsets[1:])
+        return cls(rows=df[known].iloc[order].reset_index(drop=True), offsets=offsets.astype('int32'))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position: int) -> pd.DataFrame:
+        """Returns the rows of a commune, by position."""
+        return self.rows.iloc[self.offsets[position]:self.offsets[position + 1]]
+
+    def row_numbers(self, positions: np.ndarray) -> np.ndarray:
+        """Returns the numbers of the rows of several communes, by position, without a loop over the communes."""
+        starts = self.offsets[positions].astype('int64')
+        lengths = self.offsets[positions + 1] - starts
+        ends = np.cumsum(lengths)
+        return np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - (ends - lengths), lengths)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.rows.memory_usage(deep=True).sum()) + self.offsets.nbytes
+
+    def to_arrays(self, prefix: str) -> Dict[str, np.ndarray]:
+        """Returns the offsets, with names starting with `prefix`. The rows are saved as a table."""
+        return {f'{prefix}_offsets': self.offsets}
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix: str, rows: pd.DataFrame) -> 'RowRanges':
+        """Rebuilds a RowRanges saved with `to_arrays`, from its rows."""
+        return cls(rows=rows, offsets=arrays[f'{prefix}_offsets'])
+
+
+@dataclass
+class PointIndex:
+    """
+    Points of a directory (schools, health facilities, inclusion services) grouped by commune, for the map overlays.
+    The rows hold the 'lat' and 'lon' of the points, their tooltip fields and their 'flags': bit i is set when the point
+    matches the filter flag_names[i] (e.g. a school level), so that filtering compares no strings.
+    """
+    codgeo: pd.Index  # Communes with points, by position in `points`
+    points: RowRanges
+    flag_names: List[str]
+
+    def select(self, codgeos, flag_names: List[str]) -> pd.DataFrame:
+        """Returns the points of the communes `codgeos` matching any of the `flag_names` filters. Unknown names are ignored."""
+        positions = self.codgeo.get_indexer(codgeos)
+        rows = self.points.row_numbers(positions[positions >= 0])
+        flags = self.points.rows['flags'].to_numpy()
+        mask = flags.dtype.type(sum(1 << i for i, name in enumerate(self.flag_names) if name in flag_names))
+        return self.points.rows.iloc[rows[(flags[rows] & mask) != 0]]
+
+    @property
+    def nbytes(self) -> int:
+        return self.points.nbytes + int(self.codgeo.memory_usage(deep=True))
+
+    def to_arrays(self, prefix: str) -> Dict[str, np.ndarray]:
+        """Returns the communes and the offsets of the points, with names starting with `prefix`. The points are saved as a table."""
+        return {f'{prefix}_codgeo': self.codgeo.to_numpy(dtype=str), **self.points.to_arrays(prefix)}
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix: str, rows: pd.DataFrame, flag_names: List[str]) -> 'PointIndex':
+        """Rebuilds a PointIndex saved with `to_arrays`, from its points."""
+        return cls(codgeo=pd.Index(arrays[f'{prefix}_codgeo'].astype(object)), points=RowRanges.from_arrays(arrays, prefix, rows),
+                   flag_names=flag_names)
+
+
+def _code_dtype(n_categories: int) -> str:
+    """Smallest signed integer dtype holding the codes of `n_categories` categories."""
+    return next(dtype for dtype in ['int8', 'int16', 'int32', 'int64'] if n_categories <= np.iinfo(dtype).max)
+
+
+def split_list_columns(df: pd.DataFrame, columns: List[str]) -> Tuple[pd.DataFrame, Dict[str, ListColumn]]:
+    """Removes the list `columns` from `df` and returns them as ListColumns, aligned on the rows of `df`."""
+    columns = [col for col in columns if col in df.columns]
+    return df.drop(columns=columns), {col: ListColumn.from_series(df[col]) for col in columns}
+
+
+def geometry_nbytes(geometries) -> int:
+    """Approximate memory of shapely geometries: their coordinates (2 float64 each) and one pointer per geometry."""
+    geometries = np.asarray(geometries)
+    return int(shp.get_num_coordinates(geometries).sum()) * 16 + geometries.nbytes
+
+
+def pack_wkb(geometries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Encodes geometries to WKB, concatenated in a single byte buffer with the offsets of each geometry."""
+    wkb = shp.to_wkb(geometries)
+    offsets = np.zeros(len(wkb) + 1, dtype='int64')
+    np.cumsum([len(x) for x in wkb], out=offsets[1:])
+    return np.frombuffer(b''.join(wkb), dtype='uint8'), offsets
+
+
+def unpack_wkb(buffer: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Decodes the geometries encoded by `pack_wkb`."""
+    data = buffer.tobytes()
+    return shp.from_wkb(np.array([data[start:end] for start, end in zip(offsets[:-1], offsets[1:])], dtype=object))
+
+
+@dataclass
+class GeometryBuffer:
+    """
+    Geometries encoded in WKB, concatenated in a single byte buffer with the offsets of each geometry (see pack_wkb).
+    Indexing decodes the selected geometries only, so the buffers can stay memory-mapped and shared by several processes.
+    """
+    buffer: np.ndarray  # uint8
+    offsets: np.ndarray  # int64, length n + 1
+
+    @classmethod
+    def from_geometries(cls, geometries) -> 'GeometryBuffer':
+        return cls(*pack_wkb(np.asarray(geometries)))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, positions):
+        """Decodes the geometry at a position, or the array of geometries at an array of positions."""
+        data = memoryview(self.buffer)  # Slicing a memoryview is much faster than slicing the array, and copies nothing
+        if np.ndim(positions) == 0:
+            return shp.from_wkb(data[self.offsets[positions]:self.offsets[positions + 1]].tobytes())
+        positions = np.asarray(positions)
+        if positions.dtype == bool:
+            positions = np.flatnonzero(positions)
+        starts, ends = self.offsets[positions].tolist(), self.offsets[positions + 1].tolist()
+        return shp.from_wkb(np.array([data[start:end].tobytes() for start, end in zip(starts, ends)], dtype=object))
+
+    @property
+    def nbytes(self) -> int:
+        return self.buffer.nbytes + self.offsets.nbytes
+
+    def to_arrays(self, prefix: str) -> Dict[str, np.ndarray]:
+        """Returns the arrays of the geometries, with names starting with `prefix`, e.g. to save them with np.save."""
+        return {f'{prefix}_wkb': self.buffer, f'{prefix}_offsets': self.offsets}
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix: str) -> 'GeometryBuffer':
+        """Wraps geometries saved with `to_arrays`, without copying nor decoding them."""
+        return cls(buffer=arrays[f'{prefix}_wkb'], offsets=arrays[f'{prefix}_offsets'])
+
+
+@dataclass
+class AreaPolygons:
+    """
+    Polygons of the communes dissolved by area (e.g. EPCI, département), drawn by the map instead of the communes when
+    there are too many of them in view. Areas are referred to by their position in `codes`.
+    """
+    codes: pd.Index
+    names: np.ndarray  # object
+    commune_area: np.ndarray  # int32, position of the area of each commune of the commune table (-1 without area)
+    bounds: np.ndarray  # float64, shape (n_areas, 4): min lon, min lat, max lon, max lat
+    polygons: Dict[float, object]  # Simplified levels by tolerance, decoded or in GeometryBuffers
+
+    @property
+    def nbytes(self) -> int:
+        polygons = sum(geometry_nbytes(level) if isinstance(level, np.ndarray) else level.nbytes for level in self.polygons.values())
+        return polygons + self.commune_area.nbytes + self.bounds.nbytes + int(self.codes.memory_usage(deep=True))
+
+    def to_arrays(self, prefix: str) -> Dict[str, np.ndarray]:
+        """Returns the arrays of the areas, with names starting with `prefix`. The tolerances of the levels are saved apart."""
+        arrays = {f'{prefix}_codes': self.codes.to_numpy(dtype=str), f'{prefix}_names': self.names.astype(str),
+                  f'{prefix}_commune_area': self.commune_area, f'{prefix}_bounds': self.bounds}
+        for level, polygons in enumerate(self.polygons.values()):
+            arrays.update(GeometryBuffer.from_geometries(polygons).to_arrays(f'{prefix}_polygons_{level}'))
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix: str, tolerances: List[float]) -> 'AreaPolygons':
+        """Rebuilds AreaPolygons saved with `to_arrays`, with the `tolerances` of its levels. The polygons are not decoded."""
+        return cls(codes=pd.Index(arrays[f'{prefix}_codes'].astype(object)), names=arrays[f'{prefix}_names'].astype(object),
+                   commune_area=arrays[f'{prefix}_commune_area'], bounds=arrays[f'{prefix}_bounds'],
+                   polygons={tolerance: GeometryBuffer.from_arrays(arrays, f'{prefix}_polygons_{level}') for level, tolerance in enumerate(tolerances)})
+
+
+def dissolve_polygons(polygons: np.ndarray, groups: np.ndarray, n_groups: int) -> np.ndarray:
+    """
+    Merges the polygons of each group, e.g. the communes of an EPCI. Polygons of group -1 are ignored.
+    The polygons form a coverage (without overlaps) and are merged by their shared edges (shapely >= 2.1).
+
+    Returns:
+        The merged polygon of each group (None for empty groups).
+    """
+    known = groups >= 0
+    order = np.argsort(groups[known], kind='stable')
+    members = np.asarray(polygons)[known][order]
+    offsets = np.zeros(n_groups + 1, dtype='int64')
+    np.cumsum(np.bincount(groups[known], minlength=n_groups), out=offsets[1:])
+    merged = np.empty(n_groups, dtype=object)
+    for group in range(n_groups):
+        if offsets[group + 1] > offsets[group]:
+            merged[group] = shp.coverage_union_all(members[offsets[group]:offsets[group + 1]])
+    return merged
+
+
+def build_inverted_index(keys: np.ndarray, positions: np.ndarray, n_communes: int) -> InvertedIndex:
+    """Builds an InvertedIndex from (key, commune position) pairs. Duplicated pairs are counted once."""
+    codes, uniques = pd.factorize(keys)
+    postings = sparse.csr_matrix((np.ones(len(codes), dtype=bool), (codes, positions)), shape=(len(uniques), n_communes))
+    postings.sum_duplicates()
+    return InvertedIndex(keys=pd.Index(uniques), postings=postings)
+
+
+def build_services_index(annuaire_inclusion: pd.DataFrame, codgeo: pd.Index) -> InvertedIndex:
+    """Inverted index of the inclusion services ('categorie_service' keys) available in each commune of `codgeo`."""
+    positions = codgeo.get_indexer(annuaire_inclusion['codgeo'])
+    known = positions >= 0
+    keys = (annuaire_inclusion['categorie'].astype(str) + '_' + annuaire_inclusion['service'].astype(str)).to_numpy()
+    return build_inverted_index(keys[known], positions[known], len(codgeo))
+
+
+def build_services_rows(annuaire_inclusion: pd.DataFrame, codgeo: pd.Index) -> RowRanges:
+    """Distinct inclusion services ('categorie', 'service') of each commune of `codgeo`, sorted, for the details of a result."""
+    services = annuaire_inclusion[['codgeo', 'categorie', 'service']].drop_duplicates().sort_values(['categorie', 'service'])
+    return RowRanges.from_frame(services[['categorie', 'service']], codgeo.get_indexer(services['codgeo']), len(codgeo))
+
+
+def build_point_index(directory: gpd.GeoDataFrame, codgeo_column: str, fields: List[str], flags: Dict[str, np.ndarray]) -> PointIndex:
+    """
+    Builds the PointIndex of a directory: the coordinates of its points in WGS 84 (EPSG:4326), its tooltip `fields` and
+    its `flags`, boolean masks aligned on its rows by filter name. Points without coordinates are dropped.
+    """
+    flags_dtype = next((dtype for dtype in ['uint8', 'uint16', 'uint32', 'uint64'] if len(flags) <= np.iinfo(dtype).bits), None)
+    if flags_dtype is None:
+        raise ValueError(f"{len(flags)} filters do not fit in the flags of a PointIndex (64 at most)")
+    bits = np.zeros(len(directory), dtype=flags_dtype)
+    for i, mask in enumerate(flags.values()):
+        bits[np.asarray(mask, dtype=bool)] |= np.dtype(flags_dtype).type(1 << i)
+
+    geometry = directory.geometry.to_crs('EPSG:4326')
+    points = pd.DataFrame({'lat': geometry.y.to_numpy(), 'lon': geometry.x.to_numpy()})
+    points[fields] = directory[fields].reset_index(drop=True)
+    points['flags'] = bits
+    keep = np.isfinite(points['lat'].to_numpy()) & np.isfinite(points['lon'].to_numpy())  # Missing and empty geometries have NaN coordinates
+
+    codes = directory[codgeo_column].astype(str).to_numpy()[keep]
+    codgeo = pd.Index(np.unique(codes))
+    return PointIndex(codgeo=codgeo, points=RowRanges.from_frame(points[keep], codgeo.get_indexer(codes), len(codgeo)), flag_names=list(flags))
+
+
+@dataclass
+class CommuneIndex:
+    """
+    Config-independent data computed once at load time and aligned on the row order of the `odis` table.
+    Communes are referred to by their position in `codgeo`.
+    """
+    codgeo: pd.Index
+    feature_names: List[str]
+    features: np.ndarray  # float32, shape (n_features, n_communes): each metric is stored contiguously
+    neighbors: sparse.csr_matrix  # Adjacency matrix of the communes ('codgeo_voisins'), without self loops
+    polygons_projected: np.ndarray  # Polygons in the projected CRS (meters), decoded or in a GeometryBuffer
+    centroids: np.ndarray  # Projected centroids, shape (n_communes, 2)
+    extents: np.ndarray  # Distance from each centroid to the farthest vertex of its polygon
+    centroids_tree: cKDTree
+    metiers: InvertedIndex  # Top FAP codes of the employment area ('be_codfap_top')
+    formations: InvertedIndex  # Training codes ('codes_formations')
+
+    def positions(self, codgeos) -> np.ndarray:
+        """Returns the positions of the given codgeos (-1 when unknown)."""
+        return self.codgeo.get_indexer(codgeos)
+
+    def feature_block(self, positions: np.ndarray, names: List[str]) -> np.ndarray:
+        """Returns the (len(names), len(positions)) block of features for a subset of communes."""
+        rows = [self.feature_names.index(name) for name in names]
+        return self.features[rows][:, positions]
+
+    def within_distance(self, codgeo: str, max_distance: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the communes whose polygon is closer than `max_distance` (meters) to the polygon of the commune `codgeo`.
+        A radius query on the centroids KD-tree, widened by the largest extent, gives the candidates, kept only when their
+        centroid is within `max_distance` plus their own extent and the one of the origin: exact polygon distances are
+        only computed for them, so that a few very large communes (e.g. overseas) do not widen every search.
+
+        Returns:
+            The positions of the communes found, in table order, and their distance in meters.
+        """
+        origin = self.codgeo.get_loc(codgeo)
+        radius = max_distance + self.extents.max() + self.extents[origin]
+        candidates = np.array(self.centroids_tree.query_ball_point(self.centroids[origin], radius, return_sorted=True), dtype='int64')
+        centroid_distances = np.hypot(*(self.centroids[candidates] - self.centroids[origin]).T)
+        candidates = candidates[centroid_distances <= max_distance + self.extents[candidates] + self.extents[origin]]
+        distances = shp.distance(self.polygons_projected[candidates], self.polygons_projected[origin])
+        keep = distances < max_distance
+        return candidates[keep], distances[keep]
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        """Returns the arrays of the index, e.g. to save them with np.savez. The KD-tree is rebuilt from the centroids on load."""
+        polygons = self.polygons_projected
+        if not isinstance(polygons, GeometryBuffer):
+            polygons = GeometryBuffer.from_geometries(polygons)
+        return {
+            'codgeo': np.asarray(self.codgeo, dtype=str),
+            'feature_names': np.asarray(self.feature_names, dtype=str),
+            'features': self.features,
+            'neighbors_indptr': self.neighbors.indptr,
+            'neighbors_indices': self.neighbors.indices,
+            **polygons.to_arrays('polygons'),
+            'centroids': self.centroids,
+            'extents': self.extents,
+            **self.metiers.to_arrays('metiers'),
+            **self.formations.to_arrays('formations'),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays, codgeo: pd.Index, decode_polygons: bool = True) -> 'CommuneIndex':
+        """
+        Rebuilds an index saved with `to_arrays`, for the communes `codgeo` (the index of the odis table it was built from).
+        The arrays are used as they are, e.g. memory-mapped. Without `decode_polygons`, the polygons stay in a
+        GeometryBuffer and only the candidates of each distance query are decoded.
+        """
+        if not np.array_equal(arrays['codgeo'], np.asarray(codgeo, dtype=str)):
+            raise ValueError("The saved commune index does not match the communes of the table")
+        n = len(codgeo)
+        indices = arrays['neighbors_indices']
+        return cls(
+            codgeo=codgeo,
+            feature_names=arrays['feature_names'].tolist(),
+            features=arrays['features'],
+            neighbors=sparse.csr_matrix((np.ones(len(indices), dtype=bool), indices, arrays['neighbors_indptr']), shape=(n, n)),
+            polygons_projected=unpack_wkb(arrays['polygons_wkb'], arrays['polygons_offsets']) if decode_polygons else GeometryBuffer.from_arrays(arrays, 'polygons'),
+            centroids=arrays['centroids'],
+            extents=arrays['extents'],
+            centroids_tree=cKDTree(arrays['centroids']),
+            metiers=InvertedIndex.from_arrays(arrays, 'metiers', n),
+            formations=InvertedIndex.from_arrays(arrays, 'formations', n),
+        )
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [self.features, self.neighbors.indptr, self.neighbors.indices, self.neighbors.data, self.centroids, self.extents]
+        polygons = self.polygons_projected.nbytes if isinstance(self.polygons_projected, GeometryBuffer) else geometry_nbytes(self.polygons_projected)
+        return sum(array.nbytes for array in arrays) + polygons + self.metiers.nbytes + self.formations.nbytes
+
+    def neighbor_graph(self, positions: np.ndarray) -> sparse.csr_matrix:
+        """
+        Returns the adjacency graph restricted to a subset of communes, indexed by their order in `positions`.
+        Each commune is added as the first entry of its own row: this is the monome case, the other entries
+        of the row being its possible binome partners.
+        """
+        sub = self.neighbors[positions][:, positions]
+        n = len(positions)
+        indptr = sub.indptr + np.arange(n + 1)
+        indices = np.insert(sub.indices, sub.indptr[:-1], np.arange(n))
+        return sparse.csr_matrix((np.ones(len(indices), dtype=bool), indices, indptr), shape=(n, n))
+
+
+def build_commune_index(odis: gpd.GeoDataFrame, odis_lists: Dict[str, ListColumn], projected_crs: str) -> CommuneIndex:
+    """
+    Precomputes all config-independent data of the communes:
+    - the metrics, into a dense float32 matrix. Ratios keep the same semantics as a pandas division: x/0 gives inf and 0/0 gives NaN.
+    - the neighbor lists of `odis_lists` (see split_list_columns), into a sparse adjacency matrix.
+    - the polygons projected to `projected_crs` with their centroids and a KD-tree, for distance filtering.
+    - inverted indexes of the FAP and training codes lists, for matching the user's preferences.
+    """
+    feature_names = list(STATIC_RATIOS) + STATIC_VALUES
+    features = np.empty((len(feature_names), len(odis)), dtype='float32')
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, (numerator, denominator, factor) in enumerate(STATIC_RATIOS.values()):
+            features[i] = factor * _as_float(odis[numerator]) / _as_float(odis[denominator])
+    for i, name in enumerate(STATIC_VALUES, start=len(STATIC_RATIOS)):
+        features[i] = _as_float(odis[name])
+
+    # Neighbor lists compiled into a sparse adjacency matrix over commune positions.
+    # Neighbors missing from the table are dropped, as the former inner merge did.
+    voisins, rows = odis_lists['codgeo_voisins'].flatten()
+    cols = odis.index.get_indexer(voisins)
+    keep = (cols >= 0) & (cols != rows)
+    neighbors = sparse.csr_matrix((np.ones(keep.sum(), dtype=bool), (rows[keep], cols[keep])), shape=(len(odis), len(odis)))
+
+    # Projected polygons, centroids and their extent, so that searches never reproject geometries.
+    polygons_projected = np.asarray(odis.geometry.to_crs(projected_crs).values)
+    centroids = shp.get_coordinates(shp.centroid(polygons_projected))
+    vertices, owners = shp.get_coordinates(polygons_projected, return_index=True)
+    vertex_distances = np.hypot(*(vertices - centroids[owners]).T)
+    extents = np.zeros(len(odis))
+    np.maximum.at(extents, owners, vertex_distances)
+
+    # Inverted indexes of the codes lists
+    metiers = build_inverted_index(*odis_lists['be_codfap_top'].flatten(), len(odis))
+    formations = build_inverted_index(*odis_lists['codes_formations'].flatten(), len(odis))
+
+    return CommuneIndex(
+        codgeo=odis.index,
+        feature_names=feature_names,
+        features=features,
+        neighbors=neighbors,
+        polygons_projected=polygons_projected,
+        centroids=centroids,
+        extents=extents,
+        centroids_tree=cKDTree(centroids),
+        metiers=metiers,
+        formations=formations,
+    )
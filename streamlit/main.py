@@ -1,13 +1,15 @@
 import copy
 import time
 
+import numpy as np
 import streamlit as st
 
 # Local imports
-from scoring import compute_odis_score, load_all_datasets
+from scoring import compute_odis_score, rank_results, with_polygons
+from datasets import DatasetManager
 import config as cfg
 import ui
-import maps
+# maps and streamlit_folium (folium, branca) are imported once there are results to show on the map
 
 print(f"--- App re-run at {time.ctime(time.time())} ---")
 
@@ -38,8 +40,14 @@ def session_states_init(defaults):
         st.session_state['highlighted_result'] = [False, None]
     if 'fg_dict_ref' not in st.session_state:
         st.session_state['fg_dict_ref'] = {}
+    if 'layer_cache' not in st.session_state:
+        st.session_state['layer_cache'] = {} # Layers built for the current results (see maps.memoized_layer)
     if 'fgs_to_show' not in st.session_state:
         st.session_state['fgs_to_show'] = set()
+    if 'layer_stats' not in st.session_state:
+        st.session_state['layer_stats'] = {} # Payload of the last layer of each name (see maps.memoized_layer)
+    if 'map_view' not in st.session_state:
+        st.session_state['map_view'] = None # Bounds and zoom reported by the map (see store_map_view)
     if "zoom" not in st.session_state:
         st.session_state['zoom'] = 10
     if "center" not in st.session_state:
@@ -85,60 +93,83 @@ def session_states_init(defaults):
 
 @st.cache_resource
 def init_datasets():
-    """Loads all datasets and returns them in a structured dictionary."""
+    """
+    Opens the datasets manager, shared by all sessions. The core datasets are loaded, the directories used by the
+    map overlays and the result details keep loading in the background. The datasets are reloaded in the background
+    when the source files change (see cfg.DATA_REFRESH_INTERVAL).
+    """
     print("--- Loading all datasets... ---")
-    odis, scores_cat, codfap_index, codformations_index, annuaire_ecoles, annuaire_sante, annuaire_inclusion, incl_index = load_all_datasets(
-        cfg.ODIS_FILE,
-        cfg.SCORES_CAT_FILE,
-        cfg.METIERS_FILE,
-        cfg.FORMATIONS_FILE,
-        cfg.ECOLES_FILE,
-        cfg.MATERNITE_FILE,
-        cfg.SANTE_FILE,
-        cfg.INCLUSION_FILE
-        )
-    return {
-        "odis": odis,
-        "scores_cat": scores_cat,
-        "codfap_index": codfap_index,
-        "codformations_index": codformations_index,
-        "annuaire_ecoles": annuaire_ecoles,
-        "annuaire_sante": annuaire_sante,
-        "annuaire_inclusion": annuaire_inclusion,
-        "incl_index": incl_index,
-        "coddep_set": sorted(set(odis['dep_code'])),
-        "depcom_df": odis[['dep_code','libgeo']].sort_values('libgeo'),
-    }
+    manager = DatasetManager()
+    app_data = manager.current()
+    print(f"--- Dataset load times (s): { {name: round(t, 2) for name, t in app_data.timings().items()} } ---")
+    memory = app_data.memory_report().groupby('dataset', sort=False).nbytes.sum()
+    print(f"--- Dataset memory (MiB): { {name: round(size / 1024**2, 1) for name, size in memory.items()} } ---")
+    return manager
 
 # Scoring et affichage de la carte avec tous les résultats
-@st.cache_data
-def run_scoring_pipeline(_df_original, scores_cat, config, _incl_index):
-    """Wrapper for the scoring function to enable Streamlit caching."""
-    return compute_odis_score(_df_original, scores_cat, config, _incl_index)
+def run_scoring_pipeline(app_data, config):
+    """Runs the scoring function with the caches shared by all sessions."""
+    odis_scored = compute_odis_score(
+        app_data['odis'],
+        app_data['scores_cat'],
+        config,
+        app_data['incl_index'],
+        app_data['commune_index'],
+        stage_cache=app_data['stage_cache'],
+        result_cache=app_data['result_cache'],
+    )
+    print(f"--- Result cache: {app_data['result_cache'].stats()} ---")
+    print(f"--- Stage cache: {app_data['stage_cache'].stats()} ---")
+    return odis_scored
+
+def add_top_polygons(odis_scored, app_data, top_n: int):
+    """
+    Adds the 'polygon' and 'polygon_binome' columns of the `top_n` first results, drawn by their own map layers.
+    The other results have no polygons: the scores layer only reads the ones in view (see maps.scores_in_view).
+    """
+    top = odis_scored.head(top_n)
+    for column, codgeos in [('polygon', top.codgeo), ('polygon_binome', top.codgeo_binome)]:
+        polygons = np.full(len(odis_scored), None, dtype=object)
+        polygons[:len(top)] = app_data['odis_polygons'][app_data['odis'].index.get_indexer(codgeos)]
+        odis_scored[column] = polygons
+    return odis_scored
+
+def store_map_view():
+    """
+    Callback of the map, when the user moved it: keeps the bounds and zoom it reports for the scores layer, with the
+    center and zoom the map was created with. They no longer apply once these change (see maps.view_bounds).
+    """
+    st.session_state['map_view'] = {**st.session_state['odis_scored_map'],
+                                    'created_with': (st.session_state['center'], st.session_state['zoom'])}
 
 def run_search():
     """
     Callback function for the 'Lancer la recherche' button.
     It creates the config, runs the scoring, and updates the session state.
     """
+    import maps
+
     print('--- Running new search ---')
+    # A new search moves the session to the latest version of the datasets, unless its commune no longer exists
+    latest = init_datasets().current()
+    depcom = latest['depcom_df']
+    if ((depcom.dep_code == st.session_state.ui_departement) & (depcom.libgeo == st.session_state.ui_commune)).any():
+        st.session_state.app_data = latest
     config = ui.create_scoring_config_from_inputs()
     st.session_state['config'] = config
 
     # Run the main scoring pipeline
-    odis_scored = run_scoring_pipeline(
-        _df_original=st.session_state.app_data['odis'],
-        scores_cat=st.session_state.app_data['scores_cat'],
-        config=config,
-        _incl_index=st.session_state.app_data['incl_index'],
-    )
+    odis_scored = run_scoring_pipeline(st.session_state.app_data, config)
 
     # Pop the current commune from the results and store it separately
-    selected_geo = st.session_state.app_data['odis'].loc[[config.commune_actuelle]].copy()
+    odis = st.session_state.app_data['odis']
+    position = odis.index.get_loc(config.commune_actuelle)
+    selected_geo = with_polygons(odis.iloc[[position]], st.session_state.app_data['odis_polygons'], [position])
     odis_scored = odis_scored.drop(config.commune_actuelle, errors='ignore')
 
-    # Sort results by score
-    odis_scored = odis_scored.sort_values('weighted_score', ascending=False).reset_index()
+    # Put the top results first, sorted by score. The other results are only shown on the map and don't need sorting.
+    odis_scored = rank_results(odis_scored, top_k=cfg.TOP_N_RESULTS).reset_index()
+    odis_scored = add_top_polygons(odis_scored, st.session_state.app_data, cfg.TOP_N_RESULTS)
 
     # Reset session state for the new results
     st.session_state['processed_gdf'] = odis_scored
@@ -146,6 +177,9 @@ def run_search():
     st.session_state['center'] = [selected_geo.polygon.centroid.y.iloc[0], selected_geo.polygon.centroid.x.iloc[0]]
     st.session_state['zoom'] = maps.get_map_zoom(config.loc_distance_km)
     st.session_state['fg_dict_ref'] = {}
+    st.session_state['layer_cache'] = {}
+    st.session_state['layer_stats'] = {}
+    st.session_state['map_view'] = None
     st.session_state['highlighted_result'] = [False, None]
 
 # Load Demo data
@@ -168,8 +202,9 @@ def load_demo_data(demo_data):
 defaults = cfg.DEMO_DATA_DEFAULT
 session_states_init(defaults)
 
-# Load all datasets and cache them
-st.session_state.app_data = init_datasets()
+# Load all datasets and cache them. A session keeps the version of the datasets its results were computed with.
+if st.session_state['processed_gdf'] is None or not st.session_state.app_data:
+    st.session_state.app_data = init_datasets().current()
 
 # Handle demo data from URL query params
 demo_data = load_demo_data(copy.deepcopy(cfg.DEMO_DATA_DEFAULT))
@@ -215,11 +250,9 @@ with col_results:
 
 ### Map Column
 with col_map:
-    from streamlit_folium import st_folium
     if st.session_state['processed_gdf'] is not None:
-        # Base layer with all scored communes
-        st.session_state['fg_dict_ref']['Scores'], colormap = maps.build_scores_layer(st.session_state['processed_gdf'])
-        st.session_state['fgs_to_show'].add('Scores')
+        import maps
+        from streamlit_folium import st_folium
 
         col1, col2 = st.columns([1,4], vertical_alignment='center')
         with col1:
@@ -242,11 +275,11 @@ with col_map:
                 # We add additional informational layers
                 legend_items = []
                 config = st.session_state['config']
-                target_codgeos = set(st.session_state['processed_gdf'].codgeo.tolist())
+                target_codgeos = st.session_state['processed_gdf'].codgeo
 
                 # ECOLES
                 if config.nb_enfants > 0 and st.checkbox('Établissements scolaires'):
-                    st.session_state['fg_dict_ref']['fg_ecoles'] = maps.build_ecoles_layer(st.session_state.app_data['annuaire_ecoles'], target_codgeos, config)
+                    st.session_state['fg_dict_ref']['fg_ecoles'] = maps.memoized_layer(('fg_ecoles',), maps.build_ecoles_layer, st.session_state.app_data['ecoles_points'], target_codgeos, config)
                     st.session_state['fgs_to_show'].add('fg_ecoles')
                     legend_items.append({'color': 'green', 'icon': 'pencil', 'text': 'Écoles'})
                 else:
@@ -254,7 +287,7 @@ with col_map:
 
                 # SANTE
                 if config.besoin_sante != "Aucun" and st.checkbox('Établissements de santé'):
-                    st.session_state['fg_dict_ref']['fg_sante'] = maps.build_sante_layer(st.session_state.app_data['annuaire_sante'], target_codgeos, config)
+                    st.session_state['fg_dict_ref']['fg_sante'] = maps.memoized_layer(('fg_sante',), maps.build_sante_layer, st.session_state.app_data['sante_points'], target_codgeos, config)
                     st.session_state['fgs_to_show'].add('fg_sante')
                     legend_items.append({'color': 'blue', 'icon': 'plus', 'text': 'Santé'})
                 else:
@@ -262,7 +295,7 @@ with col_map:
 
                 # SERVICES INCLUSION
                 if config.besoins_autres and st.checkbox("Services d'inclusion"):
-                    st.session_state['fg_dict_ref']['fg_services'] = maps.build_services_layer(st.session_state.app_data['annuaire_inclusion'], target_codgeos, config)
+                    st.session_state['fg_dict_ref']['fg_services'] = maps.memoized_layer(('fg_services',), maps.build_services_layer, st.session_state.app_data['inclusion_points'], target_codgeos, config)
                     st.session_state['fgs_to_show'].add('fg_services')
                     legend_items.append({'color': 'purple', 'icon': 'heart', 'text': 'Inclusion'})
                 else:
@@ -272,6 +305,20 @@ with col_map:
                 legend = maps.build_legend(legend_items)
                 st.markdown(legend, unsafe_allow_html=True)
 
+        # Base layer with the scored communes in view, or their scores by area when there are too many of them,
+        # simplified for the zoom of the map, within the payload budget left by the other layers. The layers are only
+        # built again by a new search, or here when the user moves the map out of the area drawn or zooms.
+        app_data, results = st.session_state.app_data, st.session_state['processed_gdf']
+        map_view = st.session_state['map_view']
+        if map_view and map_view['created_with'] != (st.session_state['center'], st.session_state['zoom']):
+            map_view = None
+        zoom = (map_view and map_view.get('zoom')) or st.session_state['zoom'] or maps.get_map_zoom(st.session_state['config'].loc_distance_km)
+        bounds = maps.query_bounds(maps.view_bounds(map_view, st.session_state['center'], zoom), zoom)
+        other_layers = [name for name in st.session_state['fgs_to_show'] if name != 'Scores' and name in st.session_state['fg_dict_ref']]
+        budget = cfg.MAP_PAYLOAD_BUDGET - sum(st.session_state['layer_stats'][name]['nbytes'] for name in other_layers)
+        st.session_state['fg_dict_ref']['Scores'] = maps.scores_layer_within_budget(app_data, results, bounds, zoom, budget)
+        st.session_state['fgs_to_show'].add('Scores')
+
         # Affichage de la carte (toujours en dernier)
         # Base Map
         m = maps.create_base_map(st.session_state["center"], st.session_state["zoom"])
@@ -287,11 +334,13 @@ with col_map:
         #      ...
         # }
         # Add selected feature groups to the map
-        fgs_to_add = [
-            st.session_state['fg_dict_ref'][name] 
+        names_to_add = [
+            name
             for name in sorted(list(st.session_state['fgs_to_show'])) # Sort to ensure consistent layer order
             if name in st.session_state['fg_dict_ref']
         ]
+        fgs_to_add = [st.session_state['fg_dict_ref'][name] for name in names_to_add]
+        maps.log_map_payload(names_to_add)
 
         st_folium(
             m,
@@ -300,11 +349,7 @@ with col_map:
             feature_group_to_add=fgs_to_add,
             key="odis_scored_map",
             use_container_width=True,
-            returned_objects=[],
+            returned_objects=['bounds', 'zoom'],
+            on_change=store_map_view,
         )
         st.markdown('<style>.stCustomComponentV1   {border-radius:10px}</style>', unsafe_allow_html=True) # Rounded corners for the map widget
-
-if st.session_state['processed_gdf'] is not None:
-    st.sidebar.divider()
-    if st.sidebar.button('Export des résultats', icon=':material/picture_as_pdf:', type='secondary'):
-        st.cache_data.clear()
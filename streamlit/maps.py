@@ -1,14 +1,21 @@
 # /home/jacques/odis/13_odis/eda/streamlit/maps.py
+import json
+import time
+from typing import Callable, Dict, List
+
 import streamlit as st
 import folium as flm
-import geopandas as gpd
 import pandas as pd
 import numpy as np
+import shapely
 from shapely.geometry import mapping
 from branca.colormap import linear
 from folium.plugins import FastMarkerCluster
+from streamlit_folium import generate_leaflet_string
 
 import config as cfg
+from indexes import PointIndex
+from scoring import simplify_polygons
 
 def get_map_zoom(distance_km: int) -> int:
     """Returns a map zoom level based on a search distance."""
@@ -18,18 +25,201 @@ def get_map_zoom(distance_km: int) -> int:
     if distance_km <= 100: return 8
     return 7
 
+def pixel_size(zoom: int) -> float:
+    """Returns the size of a pixel of the map at a zoom level, in degrees of longitude (tiles of 256 pixels)."""
+    return 360 / (256 * 2**zoom)
+
+def map_tolerance(app_data, zoom: int):
+    """
+    Returns the tolerance of the polygons drawn at a zoom level: the coarsest simplified level of 'odis_map_polygons'
+    with details smaller than a pixel (see scoring.simplify_polygons), or None for the full resolution.
+    The full resolution is used while the levels are still being built.
+    """
+    if not app_data.is_ready('odis_map_polygons'):
+        return None
+    tolerances = [tolerance for tolerance in app_data['odis_map_polygons'] if tolerance <= pixel_size(zoom)]
+    return max(tolerances) if tolerances else None
+
+def commune_polygons(app_data, positions: np.ndarray, zoom: int) -> np.ndarray:
+    """Returns the polygons of the communes at `positions` of the commune table to draw at a zoom level (see map_tolerance)."""
+    tolerance = map_tolerance(app_data, zoom)
+    polygons = app_data['odis_polygons'] if tolerance is None else app_data['odis_map_polygons'][tolerance]
+    return np.asarray(polygons[positions])
+
+def view_bounds(view, center: list, zoom: int) -> tuple:
+    """
+    Returns the bounds of the map (min lon, min lat, max lon, max lat): the ones st_folium reported after the user moved
+    the map (`view`, see main.store_map_view), else estimated from its center and zoom (cfg.MAP_SIZE_PX).
+    """
+    if view and view.get('bounds') and view['bounds']['_southWest']['lat'] is not None:
+        south_west, north_east = view['bounds']['_southWest'], view['bounds']['_northEast']
+        return south_west['lng'], south_west['lat'], north_east['lng'], north_east['lat']
+    lat, lon = center or cfg.DEFAULT_MAP_CENTER
+    half_width, half_height = (size * pixel_size(zoom) / 2 for size in cfg.MAP_SIZE_PX)
+    half_height *= np.cos(np.radians(lat))  # Degrees of latitude are longer than degrees of longitude on the map
+    return lon - half_width, lat - half_height, lon + half_width, lat + half_height
+
+def query_bounds(bounds: tuple, zoom: int) -> tuple:
+    """
+    Returns the bounds of the area drawn by the scores layer: the view `bounds` with a margin (cfg.MAP_VIEW_MARGIN),
+    snapped to the tiles of the zoom, so that the small moves of the map keep the same layer.
+    """
+    tile = 256 * pixel_size(zoom)
+    min_lon, min_lat, max_lon, max_lat = bounds
+    margin_lon, margin_lat = (max_lon - min_lon) * cfg.MAP_VIEW_MARGIN, (max_lat - min_lat) * cfg.MAP_VIEW_MARGIN
+    return (float(np.floor((min_lon - margin_lon) / tile) * tile), float(np.floor((min_lat - margin_lat) / tile) * tile),
+            float(np.ceil((max_lon + margin_lon) / tile) * tile), float(np.ceil((max_lat + margin_lat) / tile) * tile))
+
+def in_bounds(boxes: np.ndarray, bounds: tuple) -> np.ndarray:
+    """Returns the mask of the bounding boxes (n, 4) intersecting `bounds`."""
+    min_lon, min_lat, max_lon, max_lat = bounds
+    return (boxes[:, 0] <= max_lon) & (boxes[:, 2] >= min_lon) & (boxes[:, 1] <= max_lat) & (boxes[:, 3] >= min_lat)
+
+def scores_in_view(app_data, df: pd.DataFrame, bounds: tuple, zoom: int, detail: int = 0) -> tuple:
+    """
+    Selects what the scores layer draws within `bounds`: the result communes of `df` in view when there are at most
+    cfg.MAP_MAX_FEATURES of them, else their scores by area, at the first level of cfg.MAP_AGGREGATION_LEVELS with
+    few enough areas in view. The score of an area is the best score of its communes.
+    Only the polygons drawn are decoded, simplified for the zoom.
+
+    Args:
+        detail: Number of steps to degrade the layer by (see scores_layer_within_budget): each one halves the maximum
+            number of features and simplifies the polygons as for the zoom level below, further than the
+            precomputed levels if needed.
+
+    Returns:
+        The rows to draw ('codgeo', 'libgeo', 'weighted_score', and 'best_libgeo', 'n_communes' for the areas), their
+        polygons and the aggregation level (None for the communes).
+    """
+    max_features, zoom = cfg.MAP_MAX_FEATURES // 2**detail, zoom - detail
+    positions = app_data['odis'].index.get_indexer(df['codgeo'])
+    visible = np.flatnonzero(in_bounds(app_data['odis_bounds'][positions], bounds))
+    if len(visible) <= max_features or not app_data.is_ready('map_areas'):
+        # While the areas are being built, only the best communes in view are drawn
+        if len(visible) > max_features:
+            visible = np.sort(visible[np.argpartition(-df['weighted_score'].to_numpy()[visible], max_features)[:max_features]])
+        polygons = commune_polygons(app_data, positions[visible], zoom)
+        return df.iloc[visible][['codgeo', 'libgeo', 'weighted_score']], coarser_polygons(polygons, zoom, detail), None
+
+    # Best commune of each area: the first one by score, the top results first among equal scores
+    results = pd.DataFrame({'weighted_score': df['weighted_score'].to_numpy(), 'best_libgeo': df['libgeo'].to_numpy()})
+    order = np.argsort(-results['weighted_score'].to_numpy(), kind='stable')
+    for column in cfg.MAP_AGGREGATION_LEVELS:
+        areas = app_data['map_areas'][column]
+        commune_area = areas.commune_area[positions]
+        best = results.assign(area=commune_area).iloc[order]
+        best = best[best['area'] >= 0].drop_duplicates('area')
+        best = best[in_bounds(areas.bounds[best['area'].to_numpy()], bounds)]
+        if len(best) <= max_features:
+            break
+
+    area = best['area'].to_numpy()
+    n_communes = np.bincount(commune_area[commune_area >= 0], minlength=len(areas.codes))
+    rows = pd.DataFrame({
+        'codgeo': areas.codes[area], 'libgeo': areas.names[area], 'weighted_score': best['weighted_score'].to_numpy(),
+        'best_libgeo': best['best_libgeo'].to_numpy(), 'n_communes': n_communes[area],
+    })
+    tolerance = max([tolerance for tolerance in areas.polygons if tolerance <= pixel_size(zoom)], default=min(areas.polygons))
+    return rows, coarser_polygons(np.asarray(areas.polygons[tolerance][area]), zoom, detail), column
+
+def coarser_polygons(polygons: np.ndarray, zoom: int, detail: int) -> np.ndarray:
+    """
+    Returns the polygons of a degraded scores layer (`detail` > 0) simplified to the pixel size of its `zoom` when it is
+    coarser than all the precomputed levels (see scores_in_view), else `polygons` as they are.
+    """
+    tolerance = pixel_size(zoom)
+    if not detail or tolerance <= max(cfg.MAP_SIMPLIFY_TOLERANCES) or len(polygons) == 0:
+        return polygons
+    return simplify_polygons(polygons, [tolerance])[tolerance]
+
+def memoized_layer(key: tuple, build: Callable, *args):
+    """
+    Returns the layer of `key` for the results of the session, built with `build(*args)` the first time only.
+    The key holds the name of the layer and its parameters that can change between reruns, e.g. the zoom and the
+    bounds of the scores layer. The layers are kept in st.session_state['layer_cache'], cleared by a new search, with
+    at most cfg.MAP_LAYER_VARIANTS variants of each layer: the least recently used ones are dropped.
+
+    The payload of the layer is measured when it is built (see measure_layer), and its figures are kept by name in
+    st.session_state['layer_stats'] for log_map_payload.
+    """
+    cache = st.session_state['layer_cache']
+    if key in cache:
+        cache[key] = cache.pop(key)
+    else:
+        variants = [other for other in cache if other[0] == key[0]]
+        for other in variants[:max(0, len(variants) - cfg.MAP_LAYER_VARIANTS + 1)]:
+            del cache[other]
+        start = time.perf_counter()
+        layer = build(*args)
+        build_s = time.perf_counter() - start
+        cache[key] = layer, {**measure_layer(layer[0] if isinstance(layer, tuple) else layer), 'build_s': round(build_s, 3)}
+    layer, st.session_state['layer_stats'][key[0]] = cache[key]
+    return layer
+
+def count_features(element) -> int:
+    """Returns the number of features drawn by a layer: GeoJSON features, markers and clustered points."""
+    if isinstance(element, flm.GeoJson):
+        return len(element.data['features']) if element.data.get('type') == 'FeatureCollection' else 1
+    if isinstance(element, FastMarkerCluster):
+        return len(element.data)
+    if isinstance(element, flm.Marker):
+        return 1
+    return sum(count_features(child) for child in element._children.values())
+
+def measure_layer(layer: flm.FeatureGroup) -> Dict[str, float]:
+    """
+    Returns the payload of a layer: its number of features, and the size in bytes and serialization time of the
+    JavaScript st_folium ships to the browser for it on each rerun (rendered the same way, on a throwaway map).
+    """
+    start = time.perf_counter()
+    layer.add_to(flm.Map())
+    layer.render()
+    script = generate_leaflet_string(layer, base_id='feature_group_0')
+    render_s = time.perf_counter() - start
+    return {'features': count_features(layer), 'nbytes': len(script.encode()), 'render_s': round(render_s, 3)}
+
+def scores_layer_within_budget(app_data, df: pd.DataFrame, bounds: tuple, zoom: int, budget: int) -> flm.FeatureGroup:
+    """
+    Returns the scores layer of the results `df` within `bounds` (see scores_in_view), degraded to coarser polygons and
+    fewer features, up to cfg.MAP_DEGRADE_STEPS times, until its payload fits in `budget` bytes.
+    """
+    score_range = (df.weighted_score.min(), df.weighted_score.max())
+    ready = app_data.is_ready('odis_map_polygons'), app_data.is_ready('map_areas')
+    for detail in range(cfg.MAP_DEGRADE_STEPS + 1):
+        fg, _ = memoized_layer(
+            ('Scores', zoom, bounds, *ready, detail),
+            lambda: build_scores_layer(*scores_in_view(app_data, df, bounds, zoom, detail), score_range=score_range),
+        )
+        if st.session_state['layer_stats']['Scores']['nbytes'] <= budget:
+            break
+    st.session_state['layer_stats']['Scores']['detail'] = detail
+    return fg
+
+def log_map_payload(names: List[str]) -> int:
+    """
+    Logs the payload of the map layers shown on this rerun (see measure_layer), as a JSON line, and warns when their
+    total is over cfg.MAP_PAYLOAD_BUDGET. Returns the total size in bytes.
+    """
+    layers = {name: st.session_state['layer_stats'][name] for name in names if name in st.session_state['layer_stats']}
+    total = sum(stats['nbytes'] for stats in layers.values())
+    print(f"--- Map payload: {json.dumps({'nbytes': total, 'budget': cfg.MAP_PAYLOAD_BUDGET, 'layers': layers})} ---")
+    if total > cfg.MAP_PAYLOAD_BUDGET:
+        print(f"--- Map payload over budget: {total / 1024**2:.1f} MiB > {cfg.MAP_PAYLOAD_BUDGET / 1024**2:.1f} MiB ---")
+    return total
+
 def create_base_map(center: list, zoom: int):
     """Creates the base Folium map."""
     if center is None: center = cfg.DEFAULT_MAP_CENTER
     if zoom is None: zoom = get_map_zoom(st.session_state.config.loc_distance_km)
     return flm.Map(location=center, zoom_start=zoom, tiles="cartodbpositron")
 
-def build_scores_layer(df: pd.DataFrame) -> tuple:
-    """Builds the FeatureGroup for all scored communes, colored by score."""
+def build_scores_layer(df: pd.DataFrame, polygons: np.ndarray, level, score_range: tuple) -> tuple:
+    """
+    Builds the FeatureGroup of the scored communes, or of the areas of an aggregation `level` (see scores_in_view),
+    colored by score on `score_range`, the range of the scores of all the results.
+    """
     fg = flm.FeatureGroup(name="Scores")
-    
-    score_dict = df.set_index("codgeo")["weighted_score"]
-    colormap = linear.YlGn_09.scale(score_dict.min(), score_dict.max())
+    colormap = linear.YlGn_09.scale(*score_range)
 
     # Add current commune in blue
     current_geo_df = st.session_state.selected_geo
@@ -42,23 +232,55 @@ def build_scores_layer(df: pd.DataFrame) -> tuple:
         tooltip=current_geo_df['libgeo'].iloc[0]
     ).add_to(fg)
 
-    # Add all scored communes
-    df_serializable = df[['codgeo', 'libgeo', 'weighted_score', 'polygon']].copy()
-    df_serializable.set_geometry('polygon', inplace=True)
+    if df.empty:
+        return fg, colormap
 
+    if level is None:
+        tooltip = flm.GeoJsonTooltip(fields=['libgeo', 'weighted_score'], aliases=['Commune:', 'Score:'], fmt=['', '{:.0%}'])
+    else:
+        tooltip = flm.GeoJsonTooltip(fields=['libgeo', 'weighted_score', 'best_libgeo', 'n_communes'],
+                                     aliases=[f'{cfg.MAP_AGGREGATION_LEVELS[level]}:', 'Meilleur score:', 'Meilleure commune:', 'Communes:'])
+
+    # Add the scored communes or areas, colored in the GeoJSON itself: no style function called for each feature
+    geojson = scores_geojson(df, polygons, score_colors(df['weighted_score'], colormap))
     flm.GeoJson(
-        df_serializable,
-        style_function=lambda feature: {
-            "fillColor": colormap(score_dict.get(feature["properties"]["codgeo"])),
-            "color": "grey",
-            "weight": 1,
-            "fillOpacity": 0.7,
-        },
-        tooltip=flm.GeoJsonTooltip(fields=['libgeo', 'weighted_score'], aliases=['Commune:', 'Score:'], fmt=['', '{:.0%}']),
+        geojson,
+        style={"color": "grey", "weight": 1, "fillOpacity": 0.7},  # Common style, the fill color of each feature is in its 'style' property
+        tooltip=tooltip,
     ).add_to(fg)
 
     return fg, colormap
 
+def score_colors(scores: pd.Series, colormap) -> np.ndarray:
+    """
+    Returns the '#RRGGBB' color of each score on a branca LinearColormap, computed for all scores at once.
+    The colors are the ones of colormap.rgb_hex_str(score).
+    """
+    values = scores.to_numpy(dtype=float)
+    index = np.asarray(colormap.index, dtype=float)
+    channels = np.asarray(colormap.colors, dtype=float)[:, :3]
+    rgb = np.column_stack([np.interp(values, index, channels[:, j]) for j in range(3)])
+    rgb[values <= index[0]] = channels[0]
+    rgb = (rgb * 255.9999).astype(np.int64)
+    codes, inverse = np.unique(rgb[:, 0] << 16 | rgb[:, 1] << 8 | rgb[:, 2], return_inverse=True)
+    return np.array([f'#{code:06x}' for code in codes], dtype=object)[inverse.ravel()]
+
+def scores_geojson(df: pd.DataFrame, polygons: np.ndarray, colors: np.ndarray) -> str:
+    """
+    Returns the GeoJSON FeatureCollection of the scored communes or areas, as a string. Each feature has the columns of
+    `df` as properties, and its fill color in the 'style' property applied by folium.
+    The properties and the geometries are serialized for all features at once (pandas, shapely).
+    """
+    styles = {color: {'fillColor': color} for color in set(colors)}
+    properties = df.assign(style=[styles[color] for color in colors])
+    properties = properties.to_json(orient='records', lines=True).splitlines()
+    geometries = shapely.to_geojson(np.asarray(polygons, dtype=object))
+    features = ','.join(
+        f'{{"type":"Feature","properties":{props},"geometry":{"null" if geometry is None else geometry}}}'
+        for props, geometry in zip(properties, geometries)
+    )
+    return f'{{"type":"FeatureCollection","features":[{features}]}}'
+
 def build_top_result_layer(row: pd.Series, index: int) -> flm.FeatureGroup:
     """Builds a FeatureGroup to highlight a single top result (commune + binome)."""
     fg = flm.FeatureGroup(name=f"Top{index + 1}")
@@ -100,17 +322,12 @@ def build_legend(items_list: list) -> str:
     legend_html += "</ul></div>"
     return legend_html
 
-def _build_generic_points_layer(df: gpd.GeoDataFrame, icon: str, color: str, tooltip_cols: list) -> flm.FeatureGroup:
-    """Generic helper to build a FastMarkerCluster layer."""
-    df = df.copy()
-    df = df[~df.is_empty & df.notna()]
-    if df.empty:
+def _build_generic_points_layer(points: pd.DataFrame, icon: str, color: str, tooltip_cols: list) -> flm.FeatureGroup:
+    """Generic helper to build a FastMarkerCluster layer, from the rows of a PointIndex ('lat', 'lon' and the `tooltip_cols`)."""
+    if points.empty:
         return flm.FeatureGroup()
 
-    df['lat'] = df.geometry.y
-    df['lon'] = df.geometry.x
-    
-    locations = df[['lat', 'lon'] + tooltip_cols].values.tolist()
+    locations = points[['lat', 'lon'] + tooltip_cols].to_numpy(dtype=object).tolist()
     
     # Create a JS callback for the markers
     popup_str = " + '<br>' + ".join([f"'{col}: ' + row[{i+2}]" for i, col in enumerate(tooltip_cols)])
@@ -126,65 +343,39 @@ def _build_generic_points_layer(df: gpd.GeoDataFrame, icon: str, color: str, too
     """
     return FastMarkerCluster(locations, callback=callback)
 
-def build_ecoles_layer(annuaire_ecoles: gpd.GeoDataFrame, target_codgeos: set, config: cfg.ScoringConfig) -> flm.FeatureGroup:
-    """Builds the map layer for schools."""
+def build_ecoles_layer(ecoles_points: PointIndex, target_codgeos, config: cfg.ScoringConfig) -> flm.FeatureGroup:
+    """Builds the map layer for schools of the levels of the children (see scoring.ecoles_points)."""
     fg = flm.FeatureGroup(name="Établissements Scolaires")
-    
-    filtered = annuaire_ecoles[annuaire_ecoles['code_commune'].isin(target_codgeos)].copy()
     if not config.classe_enfants:
         return fg # No kids, no schools to show
-        
-    niveaux_map = {
-        'Maternelle': (filtered.ecole_maternelle > 0),
-        'Elémentaire': (filtered.ecole_elementaire > 0),
-        'Collège': (filtered.type_etablissement == 'Collège'),
-        'Lycée': (filtered.type_etablissement == 'Lycée')
-    }
-    
-    mask = pd.Series(False, index=filtered.index)
-    for niveau in config.classe_enfants:
-        if niveau in niveaux_map:
-            mask |= niveaux_map[niveau]
-            
-    filtered = filtered[mask]
-    
-    cluster = _build_generic_points_layer(filtered, icon='pencil', color='green', tooltip_cols=['nom_etablissement', 'type_etablissement'])
+
+    points = ecoles_points.select(target_codgeos, config.classe_enfants)
+    cluster = _build_generic_points_layer(points, icon='pencil', color='green', tooltip_cols=['nom_etablissement', 'type_etablissement'])
     cluster.add_to(fg)
     return fg
 
-def build_sante_layer(annuaire_sante: gpd.GeoDataFrame, target_codgeos: set, config: cfg.ScoringConfig) -> flm.FeatureGroup:
-    """Builds the map layer for health facilities."""
+def build_sante_layer(sante_points: PointIndex, target_codgeos, config: cfg.ScoringConfig) -> flm.FeatureGroup:
+    """Builds the map layer for health facilities matching the health need (see scoring.sante_points)."""
     fg = flm.FeatureGroup(name="Établissements de Santé")
-    filtered = annuaire_sante[annuaire_sante['codgeo'].isin(target_codgeos)].copy()
-
-    mask = pd.Series(False, index=filtered.index)
-    if config.besoin_sante == 'Maternité':
-        mask = filtered.maternite == True
-    elif config.besoin_sante == "Hopital":
-        mask = filtered.Categorie.isin(['355', '362', '101', '106'])
-    elif config.besoin_sante == "Soutien Psychologique & Addictologie":
-        mask = filtered.Categorie.isin(['156', '292', '425', '412', '366', '415', '430', '444'])
-    
-    if not mask.any():
+    points = sante_points.select(target_codgeos, [config.besoin_sante])
+    if points.empty:
         return fg
 
-    cluster = _build_generic_points_layer(filtered[mask], icon='plus', color='blue', tooltip_cols=['RaisonSociale', 'LibelleCategorieAgregat'])
+    cluster = _build_generic_points_layer(points, icon='plus', color='blue', tooltip_cols=['RaisonSociale', 'LibelleCategorieAgregat'])
     cluster.add_to(fg)
     return fg
 
-def build_services_layer(annuaire_inclusion: gpd.GeoDataFrame, target_codgeos: set, config: cfg.ScoringConfig) -> flm.FeatureGroup:
-    """Builds the map layer for inclusion services."""
+def build_services_layer(inclusion_points: PointIndex, target_codgeos, config: cfg.ScoringConfig) -> flm.FeatureGroup:
+    """Builds the map layer for inclusion services of the categories of the needs (see scoring.inclusion_points)."""
     fg = flm.FeatureGroup(name="Services d'inclusion")
     
     if not config.besoins_autres:
         return fg
         
-    filtered = annuaire_inclusion[annuaire_inclusion['codgeo'].isin(target_codgeos)].copy()
-    mask = filtered.categorie.isin(config.besoins_autres.keys())
-    
-    if not mask.any():
+    points = inclusion_points.select(target_codgeos, list(config.besoins_autres.keys()))
+    if points.empty:
         return fg
 
-    cluster = _build_generic_points_layer(filtered[mask], icon='heart', color='purple', tooltip_cols=['nom', 'categorie', 'service'])
+    cluster = _build_generic_points_layer(points, icon='heart', color='purple', tooltip_cols=['nom', 'categorie', 'service'])
     cluster.add_to(fg)
     return fg
@@ -0,0 +1,111 @@
+"""
+Compact in-memory representation of the datasets, and report of their memory.
+
+The memory tier of an instance is set by the resident datasets, and every copy of a table made by the pipeline
+duplicates its columns. Repeated strings are stored as categoricals, numeric columns in the smallest dtype holding
+their values exactly, and list columns as ListColumns (offsets + values, see indexes.py).
+
+    python memory.py   # Loads the datasets of the app and prints their memory, per dataset and per column
+"""
+from typing import Any, Dict, List, Optional
+
+import pandas as pd
+import numpy as np
+import geopandas as gpd
+from pandas.api import types
+from scipy import sparse
+
+from indexes import geometry_nbytes
+
+
+# --- Compaction ---
+
+def downcast_numeric(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Stores each numeric column in the smallest dtype holding all its values exactly: integers in the smallest integer
+    dtype, floats in float32 when no value loses precision. Values, and so scores, are unchanged.
+    """
+    dtypes = {}
+    for col in df.columns:
+        values = df[col]
+        if types.is_bool_dtype(values) or not types.is_numeric_dtype(values) or isinstance(values.dtype, pd.CategoricalDtype):
+            continue
+        if types.is_integer_dtype(values):
+            dtypes[col] = pd.to_numeric(values, downcast='integer').dtype
+        elif types.is_float_dtype(values) and values.dtype.itemsize > 4:
+            as_float32 = values.to_numpy().astype('float32')
+            if np.array_equal(as_float32.astype(values.dtype), values.to_numpy(), equal_nan=True):
+                dtypes[col] = 'float32'
+    return df.astype(dtypes) if dtypes else df
+
+
+def compact_frame(df: pd.DataFrame, categories: List[str]) -> pd.DataFrame:
+    """Converts the `categories` columns to categoricals and downcasts the numeric columns (see downcast_numeric)."""
+    df = df.astype({col: 'category' for col in categories if col in df.columns})
+    return downcast_numeric(df)
+
+
+# --- Memory Report ---
+
+def column_nbytes(df: pd.DataFrame) -> pd.Series:
+    """Memory of each column of a DataFrame and of its index ('Index'), in bytes. Geometries are approximated."""
+    usage = df.memory_usage(deep=True)
+    for col in df.columns:
+        if isinstance(df[col].dtype, gpd.array.GeometryDtype):
+            usage[col] = geometry_nbytes(df[col].values)
+    return usage
+
+
+def nbytes(value: Any) -> Optional[int]:
+    """
+    Memory of a dataset in bytes: DataFrames, dicts and tuples of datasets, arrays of geometries, sparse matrices and
+    objects with a `nbytes` (arrays, indexes). None if unknown.
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(column_nbytes(value).sum())
+    if isinstance(value, (dict, tuple)):
+        sizes = [nbytes(item) for item in (value.values() if isinstance(value, dict) else value)]
+        return None if None in sizes else sum(sizes)
+    if sparse.issparse(value):
+        return sum(int(getattr(value, name).nbytes) for name in ('data', 'indices', 'indptr') if hasattr(value, name))
+    if isinstance(value, np.ndarray) and value.dtype == object:
+        return geometry_nbytes(value)  # Arrays of decoded geometries
+    size = getattr(value, 'nbytes', None)
+    return None if size is None else int(size)
+
+
+def memory_report(datasets: Dict[str, Any]) -> pd.DataFrame:
+    """
+    Memory of datasets: one row per column of the DataFrames and per item of the dicts (e.g. the ListColumns of the
+    communes), one row for the other datasets of known size (see nbytes).
+
+    Returns:
+        DataFrame with 'dataset', 'column', 'dtype' and 'nbytes' columns.
+    """
+    rows = []
+    for name, value in datasets.items():
+        if isinstance(value, pd.DataFrame):
+            rows += [(name, col, str(value.index.dtype if col == 'Index' else value[col].dtype), int(size))
+                     for col, size in column_nbytes(value).items()]
+        elif isinstance(value, dict):
+            rows += [(name, key, type(item).__name__, nbytes(item)) for key, item in value.items() if nbytes(item) is not None]
+        elif nbytes(value) is not None:
+            rows.append((name, '', type(value).__name__, nbytes(value)))
+    return pd.DataFrame(rows, columns=['dataset', 'column', 'dtype', 'nbytes'])
+
+
+def main():
+    from datasets import open_datasets
+
+    registry = open_datasets()
+    report = registry.memory_report(wait=True)
+    report['MiB'] = (report.nbytes / 1024**2).round(2)
+    totals = report.groupby('dataset', sort=False).nbytes.sum().sort_values(ascending=False)
+    print((totals / 1024**2).round(2).rename('MiB').to_string())
+    print(f"Total: {totals.sum() / 1024**2:.1f} MiB\n")
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(report.sort_values(['dataset', 'nbytes'], ascending=[True, False]).to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,59 +1,163 @@
 # coding: utf-8
 # THIS SHOULD BE THE BEGINNING OF JUPYTER NOTEBOOK EXPORT
-from typing import List, Dict, Set, Any
+from typing import List, Dict, Set, Tuple, Any, Callable, Optional
+from dataclasses import dataclass
+from collections import OrderedDict
+import threading
 
 import pandas as pd
 import numpy as np
 import geopandas as gpd
 import shapely as shp
-from sklearn import preprocessing
+from scipy import sparse
 
-import gcsfs
-from google.cloud import storage
-from config import ScoringConfig, get_data_path
+import fsspec  # Imports gcsfs by itself when a gs:// path is first opened
+import pyarrow.parquet as pq
+from config import MAP_AGGREGATION_LEVELS, ScoringConfig, TOP_N_RESULTS
+from datastore import DataStore, open_store
+from indexes import AreaPolygons, CommuneIndex, InvertedIndex, ListColumn, PointIndex, STATIC_RATIOS, STATIC_VALUES, build_commune_index, build_point_index, build_services_index, dissolve_polygons, split_list_columns
+from memory import compact_frame, nbytes
 
 # --- Constants ---
+ODIS_CRS = "EPSG:4326"  # CRS of the commune polygons
 PROJECTED_CRS = "EPSG:2154"  # RGF93 / Lambert-93, suitable for metropolitan France
+POLYGON_PRECISION = 10**-5  # Grid size of the commune polygons, in degrees (~1 m)
+
+# Columns read from the source files: the other columns are never used by the app and are not loaded.
+ODIS_COLUMNS = ['codgeo', 'libgeo', 'dep_code', 'epci_code', 'epci_nom', 'population', 'polygon', 'codgeo_voisins',
+                'be_codfap_top', 'be_libfap_top', 'codes_formations', 'noms_formations', 'url_odis', 'url_wikipedia'] \
+               + list(dict.fromkeys(col for numerator, denominator, _ in STATIC_RATIOS.values() for col in (numerator, denominator))) \
+               + STATIC_VALUES
+ECOLES_COLUMNS = ['code_commune', 'nom_etablissement', 'type_etablissement', 'ecole_maternelle', 'ecole_elementaire', 'geometry']
+SANTE_COLUMNS = ['nofinesset', 'LibelleSph', 'coordxet', 'coordyet', 'Departement', 'Commune', 'Categorie', 'RaisonSociale', 'LibelleCategorieAgregat']
+INCLUSION_COLUMNS = ['codgeo', 'nom', 'categorie', 'service', 'geometry']
+
+# Columns with few distinct values, stored as categoricals
+ODIS_CATEGORIES = ['dep_code', 'epci_code', 'epci_nom']
+ECOLES_CATEGORIES = ['code_commune', 'type_etablissement']
+SANTE_CATEGORIES = ['LibelleSph', 'Departement', 'Commune', 'Categorie', 'LibelleCategorieAgregat', 'codgeo']
+INCLUSION_CATEGORIES = ['codgeo', 'categorie', 'service']
+# List columns of the communes, stored as ListColumns (offsets + values) instead of one list per row
+ODIS_LIST_COLUMNS = ['codgeo_voisins', 'be_codfap_top', 'be_libfap_top', 'codes_formations', 'noms_formations']
 
 
 # --- Data Loading Functions ---
 
-def load_all_datasets(odis_file: str, scores_cat_file: str, metiers_file: str, formations_file: str, ecoles_file: str, maternites_file: str, sante_file: str, inclusion_file: str) -> tuple:
+def read_parquet_columns(path: str, columns: List[str]) -> pd.DataFrame:
     """
-    Loads all necessary datasets from specified file paths.
-    This function acts as a facade, calling specific loading functions for each dataset.
+    Reads only the given columns of a parquet file (local or remote): the other columns are never read.
+    Columns missing from the file are skipped.
+    """
+    with fsspec.open(path, 'rb') as f:
+        available = set(pq.read_schema(f).names)
+        f.seek(0)
+        return pd.read_parquet(f, columns=[col for col in columns if col in available])
+
+
+def load_odis(path: str) -> Tuple[gpd.GeoDataFrame, Dict[str, ListColumn]]:
     """
-    base_path = get_data_path()
+    Loads the main table of the communes, indexed by codgeo.
 
-    odis = pd.read_parquet(base_path + odis_file)
-    odis['polygon'] = odis.polygon.apply(shp.from_wkb)
-    odis = gpd.GeoDataFrame(odis, geometry='polygon', crs='EPSG:4326')
-    odis.set_geometry('polygon', inplace=True)
-    odis.polygon.set_precision(10**-5)
+    Returns:
+        The table, without its list columns, and the ODIS_LIST_COLUMNS as ListColumns aligned on its rows.
+    """
+    odis = read_parquet_columns(path, ODIS_COLUMNS)
+    # Geometries are decoded and reduced to the working precision in bulk. Coordinates are only rounded to the grid
+    # ('pointwise'): a full validity-preserving snap costs an overlay per polygon. Rounding can make a polygon invalid
+    # (e.g. a self-intersection where two edges were closer than the grid): only those are repaired.
+    polygons = shp.set_precision(shp.from_wkb(odis.polygon.to_numpy()), POLYGON_PRECISION, mode='pointwise')
+    invalid = ~shp.is_valid(polygons) & ~shp.is_missing(polygons)
+    if invalid.any():
+        print(f"--- Repairing {invalid.sum()} commune polygons made invalid by the precision reduction ---")
+        polygons[invalid] = shp.make_valid(polygons[invalid], method='structure', keep_collapsed=False)
+    if not shp.is_valid(polygons[~shp.is_missing(polygons)]).all():
+        raise ValueError("Some commune polygons are invalid after the precision reduction")
+    odis['polygon'] = polygons
+    odis = gpd.GeoDataFrame(odis, geometry='polygon', crs=ODIS_CRS)
     odis = odis[~odis.polygon.isna()]
     odis.set_index('codgeo', inplace=True)
+    odis, odis_lists = split_list_columns(odis, ODIS_LIST_COLUMNS)
+    return compact_frame(odis, ODIS_CATEGORIES), odis_lists
+
+
+def simplify_polygons(polygons: np.ndarray, tolerances: List[float]) -> Dict[float, np.ndarray]:
+    """
+    Builds simplified levels of the commune polygons, for the map. Each level is simplified from the previous one.
+
+    The polygons are simplified as a coverage (shapely >= 2.1): a border shared by two communes is simplified once, and
+    neighbours keep touching without gaps or overlaps.
+
+    Args:
+        polygons: The polygons of the communes, in degrees.
+        tolerances: The tolerance of each level, in degrees.
+
+    Returns:
+        The polygons of each level, aligned on `polygons`, by tolerance.
+    """
+    levels = {}
+    for tolerance in sorted(tolerances):
+        polygons = shp.coverage_simplify(polygons, tolerance)
+        levels[tolerance] = polygons
+    return levels
+
+
+# Column of the commune table naming the areas of an aggregation level of the map, if any (see build_map_areas)
+AREA_NAME_COLUMNS = {'epci_code': 'epci_nom'}
+
+
+def build_map_areas(odis: pd.DataFrame, map_polygons: Dict[float, np.ndarray]) -> Dict[str, AreaPolygons]:
+    """
+    Builds the polygons of the areas the map aggregates the communes by (cfg.MAP_AGGREGATION_LEVELS), dissolved from
+    the finest simplified level of the commune polygons (see simplify_polygons), and simplified at the same tolerances.
+
+    Returns:
+        The AreaPolygons of each level, by column of the commune table (e.g. 'epci_code').
+    """
+    finest = np.asarray(map_polygons[min(map_polygons)])
+    areas = {}
+    for column, label in MAP_AGGREGATION_LEVELS.items():
+        commune_area, codes = pd.factorize(odis[column])
+        dissolved = dissolve_polygons(finest, commune_area, len(codes))
+        if column in AREA_NAME_COLUMNS:
+            names = odis[AREA_NAME_COLUMNS[column]].groupby(commune_area).first().reindex(range(len(codes))).to_numpy(dtype=object)
+        else:
+            names = np.array([f'{label} {code}' for code in codes], dtype=object)
+        areas[column] = AreaPolygons(codes=pd.Index(codes.astype(str)), names=names, commune_area=commune_area.astype('int32'),
+                                     bounds=shp.bounds(dissolved), polygons=simplify_polygons(dissolved, list(map_polygons)))
+    return areas
+
 
-    # Index of all scores and their explanations
-    scores_cat = pd.read_csv(base_path + scores_cat_file, dtype={'score': str, 'metric': str})
+def load_scores_cat(path: str) -> pd.DataFrame:
+    """Loads the index of all scores and their explanations."""
+    return pd.read_csv(path, dtype={'score': str, 'metric': str})
+
+
+def load_codfap_index(path: str) -> pd.DataFrame:
+    """Loads the code FAP <-> FAP Name table used to classify jobs."""
+    return pd.read_csv(path, delimiter=';')
+
+
+def load_codformations_index(path: str) -> pd.DataFrame:
+    """
+    Loads the code formation <-> Formation Name table used to classify trainings.
+    source: https://www.data.gouv.fr/fr/datasets/liste-publique-des-organismes-de-formation-l-6351-7-1-du-code-du-travail/
+    """
+    return pd.read_csv(path, dtype={'codformation': str}).set_index('codformation')
 
-    #Later we need the code FAP <-> FAP Name used to classify jobs
-    codfap_index = pd.read_csv(base_path + metiers_file, delimiter=';')
 
-    # Later we need the code formation <-> Formation Name used to classify trainings
-    # source: https://www.data.gouv.fr/fr/datasets/liste-publique-des-organismes-de-formation-l-6351-7-1-du-code-du-travail/
-    codformations_index = pd.read_csv(base_path + formations_file, dtype={'codformation': str}).set_index('codformation')
+def load_annuaire_ecoles(path: str) -> gpd.GeoDataFrame:
+    """Loads the directory of schools (établissements scolaires)."""
+    annuaire_ecoles = read_parquet_columns(path, ECOLES_COLUMNS)
+    annuaire_ecoles['geometry'] = shp.from_wkb(annuaire_ecoles.geometry.to_numpy())
+    return compact_frame(gpd.GeoDataFrame(annuaire_ecoles, geometry='geometry', crs='EPSG:4326'), ECOLES_CATEGORIES)
 
-    # Etablissements scolaires
-    annuaire_ecoles = pd.read_parquet(base_path + ecoles_file)
-    annuaire_ecoles.geometry = annuaire_ecoles.geometry.apply(shp.from_wkb)
-    annuaire_ecoles = gpd.GeoDataFrame(annuaire_ecoles, geometry='geometry', crs='EPSG:4326')
 
-    #Annuaire Maternités
-    annuaire_maternites = pd.read_csv(base_path + maternites_file, delimiter=';')
+def load_annuaire_sante(sante_path: str, maternites_path: str) -> gpd.GeoDataFrame:
+    """Loads the directory of public health facilities (FINESS), flagging the maternity wards."""
+    annuaire_maternites = pd.read_csv(maternites_path, delimiter=';')
     annuaire_maternites.drop_duplicates(subset=['FI_ET'], keep='last', inplace=True)
 
-    # Annuaire etablissements santé
-    annuaire_sante = pd.read_parquet(base_path + sante_file)
+    annuaire_sante = read_parquet_columns(sante_path, SANTE_COLUMNS)
     annuaire_sante = annuaire_sante[annuaire_sante.LibelleSph == 'Etablissement public de santé']
     annuaire_sante['geometry'] = gpd.points_from_xy(annuaire_sante.coordxet, annuaire_sante.coordyet, crs=PROJECTED_CRS)
     annuaire_sante = gpd.GeoDataFrame(annuaire_sante, geometry='geometry')
@@ -61,172 +165,271 @@ def load_all_datasets(odis_file: str, scores_cat_file: str, metiers_file: str, f
     annuaire_sante.drop(columns=['FI_ET'], inplace=True)
     annuaire_sante.maternite = np.where(annuaire_sante.maternite == 'both', True, False)
     annuaire_sante['codgeo'] = annuaire_sante.Departement + annuaire_sante.Commune
+    return compact_frame(annuaire_sante, SANTE_CATEGORIES)
+
+
+def load_annuaire_inclusion(path: str) -> gpd.GeoDataFrame:
+    """Loads the directory of inclusion services."""
+    annuaire_inclusion = read_parquet_columns(path, INCLUSION_COLUMNS)
+    annuaire_inclusion['geometry'] = shp.from_wkb(annuaire_inclusion.geometry.to_numpy())
+    return compact_frame(gpd.GeoDataFrame(annuaire_inclusion, geometry='geometry', crs='EPSG:4326'), INCLUSION_CATEGORIES)
+
+
+def load_inclusion_services(path: str) -> pd.DataFrame:
+    """Loads the inclusion services of each commune only ('codgeo', 'categorie', 'service'), without their geometry or names."""
+    return compact_frame(read_parquet_columns(path, ['codgeo', 'categorie', 'service']), INCLUSION_CATEGORIES)
+
+
+# Filters of the health overlay (ScoringConfig.besoin_sante) on FINESS categories, besides the maternity wards
+SANTE_BESOINS_CATEGORIES = {
+    'Hopital': ['355', '362', '101', '106'],
+    'Soutien Psychologique & Addictologie': ['156', '292', '425', '412', '366', '415', '430', '444'],
+}
+
+
+def ecoles_points(annuaire_ecoles: gpd.GeoDataFrame) -> PointIndex:
+    """Points of the schools for the map overlay, with a flag per school level (ScoringConfig.classe_enfants)."""
+    flags = {
+        'Maternelle': annuaire_ecoles.ecole_maternelle > 0,
+        'Elémentaire': annuaire_ecoles.ecole_elementaire > 0,
+        'Collège': annuaire_ecoles.type_etablissement == 'Collège',
+        'Lycée': annuaire_ecoles.type_etablissement == 'Lycée',
+    }
+    return build_point_index(annuaire_ecoles, 'code_commune', ['nom_etablissement', 'type_etablissement'], flags)
+
+
+def sante_points(annuaire_sante: gpd.GeoDataFrame) -> PointIndex:
+    """Points of the public health facilities for the map overlay, with a flag per health need (ScoringConfig.besoin_sante)."""
+    flags = {
+        'Maternité': annuaire_sante.maternite == True,
+        **{besoin: annuaire_sante.Categorie.isin(categories) for besoin, categories in SANTE_BESOINS_CATEGORIES.items()},
+    }
+    return build_point_index(annuaire_sante, 'codgeo', ['RaisonSociale', 'LibelleCategorieAgregat'], flags)
+
+
+def inclusion_points(annuaire_inclusion: gpd.GeoDataFrame) -> PointIndex:
+    """Points of the inclusion services for the map overlay, with a flag per category (keys of ScoringConfig.besoins_autres)."""
+    categories = sorted(annuaire_inclusion.categorie.dropna().unique())
+    flags = {categorie: annuaire_inclusion.categorie == categorie for categorie in categories}
+    return build_point_index(annuaire_inclusion, 'codgeo', ['nom', 'categorie', 'service'], flags)
+
+
+def inclusion_catalog(annuaire_inclusion: pd.DataFrame) -> pd.DataFrame:
+    """Returns the sorted list of the distinct ('categorie', 'service') pairs of the inclusion services, used for the needs selection."""
+    return annuaire_inclusion[['categorie', 'service']].drop_duplicates().sort_values(['categorie', 'service'], ignore_index=True)
+
+
+def load_all_datasets(odis_file: str, scores_cat_file: str, metiers_file: str, formations_file: str, ecoles_file: str, maternites_file: str, sante_file: str, inclusion_file: str,
+                      store: Optional[DataStore] = None) -> tuple:
+    """
+    Loads all necessary datasets from specified file paths.
+    This function acts as a facade, calling specific loading functions for each dataset.
+    The files are read from `store` (default: the DataStore of the app data, see datastore.open_store).
+    """
+    # Remote files are read through the local disk cache, and fetched in parallel
+    paths = (store or open_store()).fetch_all([odis_file, scores_cat_file, metiers_file, formations_file, ecoles_file, maternites_file, sante_file, inclusion_file])
+
+    odis, odis_lists = load_odis(paths[odis_file])
+
+    # Config-independent metrics, neighbor graph and spatial index, computed once instead of on every search
+    commune_index = build_commune_index(odis, odis_lists, PROJECTED_CRS)
+
+    scores_cat = load_scores_cat(paths[scores_cat_file])
+    codfap_index = load_codfap_index(paths[metiers_file])
+    codformations_index = load_codformations_index(paths[formations_file])
+    annuaire_ecoles = load_annuaire_ecoles(paths[ecoles_file])
+    annuaire_sante = load_annuaire_sante(paths[sante_file], paths[maternites_file])
 
     # Annuaire des services d'inclusion
     # Pre-process inclusion data for faster lookup
-    annuaire_inclusion = pd.read_parquet(base_path + inclusion_file)
-    annuaire_inclusion.geometry = annuaire_inclusion.geometry.apply(shp.from_wkb)
-    annuaire_inclusion = gpd.GeoDataFrame(annuaire_inclusion, geometry='geometry', crs='EPSG:4326')
-    incl_index = annuaire_inclusion[['codgeo', 'categorie', 'service']].drop_duplicates()
-    incl_index['key'] = incl_index.categorie+'_'+incl_index.service
-    incl_index = incl_index.groupby('codgeo').agg({'key': lambda x: set(x)})
+    annuaire_inclusion = load_annuaire_inclusion(paths[inclusion_file])
+    incl_index = build_services_index(annuaire_inclusion, odis.index)
 
-    return odis, scores_cat, codfap_index, codformations_index, annuaire_ecoles, annuaire_sante, annuaire_inclusion, incl_index
+    return odis, scores_cat, codfap_index, codformations_index, annuaire_ecoles, annuaire_sante, annuaire_inclusion, incl_index, commune_index, odis_lists
 
-# --- Scoring Pipeline Functions ---
+# --- Normalization ---
 
-def add_distance_to_current_loc(df: gpd.GeoDataFrame, current_codgeo: str) -> gpd.GeoDataFrame:
+def quantile_normalize(values: np.ndarray) -> np.ndarray:
     """
-    Computes the distance from each commune in the dataframe to a reference commune.
-    
+    Normalizes each column of a 2-D block to [0, 1] according to the rank of its values, in one NumPy pass.
+
+    This reproduces sklearn's QuantileTransformer(output_distribution="uniform") fitted on each column
+    separately: tied values get the mean of their ranks, values equal to the column minimum map to 0 and
+    values equal to the maximum map to 1. NaNs are ignored when ranking and stay NaN.
+
     Args:
-        df: GeoDataFrame with commune polygons.
-        current_codgeo: The 'codgeo' of the reference commune.
+        values: Array of shape (n_communes,) or (n_communes, n_criteria).
 
     Returns:
-        GeoDataFrame with an added 'dist_current_loc' column in meters.
+        Array of the same shape with the normalized values.
     """
-    # We first need to change CRS to a projected CRS to compute distances in meters.
-    df_projected = df.to_crs(PROJECTED_CRS)
+    values = np.asarray(values, dtype='float64')
+    if values.size == 0:
+        return values.copy()
+
+    # Work on one contiguous row per criterion, sorting is much faster this way.
+    block = np.ascontiguousarray(values.reshape(len(values), -1).T)
+    n_criteria, n_rows = block.shape
+
+    order = np.argsort(block, axis=1)  # NaNs are sorted last
+    sorted_values = np.take_along_axis(block, order, axis=1)
+    n_valid = (~np.isnan(block)).sum(axis=1, keepdims=True)
+
+    # First and last sorted position of the run of tied values each value belongs to.
+    positions = np.broadcast_to(np.arange(n_rows), block.shape)
+    starts = np.ones(block.shape, dtype=bool)
+    np.not_equal(sorted_values[:, 1:], sorted_values[:, :-1], out=starts[:, 1:])
+    ends = np.ones(block.shape, dtype=bool)
+    ends[:, :-1] = starts[:, 1:]
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+    last = np.minimum.accumulate(np.where(ends, positions, n_rows - 1)[:, ::-1], axis=1)[:, ::-1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scaled = (first + last) / (2 * (n_valid - 1))
+    scaled[last >= n_valid - 1] = 1.0
+    scaled[first == 0] = 0.0  # The minimum wins for constant columns
+    scaled[positions >= n_valid] = np.nan
+
+    normalized = np.empty(block.shape)
+    np.put_along_axis(normalized, order, scaled, axis=1)
+    return normalized.T.reshape(values.shape)
 
-    # Isolate the reference commune and calculate its centroid.
-    zone_recherche = df_projected.loc[[current_codgeo]].copy()
-    zone_recherche['geometry'] = zone_recherche.centroid
-    
-    # Use sjoin_nearest to efficiently calculate the distance for all points.
-    df_with_dist = df_projected.sjoin_nearest(zone_recherche, distance_col="dist_current_loc")[['dist_current_loc']]
-    
-    # Merge the distance back to the original dataframe.
-    return df.merge(df_with_dist, left_index=True, right_index=True, how='left')
 
+# --- Scoring Pipeline Functions ---
+
+def select_search_area(df: gpd.GeoDataFrame, commune_index: CommuneIndex, current_codgeo: str, max_distance_km: float, pop_min: int) -> gpd.GeoDataFrame:
+    """
+    Selects the communes within a given distance of a reference commune and above a minimum population.
+    The distance is measured between the polygons of the communes (0 for the reference commune and its neighbors),
+    with the projected geometries and the spatial index precomputed in `commune_index`.
+
+    Args:
+        df: GeoDataFrame of all communes, in the same order as `commune_index`.
+        current_codgeo: The 'codgeo' of the reference commune.
 
-def filter_by_distance(df: pd.DataFrame, max_distance_km: float) -> pd.DataFrame:
-    """Filters a dataframe to keep only rows within a given distance."""
-    return df[df.dist_current_loc < max_distance_km * 1000].copy()
+    Returns:
+        GeoDataFrame of the search area with an added 'dist_current_loc' column in meters.
+    """
+    positions, distances = commune_index.within_distance(current_codgeo, max_distance_km * 1000)
+    df = df.iloc[positions].assign(dist_current_loc=distances)
+    return df[df.population > pop_min]
 
-def compute_criteria_scores(df: gpd.GeoDataFrame, prefs: Dict[str, Any], incl_index: pd.DataFrame, df_all_communes: gpd.GeoDataFrame) -> gpd.GeoDataFrame: 
+def compute_criteria_scores(df: gpd.GeoDataFrame, prefs: Dict[str, Any], incl_index: InvertedIndex, df_all_communes: gpd.GeoDataFrame, commune_index: CommuneIndex) -> gpd.GeoDataFrame: 
     """
     Computes individual scores for each criterion based on user preferences.
-    All scores are normalized between 0 and 1 using a QuantileTransformer.
+    All scores are normalized between 0 and 1 to a uniform distribution, in one batch with `quantile_normalize`.
+    Config-independent metrics are not recomputed: they are selected from the commune index built at load time.
+    Job, training and inclusion service matches are counted from the inverted indexes built at load time.
     """
-    df = df.copy()
-    
-    # Use QuantileTransformer to normalize scores to a uniform distribution [0, 1].
-    transformer = preprocessing.QuantileTransformer(output_distribution="uniform")
+    # Select the static metrics needed by the current preferences, for the communes of the search area only.
+    static_metrics = ['met_ratio', 'pol_num']
+    if prefs['hebergement'] == "Chez l'habitant":
+        static_metrics.append('log_5p_ratio')
+    if prefs['logement'] == "Logement Social":
+        static_metrics.append('log_soc_inoc_ratio')
+    elif prefs['logement'] == "Location":
+        static_metrics.append('log_vac_ratio')
+    if prefs['classe_enfants']:
+        static_metrics.append('risque_fermeture_ratio')
+    if not prefs['besoins_autres']:
+        static_metrics.append('svc_incl_ratio')
+    positions = commune_index.positions(df.index)
+    static = dict(zip(static_metrics, commune_index.feature_block(positions, static_metrics)))
+
+    # New columns are gathered here and added to the dataframe in a single step.
+    # Raw values of the criteria to normalize are gathered in `to_scale`, keyed by the name of their scaled column.
+    scores = {}
+    to_scale = {}
 
     # --- EMPLOI ---
-    df['met_ratio'] = 1000 * df['met'] / df['pop_be']
-    df['met_scaled'] = transformer.fit_transform(df[['met_ratio']].fillna(0))
+    scores['met_ratio'] = static['met_ratio']
+    to_scale['met_scaled'] = static['met_ratio']
     
     # Job categories that match user preferences
     for i in range(prefs['nb_adultes']):
         adult_key = f'adult{i+1}'
         if prefs['codes_metiers'][i]:
-            prefs_metiers = set(prefs['codes_metiers'][i])
-            df[f'met_match_codes_{adult_key}'] = [list(set(x).intersection(prefs_metiers)) if x is not None else [] for x in df.be_codfap_top]
-            df[f'met_match_{adult_key}'] = df[f'met_match_codes_{adult_key}'].str.len()
-            df[f'met_match_{adult_key}_scaled'] = transformer.fit_transform(df[[f'met_match_{adult_key}']].fillna(0))
+            scores[f'met_match_{adult_key}'] = commune_index.metiers.count_matches(prefs['codes_metiers'][i])[positions]
+            to_scale[f'met_match_{adult_key}_scaled'] = scores[f'met_match_{adult_key}'].astype('float')
     
     # Training centers that match
     for i in range(prefs['nb_adultes']):
         adult_key = f'adult{i+1}'
         if prefs['codes_formations'][i]:
-            prefs_formations = set(prefs['codes_formations'][i])
-            df[f'form_match_codes_{adult_key}'] = [list(set(x).intersection(prefs_formations)) if x is not None else [] for x in df.codes_formations]
-            df[f'form_match_{adult_key}'] = df[f'form_match_codes_{adult_key}'].str.len()
-            df[f'form_match_{adult_key}_scaled'] = transformer.fit_transform(df[[f'form_match_{adult_key}']].fillna(0))
+            scores[f'form_match_{adult_key}'] = commune_index.formations.count_matches(prefs['codes_formations'][i])[positions]
+            to_scale[f'form_match_{adult_key}_scaled'] = scores[f'form_match_{adult_key}'].astype('float')
 
     # --- HEBERGEMENT / LOGEMENT ---
     if prefs['hebergement'] == "Chez l'habitant":
-        df['log_5p_ratio'] = df['rp_5+pieces'] / df['log_rp']
-        df['log_5p_scaled'] = transformer.fit_transform(df[['log_5p_ratio']].fillna(0))
+        scores['log_5p_ratio'] = static['log_5p_ratio']
+        to_scale['log_5p_scaled'] = static['log_5p_ratio']
     
     if prefs['logement'] == "Logement Social":
-        df['log_soc_inoc_ratio'] = df['log_soc_inoccupes'] / df['log_soc_total'] 
-        df['log_soc_inoc_scaled'] = transformer.fit_transform(df[['log_soc_inoc_ratio']].fillna(0))
+        scores['log_soc_inoc_ratio'] = static['log_soc_inoc_ratio']
+        to_scale['log_soc_inoc_scaled'] = static['log_soc_inoc_ratio']
     elif prefs['logement'] == "Location":
-        df['log_vac_ratio'] = df['log_vac'] / df['log_total']
-        df['log_vac_scaled'] = transformer.fit_transform(df[['log_vac_ratio']].fillna(0))
+        scores['log_vac_ratio'] = static['log_vac_ratio']
+        to_scale['log_vac_scaled'] = static['log_vac_ratio']
 
     # --- EDUCATION ---
     if prefs['classe_enfants']: 
-        df['risque_fermeture_ratio'] = df['risque_fermeture'] / df['ecoles_ct']
-        df['classes_ferm_scaled'] = transformer.fit_transform(df[['risque_fermeture_ratio']].fillna(0))
+        scores['risque_fermeture_ratio'] = static['risque_fermeture_ratio']
+        to_scale['classes_ferm_scaled'] = static['risque_fermeture_ratio']
 
     # --- MOBILITE ---
     # 1. Distance from the current location 
-    df['reloc_dist_scaled'] = (1 - df['dist_current_loc'] / (prefs['loc_distance_km'] * 1000))
+    scores['reloc_dist_scaled'] = (1 - df['dist_current_loc'] / (prefs['loc_distance_km'] * 1000)).to_numpy()
     # 2. Is the commune in the same EPCI as the current one?
     # We get the EPCI from the original, unfiltered dataframe to avoid KeyErrors
     current_epci = df_all_communes.loc[prefs['commune_actuelle']]['epci_code']
-    df['reloc_epci_scaled'] = np.where(df['epci_code'] == current_epci, 1, 0)
+    scores['reloc_epci_scaled'] = np.where(df['epci_code'] == current_epci, 1, 0)
     
     # --- SOUTIEN LOCAL ---
     if prefs['besoins_autres']:
-        # Vectorized approach for 'besoins_match' - much faster than itertuples
+        # Number of the needed services available in each commune, from the services inverted index
         all_needed_services = {f"{cat}_{serv}" for cat, serv_list in prefs['besoins_autres'].items() for serv in serv_list}
-        
-        # Create a boolean mask for communes that have any of the needed services
-        # This merges the pre-calculated incl_index with our current dataframe
-        df_merged = df.join(incl_index, how='left')
-        
-        # Calculate the number of matching services for each commune
-        df['besoins_match'] = [len(all_needed_services.intersection(s)) if isinstance(s, set) else 0 for s in df_merged['key']]
-        df['besoins_match_scaled'] = transformer.fit_transform(df[['besoins_match']].fillna(0))
+        scores['besoins_match'] = incl_index.count_matches(all_needed_services)[positions]
+        to_scale['besoins_match_scaled'] = scores['besoins_match'].astype('float')
     else:
         # If no specific needs, score based on the general availability of inclusion services
-        df['svc_incl_ratio'] = 1000 * df['svc_incl_count'] / df['pop_be']
-        df['svc_incl_scaled'] = transformer.fit_transform(df[['svc_incl_ratio']].fillna(0))
+        scores['svc_incl_ratio'] = static['svc_incl_ratio']
+        to_scale['svc_incl_scaled'] = static['svc_incl_ratio']
 
     # Political orientation score
-    df['pol_scaled'] = df['pol_num'].astype('float')
-        
-    return df
-
+    scores['pol_scaled'] = static['pol_num']
 
-def add_neighbor_scores(df_search: gpd.GeoDataFrame, scores_cat: pd.DataFrame) -> pd.DataFrame:
-    """
-    Expands the dataframe to include data from neighboring communes ('voisins').
-    This creates 'binome' pairs (commune + neighbor) and 'monome' cases (commune itself).
-    """
-    # Define columns needed for binome analysis.
-    binome_columns = ['codgeo','libgeo','polygon','epci_code','epci_nom'] + scores_cat[scores_cat.incl_binome]['score'].to_list()+scores_cat[scores_cat.incl_binome]['metric'].to_list()
-    binome_columns = [col for col in binome_columns if col in df_search.columns]
-    df_binomes = df_search[binome_columns].copy()
+    # Normalize all criteria at once to a uniform distribution [0, 1], missing values counting as 0.
+    block = np.column_stack([np.where(np.isnan(values), 0, values) for values in to_scale.values()])
+    scores.update(zip(to_scale, quantile_normalize(block).T))
+        
+    return pd.concat([df.drop(columns=[col for col in scores if col in df.columns]), pd.DataFrame(scores, index=df.index)], axis=1)
 
-    # Create a series with the commune itself and its neighbors.
-    # Using .copy() on df_search prevents SettingWithCopyWarning.
-    df_search_copy = df_search.copy()
-    df_search_copy['codgeo_voisins_and_self'] = [
-        np.append(voisins, codgeo) for voisins, codgeo in zip(df_search_copy['codgeo_voisins'], df_search_copy.index)
-    ]
 
-    # Explode the dataframe to have one row per (commune, neighbor) pair.
-    df_search_exploded = df_search_copy.explode('codgeo_voisins_and_self')
-    df_search_exploded.rename(columns={'codgeo_voisins_and_self':'codgeo_binome'}, inplace=True)
-    
-    # Merge to bring in the scores of the binome commune.
-    odis_search_exploded = pd.merge(
-        df_search_exploded, 
-        df_binomes.add_suffix('_binome'), 
-        left_on='codgeo_binome', 
-        right_index=True, 
-        how='inner', 
-        validate="many_to_one"
-    )
-    
-    # Add a boolean column to identify binomes (True) vs monomes (False).
-    odis_search_exploded['binome'] = np.where(odis_search_exploded.index == odis_search_exploded.codgeo_binome, False, True)
+def binome_columns(df: pd.DataFrame, scores_cat: pd.DataFrame) -> List[str]:
+    """Columns of the binome partner that are brought next to each commune's own columns."""
+    columns = ['codgeo','libgeo','polygon','epci_code','epci_nom'] + scores_cat[scores_cat.incl_binome]['score'].to_list()+scores_cat[scores_cat.incl_binome]['metric'].to_list()
+    return [col for col in columns if col in df.columns]
 
-    return odis_search_exploded
 
-def compute_category_scores(df: pd.DataFrame, scores_cat: pd.DataFrame, binome_penalty: float) -> pd.DataFrame:
+def compute_category_scores(df: pd.DataFrame, graph: sparse.csr_matrix, scores_cat: pd.DataFrame, binome_penalty: float) -> pd.DataFrame:
     """
-    Aggregates individual criteria scores into category scores (e.g., 'emploi_cat_score').
+    Aggregates individual criteria scores into category scores (e.g., 'emploi_cat_score'), for every
+    (commune, binome partner) pair of the neighbor graph: this includes the monome case, where the partner is the commune itself.
     For binomes, it considers the max score between the commune and its neighbor, applying a penalty to the neighbor's score.
+
+    Args:
+        df: Criteria scores of the search area.
+        graph: Neighbor graph of the search area (see CommuneIndex.neighbor_graph), one stored entry per pair.
+
+    Returns:
+        A DataFrame with only the category score columns, one row per stored entry of `graph`.
     """
-    df = df.copy()
+    # Position of the commune and of its partner for each pair.
+    communes = np.repeat(np.arange(graph.shape[0]), np.diff(graph.indptr))
+    partners = graph.indices
+    binome_cols = set(binome_columns(df, scores_cat))
 
+    category_scores = pd.DataFrame(index=pd.RangeIndex(graph.nnz))
     for category in scores_cat['cat'].unique():
         # Get the list of score columns for the current category (e.g., ['met_scaled', 'met_match_adult1_scaled'])
         score_cols = scores_cat[scores_cat.cat == category]['score'].tolist()
@@ -241,21 +444,21 @@ def compute_category_scores(df: pd.DataFrame, scores_cat: pd.DataFrame, binome_p
         # This is done for all criteria in the category.
         max_scores = []
         for col in score_cols:
-            score_commune = df[col]
-            # Check if a corresponding binome score exists
-            if f'{col}_binome' in df.columns:
-                score_voisin = df[f'{col}_binome'] * (1 - binome_penalty)
-                # For monomes, the binome score is NaN, so we fill it with 0 to ensure max() works correctly.
-                # The score of the commune itself is not penalized.
-                effective_score = np.maximum(score_commune.fillna(0), score_voisin.fillna(0))
-                max_scores.append(effective_score)
-            else: # This criterion is not applicable to binomes
-                max_scores.append(score_commune.fillna(0))
+            # Missing scores count as 0 to ensure max() works correctly.
+            scores = df[col].fillna(0).to_numpy(dtype='float64')
+            score_commune = scores[communes]
+            # Check if this criterion is applicable to binomes
+            if col in binome_cols:
+                # The score of the commune itself is not penalized. For monomes, max() gives back the commune score.
+                score_voisin = scores[partners] * (1 - binome_penalty)
+                max_scores.append(np.maximum(score_commune, score_voisin))
+            else:
+                max_scores.append(score_commune)
 
         # The category score is the mean of the effective scores of its criteria.
-        df[f'{category}_cat_score'] = pd.concat(max_scores, axis=1).mean(axis=1)
+        category_scores[f'{category}_cat_score'] = np.mean(max_scores, axis=0)
     
-    return df
+    return category_scores
 
 
 def compute_weighted_score(df: pd.DataFrame, config: 'ScoringConfig') -> pd.Series:
@@ -277,55 +480,504 @@ def compute_weighted_score(df: pd.DataFrame, config: 'ScoringConfig') -> pd.Seri
             total_score += df[cat_score_col].fillna(0) * weight
             total_weight += weight
             
-    return total_score / total_weight if total_weight > 0 else 0
+    return total_score / total_weight if total_weight > 0 else pd.Series(0.0, index=df.index)
+
+
+def select_best_score_per_commune(weighted_score: pd.Series, graph: sparse.csr_matrix) -> np.ndarray:
+    """
+    For each commune, finds the best scoring result (whether it's a monome or a binome), with a row-max over the neighbor graph.
+    On ties, the monome wins: it is the first entry of each row.
+
+    Args:
+        weighted_score: Score of each stored entry of `graph`. A 2-D array (e.g. one row per household) is reduced along its last axis.
+
+    Returns:
+        For each commune (row of `graph`), the position of its best pair among the stored entries of `graph`.
+    """
+    scores = np.asarray(weighted_score, dtype='float64')
+    n_pairs = scores.shape[-1]
+    row_starts = graph.indptr[:-1]  # Never empty rows, the monome is always there
+    row_max = np.maximum.reduceat(scores, row_starts, axis=-1)
+    is_max = scores == np.repeat(row_max, np.diff(graph.indptr), axis=-1)
+    return np.minimum.reduceat(np.where(is_max, np.arange(n_pairs), n_pairs), row_starts, axis=-1)
+
+
+def add_binome_scores(df: pd.DataFrame, scores_cat: pd.DataFrame, partners: np.ndarray) -> pd.DataFrame:
+    """
+    Adds the columns of the binome partner of each commune, suffixed with '_binome' (for monomes, the partner is the commune itself).
+
+    Args:
+        df: Criteria scores of the search area.
+        partners: For each row of `df`, the position of its partner in `df`.
+    """
+    binome = df[binome_columns(df, scores_cat)].iloc[partners].add_suffix('_binome')
+    binome.index = df.index
+    binome.insert(0, 'codgeo_binome', df.index[partners])
+    binome['binome'] = partners != np.arange(len(df))
+    return pd.concat([df, pd.DataFrame(binome)], axis=1)
+
+
+def rank_results(df: pd.DataFrame, top_k: Optional[int] = None) -> pd.DataFrame:
+    """
+    Orders results by decreasing 'weighted_score'.
+
+    With `top_k`, only the `top_k` best rows are sorted and put first (selected with argpartition), the other rows
+    follow in their current order. The full O(n log n) sort is only done when it is needed, e.g. for an export.
+    """
+    scores = df['weighted_score'].to_numpy(dtype='float64')
+    if top_k is None or top_k >= len(df):
+        return df.iloc[np.argsort(-scores, kind='stable')]
+
+    top = np.argpartition(-scores, top_k)[:top_k]
+    top = top[np.lexsort((top, -scores[top]))]
+    others = np.ones(len(df), dtype=bool)
+    others[top] = False
+    return df.iloc[np.concatenate([top, np.flatnonzero(others)])]
+
+
+# --- Pipeline Stages Cache ---
+
+# ScoringConfig fields each cached stage depends on, on top of the fields of the stages before it.
+# The weights (poids_*) are not listed: they are only used by the final, never cached, stage.
+STAGE_FIELDS = {
+    'search_area': ['commune_actuelle', 'loc_distance_km', 'pop_min'],
+    'criteria': ['nb_adultes', 'hebergement', 'logement', 'codes_metiers', 'codes_formations', 'classe_enfants', 'besoins_autres'],
+    'category_scores': ['binome_penalty'],
+}
 
 
-def select_best_score_per_commune(df: pd.DataFrame) -> pd.DataFrame:
-    """For each commune, keeps only the best scoring result (whether it's a monome or a binome)."""
-    return df.sort_values('weighted_score', ascending=False).groupby('codgeo').head(1)
+def canonical_config(config: ScoringConfig) -> Dict[str, Any]:
+    """
+    Returns the config fields that affect the scores, in a hashable canonical form: configs that give the same results
+    get the same values. Codes lists are sorted and deduplicated, and only the adults of the household are kept.
+    Fields that are never used by the scoring (nb_enfants, besoin_sante) are left out.
+    """
+    def codes(codes_per_adult: List[List[str]]) -> tuple:
+        return tuple(tuple(sorted(set(adult_codes))) for adult_codes in codes_per_adult[:config.nb_adultes])
+
+    return {
+        'commune_actuelle': config.commune_actuelle,
+        'loc_distance_km': config.loc_distance_km,
+        'pop_min': config.pop_min,
+        'nb_adultes': config.nb_adultes,
+        'hebergement': config.hebergement,
+        'logement': config.logement,
+        'codes_metiers': codes(config.codes_metiers),
+        'codes_formations': codes(config.codes_formations),
+        'classe_enfants': bool(config.classe_enfants),  # Only used as a flag
+        # Categories with an empty services list are kept: any category makes the services matching replace svc_incl_ratio.
+        'besoins_autres': tuple(sorted((cat, tuple(sorted(set(services)))) for cat, services in config.besoins_autres.items())),
+        'binome_penalty': float(config.binome_penalty),
+    }
+
+
+def stage_key(config: ScoringConfig, stage: str) -> tuple:
+    """Returns the cache key of a stage: the canonical values of all the config fields it depends on."""
+    canonical = canonical_config(config)
+    fields = []
+    for name, stage_fields in STAGE_FIELDS.items():
+        fields += stage_fields
+        if name == stage:
+            break
+    return (stage,) + tuple(canonical[field] for field in fields)
+
+
+def result_key(config: ScoringConfig) -> tuple:
+    """
+    Returns the cache key of the final result: the key of the last cached stage and the weights.
+    Negative weights count as 0, and the weights of the categories that cannot be scored with this config are left out.
+    """
+    weights = {category: max(getattr(config, f'poids_{category}'), 0) for category in ['emploi', 'logement', 'education', 'inclusion', 'mobilité']}
+    if not config.classe_enfants:
+        del weights['education']
+    if config.hebergement != "Chez l'habitant" and config.logement not in ("Logement Social", "Location"):
+        del weights['logement']
+    return ('result',) + stage_key(config, 'category_scores')[1:] + tuple(weights.items())
+
+
+class StageCache:
+    """
+    Thread-safe LRU cache of the intermediate results of the scoring pipeline, shared by all sessions and bounded by a
+    memory budget (the size of each entry is measured once, with memory.nbytes).
+    A StageCache must only be used with a single dataset: the keys do not identify the data.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: tuple, compute: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+
+        # Computed outside of the lock so that other sessions are not blocked
+        value = compute()
+        size = nbytes(value) or 0
+        if size > self.max_bytes:
+            return value
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = (value, size)
+                self._nbytes += size
+            self._entries.move_to_end(key)
+            while self._nbytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._nbytes -= evicted
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the current size of the cache."""
+        with self._lock:
+            return {'entries': len(self._entries), 'nbytes': self._nbytes}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+
+def _run_stage(stage_cache: Optional[StageCache], stage: str, config: ScoringConfig, compute: Callable[[], Any]) -> Any:
+    if stage_cache is None:
+        return compute()
+    return stage_cache.get_or_compute(stage_key(config, stage), compute)
+
+
+# --- Result Cache ---
+
+@dataclass
+class CompactResult:
+    """
+    Result of compute_odis_score stored without geometries nor any column of the original table:
+    communes are kept as positions in the original table and are joined back when the result is read.
+    """
+    positions: np.ndarray  # Position of each result commune in the original table
+    partners: np.ndarray  # Position of the binome partner of each commune in `positions` (itself for monomes)
+    scores: Dict[str, np.ndarray]  # Columns added by the search area and criteria stages
+    best: Dict[str, np.ndarray]  # Category scores and weighted score of the best pair of each commune
+
+    @property
+    def nbytes(self) -> int:
+        arrays = [self.positions, self.partners, *self.scores.values(), *self.best.values()]
+        return sum(array.nbytes for array in arrays)
+
+
+def with_polygons(df: pd.DataFrame, polygons, positions: np.ndarray) -> gpd.GeoDataFrame:
+    """
+    Adds their 'polygon' geometry to rows of a commune table loaded without polygons (see snapshot.py).
+
+    Args:
+        polygons: The polygons of the full table, decoded or in a GeometryBuffer: only the selected ones are decoded.
+        positions: The positions of the rows of `df` in the full table.
+    """
+    return gpd.GeoDataFrame(df.assign(polygon=polygons[positions]), geometry='polygon', crs=ODIS_CRS)
+
+
+def expand_result(result: CompactResult, df_original: gpd.GeoDataFrame, scores_cat: pd.DataFrame, polygons=None) -> pd.DataFrame:
+    """Rebuilds the full result DataFrame of compute_odis_score from a CompactResult."""
+    df = df_original.iloc[result.positions]
+    if polygons is not None:
+        df = with_polygons(df, polygons, result.positions)
+    df = pd.concat([df, pd.DataFrame(result.scores, index=df.index)], axis=1)
+    df = add_binome_scores(df, scores_cat, partners=result.partners)
+    return pd.concat([df, pd.DataFrame(result.best, index=df.index)], axis=1)
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache of the results of compute_odis_score, shared by all sessions and bounded by a memory budget.
+    Results are stored as CompactResult, keyed by the canonical form of the config (see result_key).
+    Like StageCache, a ResultCache must only be used with a single dataset.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: tuple, compute: Callable[[], CompactResult]) -> CompactResult:
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+
+        # Computed outside of the lock so that other sessions are not blocked
+        value = compute()
+        if value.nbytes > self.max_bytes:
+            return value
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = value
+                self._nbytes += value.nbytes
+            self._entries.move_to_end(key)
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+                self.evictions += 1
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the counters of the cache and its current size."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'nbytes': self._nbytes}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
 
 
 # --- Main Orchestration Function ---
 
-def compute_odis_score(df_original: gpd.GeoDataFrame, scores_cat: pd.DataFrame, config: 'ScoringConfig', incl_index: pd.DataFrame) -> pd.DataFrame:
+def compute_odis_score(df_original: gpd.GeoDataFrame, scores_cat: pd.DataFrame, config: 'ScoringConfig', incl_index: InvertedIndex, commune_index: CommuneIndex,
+                       stage_cache: Optional[StageCache] = None, result_cache: Optional[ResultCache] = None, polygons=None) -> pd.DataFrame:
     """
     Main function that orchestrates the entire scoring pipeline.
+
+    The pipeline is split into stages (see STAGE_FIELDS). When a `stage_cache` is given, each stage is reused
+    as long as the config fields it depends on do not change: moving the weight sliders only reruns steps 6 to 8.
+    When a `result_cache` is given, the final result is reused for any config with the same canonical form.
     
     Args:
         df_original: The base GeoDataFrame of all communes, unfiltered.
         scores_cat: DataFrame defining scores and their categories.
         config: ScoringConfig object with user preferences.
-        incl_index: Pre-processed DataFrame for inclusion services lookup.
+        incl_index: Inverted index of the inclusion services available in each commune.
+        commune_index: Config-independent metrics precomputed at load time.
+        stage_cache: Optional cache of the intermediate results, built for `df_original`.
+        result_cache: Optional cache of the final results, built for `df_original`.
+        polygons: The polygons of `df_original` when it is loaded without them (see with_polygons).
 
     Returns:
         A DataFrame with the best score for each commune in the search area.
     """
-    # Make a copy to avoid modifying the original cached dataframe
-    df = df_original.copy()
+    def compute() -> CompactResult:
+        def search_area():
+            # 1-3. Keep the communes above the minimum population within the max distance of the user's current location.
+            df = select_search_area(df_original, commune_index, config.commune_actuelle, max_distance_km=config.loc_distance_km, pop_min=config.pop_min)
+
+            # Get the neighbor graph of the search area (monomes and binomes).
+            return df, commune_index.neighbor_graph(commune_index.positions(df.index))
 
-    # 1. Filter communes by minimum population
-    df = df[df.population > config.pop_min]
+        odis_search, graph = _run_stage(stage_cache, 'search_area', config, search_area)
 
-    # 2. Add distance from the user's current location
-    df = add_distance_to_current_loc(df, current_codgeo=config.commune_actuelle)
+        # 4. Compute all individual criteria scores based on preferences.
+        odis_scored = _run_stage(stage_cache, 'criteria', config,
+                                 lambda: compute_criteria_scores(odis_search, prefs=config.__dict__, incl_index=incl_index, df_all_communes=df_original, commune_index=commune_index))
 
-    # 3. Filter by max distance to create the primary search area
-    odis_search = filter_by_distance(df, max_distance_km=config.loc_distance_km)
+        # 5. Aggregate criteria scores into category scores for every commune/binome pair, handling the binome logic.
+        category_scores = _run_stage(stage_cache, 'category_scores', config,
+                                     lambda: compute_category_scores(odis_scored, graph, scores_cat=scores_cat, binome_penalty=config.binome_penalty))
 
-    # 4. Compute all individual criteria scores based on preferences.
-    odis_scored = compute_criteria_scores(odis_search, prefs=config.__dict__, incl_index=incl_index, df_all_communes=df_original)
+        # 6. Compute the final weighted score for each commune/binome pair.
+        weighted_score = compute_weighted_score(category_scores, config=config)
 
-    # 5. Expand the dataframe to include neighbor data (creating monomes and binomes).
-    odis_exploded = add_neighbor_scores(odis_scored, scores_cat)
+        # 7. For each commune, keep only the best result (could be monome or a binome).
+        best_pairs = select_best_score_per_commune(weighted_score, graph)
 
-    # 6. Aggregate criteria scores into category scores, handling the binome logic.
-    odis_exploded = compute_category_scores(odis_exploded, scores_cat=scores_cat, binome_penalty=config.binome_penalty)
+        # 8. Keep the scores of the best pair and the binome partner. The cached stages are never modified,
+        # only the computed columns are copied out of them: the original columns are joined back by expand_result.
+        best = {col: category_scores[col].to_numpy()[best_pairs] for col in category_scores.columns}
+        best['weighted_score'] = weighted_score.to_numpy()[best_pairs]
+        return CompactResult(
+            positions=commune_index.positions(odis_scored.index).astype('int32'),
+            partners=graph.indices[best_pairs].astype('int32'),
+            scores={col: odis_scored[col].to_numpy() for col in odis_scored.columns if col not in df_original.columns},
+            best=best,
+        )
 
-    # 7. Compute the final weighted score for each commune/binome pair.
-    odis_exploded['weighted_score'] = compute_weighted_score(odis_exploded, config=config)
+    result = compute() if result_cache is None else result_cache.get_or_compute(result_key(config), compute)
+    return expand_result(result, df_original, scores_cat, polygons)
 
-    # 8. For each commune, keep only the best result (could be monome or a binome).
-    odis_search_best = select_best_score_per_commune(odis_exploded)
 
-    return odis_search_best
+# --- Batch Scoring ---
+
+# Scaled criteria that only depend on the commune, with the static metric they are normalized from.
+STATIC_CRITERIA = {
+    'met_scaled': 'met_ratio',
+    'log_5p_scaled': 'log_5p_ratio',
+    'log_soc_inoc_scaled': 'log_soc_inoc_ratio',
+    'log_vac_scaled': 'log_vac_ratio',
+    'classes_ferm_scaled': 'risque_fermeture_ratio',
+    'svc_incl_scaled': 'svc_incl_ratio',
+}
+BATCH_BLOCK_SIZE = 2**22  # Max number of (household, commune/binome pair) scores held at once per category
+
+
+def household_criteria(config: ScoringConfig, incl_index: InvertedIndex, commune_index: CommuneIndex) -> tuple:
+    """
+    Lists the criteria a household is scored on, following the same rules as compute_criteria_scores.
+
+    Returns:
+        The names of the criteria shared by all households of a search area, and a dict of the criteria
+        specific to this household (job, training and services matches) with their match counts for every commune.
+    """
+    shared = ['met_scaled']
+    own = {}
+    for i in range(config.nb_adultes):
+        if config.codes_metiers[i]:
+            own[f'met_match_adult{i+1}_scaled'] = commune_index.metiers.count_matches(config.codes_metiers[i])
+        if config.codes_formations[i]:
+            own[f'form_match_adult{i+1}_scaled'] = commune_index.formations.count_matches(config.codes_formations[i])
+    if config.hebergement == "Chez l'habitant":
+        shared.append('log_5p_scaled')
+    if config.logement == "Logement Social":
+        shared.append('log_soc_inoc_scaled')
+    elif config.logement == "Location":
+        shared.append('log_vac_scaled')
+    if config.classe_enfants:
+        shared.append('classes_ferm_scaled')
+    shared += ['reloc_dist_scaled', 'reloc_epci_scaled', 'pol_scaled']
+    if config.besoins_autres:
+        needed_services = {f"{cat}_{serv}" for cat, serv_list in config.besoins_autres.items() for serv in serv_list}
+        own['besoins_match_scaled'] = incl_index.count_matches(needed_services)
+    else:
+        shared.append('svc_incl_scaled')
+    return shared, own
+
+
+def _score_households(configs: List[ScoringConfig], positions: np.ndarray, graph: sparse.csr_matrix, shared: Dict[str, np.ndarray],
+                      scores_cat: pd.DataFrame, incl_index: InvertedIndex, commune_index: CommuneIndex) -> tuple:
+    """
+    Scores every (commune, binome partner) pair of a search area for several households at once.
+    Criteria are summed into (household, pair) matrices category by category, in the order of `scores_cat`, so that
+    the results are the same as compute_category_scores and compute_weighted_score for each household alone.
+
+    Returns:
+        The weighted scores, shape (n_households, graph.nnz), and a dict of the category scores with the same shape
+        (NaN for the households not scored on the category).
+    """
+    communes = np.repeat(np.arange(graph.shape[0]), np.diff(graph.indptr))
+    partners = graph.indices
+    penalties = np.array([config.binome_penalty for config in configs], dtype='float64')
+    binome_criteria = set(scores_cat[scores_cat.incl_binome]['score'])
+
+    # Criteria of each household. Its own match counts are normalized in one batch for all households.
+    criteria = [household_criteria(config, incl_index, commune_index) for config in configs]
+    used = [set(shared_names) | set(own) for shared_names, own in criteria]
+    own_names = [(h, name) for h, (_, own) in enumerate(criteria) for name in own]
+    own_values = {}
+    if own_names:
+        counts = np.column_stack([criteria[h][1][name][positions].astype('float') for h, name in own_names])
+        own_values = dict(zip(own_names, quantile_normalize(counts).T))
+
+    weighted = np.zeros((len(configs), graph.nnz))
+    total_weight = np.zeros(len(configs))
+    category_scores = {}
+    for category in scores_cat['cat'].unique():
+        category_sum = np.zeros((len(configs), graph.nnz))
+        count = np.zeros(len(configs))
+        for criterion in scores_cat[scores_cat.cat == category]['score']:
+            users = np.array([criterion in names for names in used])
+            if not users.any():
+                continue
+            if criterion in shared:
+                values = shared[criterion][np.newaxis, :]
+            else:
+                values = np.stack([own_values[(h, criterion)] for h in np.flatnonzero(users)])
+            effective = values[:, communes]
+            if criterion in binome_criteria:
+                effective = np.maximum(effective, values[:, partners] * (1 - penalties[users, np.newaxis]))
+            category_sum[users] += effective
+            count[users] += 1
+
+        with np.errstate(invalid='ignore'):
+            category_scores[f'{category}_cat_score'] = category_sum / count[:, np.newaxis]
+        weights = np.array([getattr(config, f'poids_{category}', 0) for config in configs], dtype='float64')
+        weights = np.maximum(weights, 0)  # Negative weights count as 0, as in compute_weighted_score
+        weights[count == 0] = 0
+        weighted += np.where(weights[:, np.newaxis] > 0, category_scores[f'{category}_cat_score'] * weights[:, np.newaxis], 0)
+        total_weight += weights
+
+    with np.errstate(invalid='ignore'):
+        weighted = np.where(total_weight[:, np.newaxis] > 0, weighted / total_weight[:, np.newaxis], 0.0)
+    return weighted, category_scores
+
+
+def compute_odis_score_batch(df_original: gpd.GeoDataFrame, scores_cat: pd.DataFrame, configs: List[ScoringConfig], incl_index: InvertedIndex,
+                             commune_index: CommuneIndex, top_n: int = TOP_N_RESULTS) -> pd.DataFrame:
+    """
+    Scores many households in one pass and returns the best communes of each one, e.g. for the placement proposals of a cohort.
+
+    Households are grouped by search area (current commune, max distance and min population): the search area,
+    its neighbor graph and the shared criteria are computed once per group, and the household-specific steps
+    are matrix operations over the households of the group. Scores are the same as compute_odis_score, but the
+    current commune of each household is removed from its results: they match rank_results on the output of
+    compute_odis_score without the row of the current commune.
+
+    Args:
+        df_original: The base GeoDataFrame of all communes, unfiltered.
+        scores_cat: DataFrame defining scores and their categories.
+        configs: One ScoringConfig per household.
+        incl_index: Inverted index of the inclusion services available in each commune.
+        commune_index: Config-independent metrics precomputed at load time.
+        top_n: Number of results kept per household.
+
+    Returns:
+        A tidy DataFrame with one row per (household, result): 'household' (position in `configs`), 'rank',
+        the commune and its binome partner, the weighted score and the category scores. The current commune
+        of each household is never proposed.
+    """
+    groups = {}
+    for h, config in enumerate(configs):
+        groups.setdefault((config.commune_actuelle, config.loc_distance_km, config.pop_min), []).append(h)
+
+    results = []
+    for (commune_actuelle, loc_distance_km, pop_min), households in groups.items():
+        area = select_search_area(df_original, commune_index, commune_actuelle, max_distance_km=loc_distance_km, pop_min=pop_min)
+        positions = commune_index.positions(area.index)
+        graph = commune_index.neighbor_graph(positions)
+
+        # Criteria shared by all the households of the group, see compute_criteria_scores
+        metrics = commune_index.feature_block(positions, list(STATIC_CRITERIA.values()))
+        shared = dict(zip(STATIC_CRITERIA, quantile_normalize(np.where(np.isnan(metrics), 0, metrics).T).T))
+        shared['pol_scaled'] = commune_index.feature_block(positions, ['pol_num'])[0]
+        shared['reloc_dist_scaled'] = 1 - area['dist_current_loc'].to_numpy() / (loc_distance_km * 1000)
+        current_epci = df_original.loc[commune_actuelle, 'epci_code']
+        shared['reloc_epci_scaled'] = np.where(area['epci_code'] == current_epci, 1, 0)
+        # Missing scores count as 0, as in compute_category_scores
+        shared = {name: np.nan_to_num(values.astype('float64'), nan=0.0) for name, values in shared.items()}
+
+        # Households are scored by chunks to bound the size of the (household, pair) matrices.
+        candidates = area.index != commune_actuelle
+        k = min(top_n, int(candidates.sum()))
+        chunk_size = max(1, BATCH_BLOCK_SIZE // max(graph.nnz, 1))
+        for start in range(0, len(households) if k > 0 else 0, chunk_size):
+            chunk = households[start:start + chunk_size]
+            weighted, category_scores = _score_households([configs[h] for h in chunk], positions, graph, shared,
+                                                          scores_cat, incl_index, commune_index)
+
+            # Best pair of each commune, then the top k communes of each household
+            best_pairs = select_best_score_per_commune(weighted, graph)
+            best_scores = np.where(candidates, np.take_along_axis(weighted, best_pairs, axis=1), -np.inf)
+            top = np.sort(np.argpartition(-best_scores, k - 1, axis=1)[:, :k], axis=1)
+            top = np.take_along_axis(top, np.argsort(-np.take_along_axis(best_scores, top, axis=1), axis=1, kind='stable'), axis=1)
+            top_pairs = np.take_along_axis(best_pairs, top, axis=1)
+            partners = graph.indices[top_pairs]
+
+            result = pd.DataFrame({
+                'household': np.repeat(chunk, k),
+                'rank': np.tile(np.arange(1, k + 1), len(chunk)),
+                'codgeo': area.index[top.ravel()],
+                'libgeo': area['libgeo'].to_numpy()[top.ravel()],
+                'codgeo_binome': area.index[partners.ravel()],
+                'libgeo_binome': area['libgeo'].to_numpy()[partners.ravel()],
+                'binome': (partners != top).ravel(),
+                'weighted_score': np.take_along_axis(weighted, top_pairs, axis=1).ravel(),
+            })
+            for name, values in category_scores.items():
+                result[name] = np.take_along_axis(values, top_pairs, axis=1).ravel()
+            results.append(result)
+
+    if not results:
+        return pd.DataFrame(columns=['household', 'rank', 'codgeo', 'libgeo', 'codgeo_binome', 'libgeo_binome', 'binome', 'weighted_score'])
+    return pd.concat(results, ignore_index=True).sort_values(['household', 'rank'], ignore_index=True)
 # THIS SHOULD BE THE END OF JUPYTER NOTEBOOK EXPORT
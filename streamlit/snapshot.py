@@ -0,0 +1,300 @@
+"""
+Compiled snapshot of all the datasets of the app, for a fast cold start.
+
+The snapshot is compiled offline from the source files: all the preprocessing of `load_all_datasets` (WKB decoding,
+FINESS geometries, maternity merge, indexes) is done once, and its results are written as uncompressed Arrow IPC
+tables and NumPy arrays. A manifest records the format version and the checksums of the source files the snapshot
+was compiled from.
+
+Each compilation writes its files to a new directory of the snapshot (`<compiled at>-<checksum>/`), then publishes them
+by replacing the manifest, which points to that directory: the manifest always describes a complete set of files, never
+a mix of two compilations, even during an interrupted compilation. The directory of the previous compilation is kept,
+for the apps still loading it, and the older ones are deleted.
+
+The app memory-maps the tables and arrays read-only instead of loading them: several server processes on the same
+host reading the same snapshot share a single copy of the data in the page cache. The polygons of the communes are
+kept as WKB buffers with offsets (GeometryBuffer), and only the polygons used by a search are decoded, like their
+simplified levels drawn on the map (see scoring.simplify_polygons) and the polygons of the areas (EPCI, départements)
+the map shows the scores by at low zoom (see scoring.build_map_areas). The bounding boxes of the communes select the
+ones in view without decoding any polygon. The directories (schools, health, inclusion services) are only stored as
+the points of the map overlays, grouped by commune (see indexes.PointIndex), and are memory-mapped like the other tables.
+
+    python snapshot.py compile   # Compiles the sources of get_data_path() to get_data_path() + SNAPSHOT_DIR
+    python snapshot.py check     # Checks that the snapshot is up to date with the sources
+"""
+import argparse
+import hashlib
+import json
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, Tuple
+
+import fsspec
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyarrow as pa
+
+import config as cfg
+from datastore import open_store
+from indexes import AreaPolygons, CommuneIndex, GeometryBuffer, InvertedIndex, ListColumn, PointIndex, RowRanges, build_services_rows
+from scoring import ODIS_LIST_COLUMNS, build_map_areas, ecoles_points, inclusion_catalog, inclusion_points, load_all_datasets, sante_points, simplify_polygons
+
+# Increment when the content or the layout of the snapshot changes: snapshots of other versions are not loaded.
+SNAPSHOT_FORMAT_VERSION = 10
+
+# Source files, in the order of the arguments of load_all_datasets
+SOURCE_FILES = [cfg.ODIS_FILE, cfg.SCORES_CAT_FILE, cfg.METIERS_FILE, cfg.FORMATIONS_FILE,
+                cfg.ECOLES_FILE, cfg.MATERNITE_FILE, cfg.SANTE_FILE, cfg.INCLUSION_FILE]
+
+# Tables returned by load_all_datasets, in order. They are followed by the indexes and the list columns of the communes.
+DATASET_TABLES = ['odis', 'scores_cat', 'codfap_index', 'codformations_index', 'annuaire_ecoles', 'annuaire_sante', 'annuaire_inclusion']
+# Points of the directories shown by the map overlays (PointIndexes): the directories are only stored this way
+POINT_TABLES = ['ecoles_points', 'sante_points', 'inclusion_points']
+# All the tables of the snapshot. The odis table is written without its polygons, stored in the 'odis_polygons' arrays.
+# The 'inclusion_by_commune' and POINT_TABLES tables hold the rows of RowRanges, their offsets are in the arrays.
+TABLES = ['odis', 'scores_cat', 'codfap_index', 'codformations_index', 'inclusion_services', 'inclusion_by_commune'] + POINT_TABLES
+# Source files each table is compiled from, directly or through the odis table
+TABLE_SOURCES = {
+    'odis': [cfg.ODIS_FILE],
+    'scores_cat': [cfg.SCORES_CAT_FILE],
+    'codfap_index': [cfg.METIERS_FILE],
+    'codformations_index': [cfg.FORMATIONS_FILE],
+    'inclusion_services': [cfg.INCLUSION_FILE],
+    'inclusion_by_commune': [cfg.INCLUSION_FILE, cfg.ODIS_FILE],
+    'ecoles_points': [cfg.ECOLES_FILE],
+    'sante_points': [cfg.SANTE_FILE, cfg.MATERNITE_FILE],
+    'inclusion_points': [cfg.INCLUSION_FILE],
+}
+ARRAYS_DIR = 'arrays/'
+MANIFEST_FILE = 'manifest.json'
+# Directories of the compilations kept in the snapshot: the published one and the previous one
+KEPT_COMPILATIONS = 2
+
+
+# --- Checksums ---
+
+def file_checksum(path: str) -> str:
+    """Returns the SHA-256 of a local or remote (e.g. gs://) file."""
+    digest = hashlib.sha256()
+    with fsspec.open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sources_checksums(base_path: str) -> Dict[str, str]:
+    """Returns the checksum of each source file."""
+    return {file: file_checksum(base_path + file) for file in SOURCE_FILES}
+
+
+def combined_checksum(checksums: Dict[str, str]) -> str:
+    """Returns a single checksum identifying a set of source files."""
+    return hashlib.sha256(json.dumps(checksums, sort_keys=True).encode()).hexdigest()
+
+
+# --- Compile ---
+
+def compile_snapshot(base_path: str, snapshot_path: str) -> dict:
+    """
+    Loads and preprocesses the source files of `base_path`, and writes the snapshot to `snapshot_path`.
+    The files are written to a new directory, published by the manifest written last: an interrupted compilation
+    leaves the previous snapshot as it was.
+
+    Returns:
+        The manifest of the snapshot.
+    """
+    # Checksums are computed first: a source updated during the compilation makes the snapshot outdated, not wrong.
+    checksums = sources_checksums(base_path)
+    datasets = load_all_datasets(*SOURCE_FILES, store=open_store(base_path))
+    tables = dict(zip(DATASET_TABLES, datasets))
+    tables['inclusion_services'] = inclusion_catalog(tables['annuaire_inclusion'])
+    incl_index, commune_index, odis_lists = datasets[len(DATASET_TABLES):]
+
+    odis = tables['odis']
+    tables['odis'] = pd.DataFrame(odis.drop(columns=odis.geometry.name))
+    services_rows = build_services_rows(tables['annuaire_inclusion'], odis.index)
+    tables['inclusion_by_commune'] = services_rows.rows
+    points = {
+        'ecoles_points': ecoles_points(tables.pop('annuaire_ecoles')),
+        'sante_points': sante_points(tables.pop('annuaire_sante')),
+        'inclusion_points': inclusion_points(tables.pop('annuaire_inclusion')),
+    }
+    tables.update({name: index.points.rows for name, index in points.items()})
+    map_polygons = simplify_polygons(np.asarray(odis.geometry.values), cfg.MAP_SIMPLIFY_TOLERANCES)
+    map_areas = build_map_areas(odis, map_polygons)
+    arrays = {
+        **commune_index.to_arrays(),
+        **incl_index.to_arrays('incl'),
+        **services_rows.to_arrays('inclusion_by_commune'),
+        **{key: array for name, index in points.items() for key, array in index.to_arrays(name).items()},
+        **GeometryBuffer.from_geometries(odis.geometry.values).to_arrays('odis_polygons'),
+        'odis_bounds': odis.geometry.bounds.to_numpy(),
+        **{key: array for column, areas in map_areas.items() for key, array in areas.to_arrays(f'areas_{column}').items()},
+        **{key: array for name, column in odis_lists.items() for key, array in column.to_arrays(f'list_{name}').items()},
+        **{key: array for level, polygons in enumerate(map_polygons.values())
+           for key, array in GeometryBuffer.from_geometries(polygons).to_arrays(f'map_polygons_{level}').items()},
+    }
+
+    compiled_at = datetime.now(timezone.utc)
+    checksum = combined_checksum(checksums)
+    manifest = {
+        'format_version': SNAPSHOT_FORMAT_VERSION,
+        'directory': f"{compiled_at.strftime('%Y%m%dT%H%M%S')}-{checksum[:12]}/",
+        'checksum': checksum,
+        'sources': checksums,
+        'geo_tables': [name for name, table in tables.items() if isinstance(table, gpd.GeoDataFrame)],
+        'arrays': sorted(arrays),
+        'map_tolerances': list(map_polygons),
+        'map_areas': list(map_areas),
+        'point_flags': {name: index.flag_names for name, index in points.items()},
+        'compiled_at': compiled_at.isoformat(timespec='seconds'),
+    }
+
+    # The files of a compilation are never overwritten: running apps keep reading the directory of their manifest
+    fs, root = fsspec.core.url_to_fs(snapshot_path)
+    fs.makedirs(f"{root}/{manifest['directory']}{ARRAYS_DIR}", exist_ok=True)
+    for name, table in tables.items():
+        with fs.open(f'{root}/{table_file(name, manifest)}', 'wb') as f:
+            write_table(f, table)
+    for name, array in arrays.items():
+        with fs.open(f'{root}/{array_file(name, manifest)}', 'wb') as f:
+            np.save(f, array)
+
+    # Published last, by replacing the manifest file (a rename, or a single object copy on GCS): readers get the
+    # previous manifest or this one, both complete
+    with fs.open(f'{root}/{MANIFEST_FILE}.tmp', 'wb') as f:
+        f.write(json.dumps(manifest, indent=2).encode())
+    fs.mv(f'{root}/{MANIFEST_FILE}.tmp', f'{root}/{MANIFEST_FILE}')
+    prune_compilations(fs, root, manifest)
+    return manifest
+
+
+def prune_compilations(fs, root: str, manifest: dict):
+    """Deletes the directories of the compilations of the snapshot older than the KEPT_COMPILATIONS last ones."""
+    directories = sorted(entry['name'].rstrip('/').rsplit('/', 1)[-1] for entry in fs.ls(root, detail=True) if entry['type'] == 'directory')
+    compilations = [name for name in directories if name[:8].isdigit() and name <= manifest['directory'].rstrip('/')]
+    for name in compilations[:-KEPT_COMPILATIONS]:
+        fs.rm(f'{root}/{name}', recursive=True)
+
+
+# --- Load ---
+
+def table_file(name: str, manifest: dict) -> str:
+    """File of one of the TABLES, in the snapshot directory, for the compilation of `manifest`."""
+    return f"{manifest['directory']}{name}.arrow"
+
+
+def array_file(name: str, manifest: dict) -> str:
+    """File of one of the arrays listed in the manifest, in the snapshot directory, for the compilation of `manifest`."""
+    return f"{manifest['directory']}{ARRAYS_DIR}{name}.npy"
+
+
+def write_table(f, table: pd.DataFrame):
+    """Writes a table as an uncompressed Arrow IPC file, so that it can be memory-mapped. Geometries are encoded as WKB."""
+    if isinstance(table, gpd.GeoDataFrame):
+        table.to_feather(f, compression='uncompressed')
+    else:
+        arrow_table = pa.Table.from_pandas(table)
+        # NaNs are kept as float values instead of nulls: columns without nulls are mapped without any copy
+        for i, field in enumerate(arrow_table.schema):
+            if pa.types.is_floating(field.type) and arrow_table.column(i).null_count:
+                arrow_table = arrow_table.set_column(i, field, pa.array(table[field.name].to_numpy(), from_pandas=False))
+        with pa.ipc.new_file(f, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+
+
+def read_manifest(path: str) -> dict:
+    """
+    Reads the manifest file of a snapshot.
+
+    Raises:
+        FileNotFoundError: There is no snapshot.
+        ValueError: The snapshot was compiled with another format version.
+    """
+    with fsspec.open(path, 'r') as f:
+        manifest = json.load(f)
+    if manifest['format_version'] != SNAPSHOT_FORMAT_VERSION:
+        raise ValueError(f"Snapshot format version {manifest['format_version']} is not supported (expected {SNAPSHOT_FORMAT_VERSION})")
+    return manifest
+
+
+def read_table(path: str, manifest: dict, name: str) -> pd.DataFrame:
+    """
+    Reads the file of one of the TABLES of a snapshot, from a local `path`.
+    Tables without geometries are memory-mapped: their numeric and string columns are not copied (strings are
+    backed by Arrow from pandas 3, earlier versions would copy them into Python objects).
+    """
+    if name in manifest['geo_tables']:
+        return gpd.read_feather(path)
+    return pa.ipc.open_file(pa.memory_map(path)).read_all().to_pandas(split_blocks=True)
+
+
+def read_arrays(paths: Dict[str, str]) -> Dict[str, np.ndarray]:
+    """Memory-maps the arrays of a snapshot read-only, from their local `paths` by name."""
+    return {name: np.load(path, mmap_mode='r') for name, path in paths.items()}
+
+
+def read_indexes(arrays: Dict[str, np.ndarray], odis: pd.DataFrame) -> Tuple[InvertedIndex, CommuneIndex, Dict[str, ListColumn], GeometryBuffer]:
+    """
+    Rebuilds the indexes of a snapshot from its arrays, for its `odis` table, without copying the arrays.
+
+    Returns:
+        The inclusion services index, the commune index, the list columns and the polygons of the communes.
+    """
+    odis_lists = {name: ListColumn.from_arrays(arrays, f'list_{name}') for name in ODIS_LIST_COLUMNS if f'list_{name}_offsets' in arrays}
+    return (InvertedIndex.from_arrays(arrays, 'incl', len(odis)), CommuneIndex.from_arrays(arrays, odis.index, decode_polygons=False),
+            odis_lists, GeometryBuffer.from_arrays(arrays, 'odis_polygons'))
+
+
+def read_row_ranges(arrays: Dict[str, np.ndarray], rows: pd.DataFrame, name: str) -> RowRanges:
+    """Rebuilds a RowRanges of a snapshot from its `rows` table and its offsets, e.g. 'inclusion_by_commune'."""
+    return RowRanges.from_arrays(arrays, name, rows)
+
+
+def read_map_areas(arrays: Dict[str, np.ndarray], manifest: dict) -> Dict[str, AreaPolygons]:
+    """Returns the polygons of the areas the map aggregates the communes by, by column (see scoring.build_map_areas)."""
+    return {column: AreaPolygons.from_arrays(arrays, f'areas_{column}', manifest['map_tolerances']) for column in manifest['map_areas']}
+
+
+def read_point_index(arrays: Dict[str, np.ndarray], rows: pd.DataFrame, manifest: dict, name: str) -> PointIndex:
+    """Rebuilds one of the POINT_TABLES of a snapshot as a PointIndex, from its `rows` table and its arrays."""
+    return PointIndex.from_arrays(arrays, name, rows, manifest['point_flags'][name])
+
+
+def read_map_polygons(arrays: Dict[str, np.ndarray], manifest: dict) -> Dict[float, GeometryBuffer]:
+    """Returns the simplified levels of the commune polygons of a snapshot, by tolerance (see scoring.simplify_polygons)."""
+    return {tolerance: GeometryBuffer.from_arrays(arrays, f'map_polygons_{level}') for level, tolerance in enumerate(manifest['map_tolerances'])}
+
+
+# --- Command line ---
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['compile', 'check'])
+    parser.add_argument('--out', default=None, help='Snapshot directory (default: get_data_path() + SNAPSHOT_DIR)')
+    args = parser.parse_args()
+
+    base_path = cfg.get_data_path()
+    snapshot_path = (args.out.rstrip('/') + '/') if args.out else base_path + cfg.SNAPSHOT_DIR
+
+    if args.command == 'compile':
+        start = time.perf_counter()
+        manifest = compile_snapshot(base_path, snapshot_path)
+        print(f"Compiled snapshot {manifest['checksum'][:12]} to {snapshot_path} in {time.perf_counter() - start:.1f} s")
+    else:
+        expected = combined_checksum(sources_checksums(base_path))
+        try:
+            manifest = read_manifest(snapshot_path + MANIFEST_FILE)
+        except (FileNotFoundError, ValueError) as e:
+            print(f"No usable snapshot in {snapshot_path} ({e}): run `python snapshot.py compile`")
+            sys.exit(1)
+        if manifest['checksum'] != expected:
+            print(f"Snapshot {manifest['checksum'][:12]} is outdated: run `python snapshot.py compile`")
+            sys.exit(1)
+        print(f"Snapshot {manifest['checksum'][:12]} is up to date")
+
+
+if __name__ == '__main__':
+    main()
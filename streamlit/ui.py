@@ -1,10 +1,9 @@
 # /home/jacques/odis/13_odis/eda/streamlit/ui.py
 import streamlit as st
 import pandas as pd
-from plotly.express import line_polar
 
 import config as cfg
-import maps
+# maps (folium) and plotly are imported by the functions using them: they are not needed before a search
 
 def display_sidebar(demo_data: dict):
     """Displays the sidebar with location and weight controls."""
@@ -103,9 +102,9 @@ def display_input_tabs(demo_data: dict):
         st.text("Sélectionnez d'autres besoins:")
         col1, col2 = st.columns(2)
         with col1:
-            annuaire_inclusion = app_data['annuaire_inclusion']
-            cat = st.selectbox('Catégorie', sorted(set(annuaire_inclusion.categorie)), format_func=lambda x: x.replace('-', ' ').capitalize(), index=2)
-            service = st.selectbox('Service', sorted(set(annuaire_inclusion[annuaire_inclusion.categorie == cat].service)), format_func=lambda x: x.replace('-', ' ').capitalize(), index=0)
+            inclusion_services = app_data['inclusion_services']
+            cat = st.selectbox('Catégorie', sorted(set(inclusion_services.categorie)), format_func=lambda x: x.replace('-', ' ').capitalize(), index=2)
+            service = st.selectbox('Service', sorted(set(inclusion_services[inclusion_services.categorie == cat].service)), format_func=lambda x: x.replace('-', ' ').capitalize(), index=0)
             if st.button('Ajouter'):
                 st.session_state.ui_besoins_autres.setdefault(cat, []).append(service)
                 st.session_state.ui_besoins_autres[cat] = sorted(list(set(st.session_state.ui_besoins_autres[cat])))
@@ -182,14 +181,16 @@ def display_results_list(name: str):
     st.text(f'Voici des localités qui pourraient convenir à {name or "ce projet de vie"}.')
     st.markdown('<style>[class*="st-key-button_top"] .stButton button div {text-align:left; width:100%;}</style>', unsafe_allow_html=True)
 
-    top_n = 5
+    top_n = cfg.TOP_N_RESULTS
     df = st.session_state.processed_gdf
     is_highlighted, highlighted_index = st.session_state.highlighted_result
 
-    # Pre-build layers for top results to be shown on map
+    import maps
+
+    # Layers of the top results to be shown on map, built once per search
     for index, row in df.head(top_n).iterrows():
         fg_key = f'Top{index + 1}'
-        st.session_state.fg_dict_ref[fg_key] = maps.build_top_result_layer(row, index)
+        st.session_state.fg_dict_ref[fg_key] = maps.memoized_layer((fg_key,), maps.build_top_result_layer, row, index)
 
     # Display buttons and details
     for index, row in df.head(top_n).iterrows():
@@ -208,6 +209,8 @@ def display_results_list(name: str):
 
 def _display_result_details(row: pd.Series):
     """Displays the detailed information for a single highlighted result."""
+    from plotly.express import line_polar
+
     with st.container(border=True):
         # --- Pitch ---
         pitch = _produce_pitch_markdown(row)
@@ -225,28 +228,30 @@ def _display_result_details(row: pd.Series):
         # --- Additional Info ---
         st.divider()
         st.markdown('**Plus d’informations sur cette localité :**')
+        # Per-commune indexes: only the rows of this commune (and its binome) are read
+        app_data = st.session_state.app_data
+        odis_lists = app_data['odis_lists']
+        position = app_data['odis'].index.get_loc(row.codgeo)
         with st.expander('Top 10 des métiers recherchés'):
-            top_metiers = set(row.be_libfap_top if row.be_libfap_top is not None else [])
+            top_metiers = set(odis_lists['be_libfap_top'][position])
             if top_metiers:
                 st.markdown("\n".join([f'- {item}' for item in sorted(list(top_metiers))]))
             else:
                 st.info("Pas de données disponibles.")
         
         with st.expander('Formations proposées'):
-            formations = set(row.noms_formations if row.noms_formations is not None else [])
+            formations = set(odis_lists['noms_formations'][position])
             if row.binome:
-                binome_row = st.session_state.app_data['odis'].loc[row.codgeo_binome]
-                formations.update(binome_row.noms_formations if binome_row.noms_formations is not None else [])
+                formations.update(odis_lists['noms_formations'][app_data['odis'].index.get_loc(row.codgeo_binome)])
             if formations:
                 st.markdown("\n".join([f'- {item}' for item in sorted(list(formations))]))
             else:
                 st.info("Pas de données disponibles.")
         
         with st.expander("Services d'inclusions proposés"):
-            services = st.session_state.app_data['annuaire_inclusion']
-            services = services[services.codgeo == row.codgeo]
+            services = app_data['inclusion_by_commune'][position]
             if not services.empty:
-                for cat, group in services.groupby('categorie'):
+                for cat, group in services.groupby('categorie', sort=False, observed=True):
                     st.markdown(f"**{cat.replace('-', ' ').capitalize()}**")
                     for item in group.itertuples():
                         if item.service != '-':
@@ -274,11 +279,11 @@ def _produce_pitch_markdown(row: pd.Series) -> str:
         pitch_md.append(f'\nLa correspondance avec le projet est évaluée à **{score_percent}**. ')
 
     # --- Top contributing criteria ---
-    all_scores = scores_cat['score'].unique()
-    crit_scores_cols = [col for col in row.keys() if col in all_scores]
+    scores_by_name = scores_cat.drop_duplicates('score').set_index('score') # First definition of each score
+    crit_scores_cols = [col for col in row.keys() if col in scores_by_name.index]
     weighted_scores = {}
     for col in crit_scores_cols:
-        cat = scores_cat[scores_cat.score == col]['cat'].iloc[0]
+        cat = scores_by_name.at[col, 'cat']
         weight = getattr(config, f'poids_{cat}', 0)
         
         # Apply binome penalty if applicable
@@ -297,7 +302,7 @@ def _produce_pitch_markdown(row: pd.Series) -> str:
     count = 0
     for score_col, weighted_val in sorted_scores:
         if weighted_val > 0 and count < 5:
-            score_details = scores_cat[scores_cat.score == score_col].iloc[0]
+            score_details = scores_by_name.loc[score_col]
             pitch_md.append(f'- {score_details["score_affichage"]}')
             count += 1
 